@@ -4,9 +4,12 @@ from msgq import fake_event_handle, drain_sock_raw, MultiplePublishersError, Ipc
                  set_fake_prefix, get_fake_prefix, delete_fake_prefix, wait_for_one_event
 import msgq
 import os
+import bisect
 import capnp
+import struct
 import time
 
+from collections.abc import Iterable
 from typing import Union
 
 from openpilot.cereal import log
@@ -18,14 +21,17 @@ __all__ = (
   "Context",
   "FrequencyTracker",
   "IpcError",
+  "MessagingStats",
   "MultiplePublishersError",
   "Poller",
   "PubMaster",
   "PubSocket",
+  "RawEvent",
   "SocketEventHandle",
   "SubMaster",
   "SubSocket",
   "delete_fake_prefix",
+  "drain_many",
   "drain_sock",
   "drain_sock_raw",
   "fake_event_handle",
@@ -33,6 +39,7 @@ __all__ = (
   "log_from_bytes",
   "new_message",
   "pub_sock",
+  "raw_event",
   "recv_one",
   "recv_one_or_none",
   "recv_one_retry",
@@ -46,6 +53,10 @@ __all__ = (
 
 NO_TRAVERSAL_LIMIT = 2**64-1
 
+# upper bounds of the publish to receive latency histogram buckets, in ms. the last bucket is everything above
+LATENCY_BUCKETS_MS = (1., 2., 5., 10., 20., 50., 100., 200., 500.)
+STATS_REPORT_INTERVAL = 10.  # seconds
+
 
 def pub_sock(endpoint: str) -> PubSocket:
   service = SERVICE_LIST.get(endpoint)
@@ -91,6 +102,34 @@ def drain_sock(sock: SubSocket, wait_for_one: bool = False) -> list[capnp.lib.ca
   return [log_from_bytes(m) for m in msgs]
 
 
+def drain_many(socks: Iterable[SubSocket], poller: Poller | None = None, timeout: int = 0, raw: bool = False,
+               out: list | None = None) -> list:
+  """
+  Receive all messages currently available on several sockets in one call, ordered by logMonoTime.
+  With a poller, first waits up to timeout ms for one of its sockets to have a message. With raw, messages
+  are returned as RawEvents, which are ordered without decoding. Pass out to reuse the returned list.
+  """
+  if poller is not None:
+    poller.poll(timeout)
+
+  msgs = out if out is not None else []
+  msgs.clear()
+  for sock in socks:
+    for dat in drain_sock_raw(sock):
+      if raw:
+        evt = raw_event(dat)
+        if evt is None:
+          m = log_from_bytes(dat)
+          evt = RawEvent(dat, m.which(), m.logMonoTime, m.valid)
+        msgs.append(evt)
+      else:
+        msgs.append(log_from_bytes(dat))
+
+  # each socket's messages are already in order, so this is a merge of sorted runs
+  msgs.sort(key=lambda m: m.logMonoTime)
+  return msgs
+
+
 # TODO: print when we drop packets?
 def recv_sock(sock: SubSocket, wait: bool = False) -> capnp.lib.capnp._DynamicStructReader | None:
   """Same as drain sock, but only returns latest message. Consider using conflate instead."""
@@ -135,6 +174,66 @@ def recv_one_retry(sock: SubSocket) -> capnp.lib.capnp._DynamicStructReader:
       return log_from_bytes(dat)
 
 
+def _event_layout() -> tuple[int, int, int, bool, dict[int, str]]:
+  schema = log.Event.schema
+  valid = schema.fields['valid'].proto.slot
+  union_fields = set(schema.union_fields)
+  services = {f.proto.discriminantValue: name for name, f in schema.fields.items() if name in union_fields}
+  return schema.node.struct.discriminantOffset, schema.fields['logMonoTime'].proto.slot.offset, valid.offset, valid.defaultValue.bool, services
+
+EVENT_WHICH_OFFSET, EVENT_LOG_MONO_TIME_OFFSET, EVENT_VALID_OFFSET, EVENT_VALID_DEFAULT, EVENT_SERVICES = _event_layout()
+
+
+class RawEvent:
+  """Service, logMonoTime and valid read from a serialized Event's data section, without decoding the rest"""
+  __slots__ = ('dat', 'service', 'logMonoTime', 'valid')
+
+  def __init__(self, dat: bytes, service: str, log_mono_time: int, valid: bool):
+    self.dat = dat
+    self.service = service
+    self.logMonoTime = log_mono_time
+    self.valid = valid
+
+  def which(self) -> str:
+    return self.service
+
+
+def raw_event(dat: bytes) -> RawEvent | None:
+  """Returns None for layouts that need a full decode, e.g. a far root pointer"""
+  # https://capnproto.org/encoding.html
+  if len(dat) < 16:
+    return None
+  num_segments = struct.unpack_from('<I', dat)[0] + 1
+  header_size = (4 * (num_segments + 1) + 7) & ~7
+  if len(dat) < header_size + 8:
+    return None
+  segment_end = header_size + 8 * struct.unpack_from('<I', dat, 4)[0]
+  root = struct.unpack_from('<Q', dat, header_size)[0]
+  if root & 3 != 0:
+    return None
+
+  offset = (root >> 2) & 0x3FFFFFFF
+  if offset & 0x20000000:
+    offset -= 0x40000000
+  data_start = header_size + 8 * (1 + offset)
+  data_end = data_start + 8 * ((root >> 32) & 0xFFFF)
+  if data_start < header_size or data_end > min(segment_end, len(dat)):
+    return None
+
+  # fields past the data section are at their default, non-zero defaults are stored XORed
+  which_pos = data_start + 2 * EVENT_WHICH_OFFSET
+  which = struct.unpack_from('<H', dat, which_pos)[0] if which_pos + 2 <= data_end else 0
+  time_pos = data_start + 8 * EVENT_LOG_MONO_TIME_OFFSET
+  log_mono_time = struct.unpack_from('<Q', dat, time_pos)[0] if time_pos + 8 <= data_end else 0
+  valid_pos = data_start + EVENT_VALID_OFFSET // 8
+  valid_bit = bool(dat[valid_pos] >> (EVENT_VALID_OFFSET % 8) & 1) if valid_pos < data_end else False
+
+  service = EVENT_SERVICES.get(which)
+  if service is None:
+    return None
+  return RawEvent(dat, service, log_mono_time, valid_bit != EVENT_VALID_DEFAULT)
+
+
 class FrequencyTracker:
   def __init__(self, service_freq: float, update_freq: float, is_poll: bool):
     freq = max(min(service_freq, update_freq), 1.)
@@ -178,10 +277,98 @@ class FrequencyTracker:
     return self.min_freq <= avg_freq_recent <= self.max_freq
 
 
+class ServiceStats:
+  def __init__(self, service_freq: float):
+    self.service_freq = service_freq
+    self.count = 0
+    self.bytes = 0
+    self.drops = 0
+    self.max_latency = 0.
+    self.latency_hist = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+    self.last_log_mono_time = 0
+
+  def record(self, log_mono_time: int, size: int, cur_time_ns: int) -> None:
+    self.count += 1
+    self.bytes += size
+
+    # logMonoTime is set when the message is created, so this includes publishing and queueing
+    latency = (cur_time_ns - log_mono_time) / 1e6
+    self.latency_hist[bisect.bisect_left(LATENCY_BUCKETS_MS, latency)] += 1
+    self.max_latency = max(self.max_latency, latency)
+
+    # messages of a fixed frequency service missing between two received ones were dropped, or skipped by conflating
+    if self.last_log_mono_time > 0 and self.service_freq > 1e-5:
+      self.drops += max(round((log_mono_time - self.last_log_mono_time) * 1e-9 * self.service_freq) - 1, 0)
+    self.last_log_mono_time = log_mono_time
+
+  def latency_percentile(self, p: float) -> float:
+    """Upper bound of the histogram bucket containing the p-th percentile latency, in ms"""
+    target = p / 100. * self.count
+    total = 0
+    for bound, n in zip(LATENCY_BUCKETS_MS, self.latency_hist, strict=False):
+      total += n
+      if total >= target:
+        return min(bound, self.max_latency)
+    return self.max_latency
+
+
+class MessagingStats:
+  def __init__(self, report_interval: float = STATS_REPORT_INTERVAL):
+    """Per-service receive latency, throughput and drop counters, and sent message counters"""
+    self.report_interval = report_interval
+    self.reset(time.monotonic())
+
+  def reset(self, cur_time: float) -> None:
+    self.start_time = cur_time
+    self.recv: dict[str, ServiceStats] = {}
+    self.sent: dict[str, list[int]] = {}
+
+  def record_recv(self, service: str, log_mono_time: int, size: int, cur_time_ns: int) -> None:
+    if service not in self.recv:
+      self.recv[service] = ServiceStats(SERVICE_LIST[service].frequency if service in SERVICE_LIST else 0.)
+    self.recv[service].record(log_mono_time, size, cur_time_ns)
+
+  def record_send(self, service: str, size: int) -> None:
+    sent = self.sent.setdefault(service, [0, 0])
+    sent[0] += 1
+    sent[1] += size
+
+  def summary(self, cur_time: float) -> dict:
+    dt = max(cur_time - self.start_time, 1e-9)
+    recv = {s: {
+      "freq": st.count / dt,
+      "bytes_per_sec": st.bytes / dt,
+      "drops": st.drops,
+      "latency_p50_ms": st.latency_percentile(50),
+      "latency_p99_ms": st.latency_percentile(99),
+      "latency_max_ms": st.max_latency,
+      "latency_hist": st.latency_hist,
+    } for s, st in self.recv.items()}
+    sent = {s: {"freq": count / dt, "bytes_per_sec": size / dt} for s, (count, size) in self.sent.items()}
+    return {"duration": dt, "recv": recv, "sent": sent}
+
+  def maybe_report(self, cur_time: float) -> None:
+    """Logs a messaging_stats event with the summary every report_interval seconds, and starts over"""
+    if cur_time - self.start_time < self.report_interval:
+      return
+    from openpilot.common.swaglog import cloudlog
+    cloudlog.event("messaging_stats", latency_buckets_ms=LATENCY_BUCKETS_MS, **self.summary(cur_time))
+    self.reset(cur_time)
+
+
+def stats_enabled(stats: bool | None) -> bool:
+  return stats if stats is not None else bool(int(os.getenv("MESSAGING_STATS", "0")))
+
+
 class SubMaster:
   def __init__(self, services: list[str], poll: str | None = None,
                ignore_alive: list[str] | None = None, ignore_avg_freq: list[str] | None = None,
-               ignore_valid: list[str] | None = None, addr: str = "127.0.0.1", frequency: float | None = None):
+               ignore_valid: list[str] | None = None, addr: str = "127.0.0.1", frequency: float | None = None,
+               lazy: bool = False, stats: bool | None = None):
+    """
+    With lazy, received messages are kept serialized and only decoded on their first sm[s] access.
+    With stats, or MESSAGING_STATS=1, receive latency, throughput and drops are tracked in self.stats and logged periodically.
+    """
     self.frame = -1
     self.services = services
     self.seen = dict.fromkeys(services, False)
@@ -191,6 +378,12 @@ class SubMaster:
     self.sock = {}
     self.data = {}
     self.logMonoTime = dict.fromkeys(services, 0)
+    self.lazy = lazy
+    self._raw: dict[str, bytes] = {}
+    # time spent and messages decoded per service
+    self.decode_time = dict.fromkeys(services, 0.0)
+    self.decode_count = dict.fromkeys(services, 0)
+    self.stats = MessagingStats() if stats_enabled(stats) else None
 
     # zero-frequency / on-demand services are always alive and presumed valid; all others must pass checks
     on_demand = {s: SERVICE_LIST[s].frequency <= 1e-5 for s in services}
@@ -227,22 +420,45 @@ class SubMaster:
       self.freq_tracker[s] = FrequencyTracker(SERVICE_LIST[s].frequency, self.update_freq, s == poll)
 
   def __getitem__(self, s: str) -> capnp.lib.capnp._DynamicStructReader:
+    dat = self._raw.pop(s, None)
+    if dat is not None:
+      self.data[s] = getattr(self._decode(dat), s)
     return self.data[s]
 
+  def _decode(self, dat: bytes) -> capnp.lib.capnp._DynamicStructReader:
+    t = time.perf_counter()
+    msg = log_from_bytes(dat)
+    s = msg.which()
+    self.decode_time[s] += time.perf_counter() - t
+    self.decode_count[s] += 1
+    return msg
+
   def _check_avg_freq(self, s: str) -> bool:
     return SERVICE_LIST[s].frequency > 0.99 and (s not in self.ignore_average_freq) and (s not in self.ignore_alive)
 
   def update(self, timeout: int = 100) -> None:
-    msgs = []
+    dats = []
     for sock in self.poller.poll(timeout):
-      msgs.append(recv_one_or_none(sock))
+      dats.append(sock.receive(non_blocking=True))
 
     # non-blocking receive for non-polled sockets
     for s in self.non_polled_services:
-      msgs.append(recv_one_or_none(self.sock[s]))
-    self.update_msgs(time.monotonic(), msgs)
+      dats.append(self.sock[s].receive(non_blocking=True))
 
-  def update_msgs(self, cur_time: float, msgs: list[capnp.lib.capnp._DynamicStructReader]) -> None:
+    msgs = []
+    for dat in dats:
+      if dat is not None:
+        msgs.append((self.lazy and raw_event(dat)) or self._decode(dat))
+
+    cur_time = time.monotonic()
+    if self.stats is not None:
+      cur_time_ns = time.monotonic_ns()
+      for dat, msg in zip((d for d in dats if d is not None), msgs, strict=True):
+        self.stats.record_recv(msg.which(), msg.logMonoTime, len(dat), cur_time_ns)
+      self.stats.maybe_report(cur_time)
+    self.update_msgs(cur_time, msgs)
+
+  def update_msgs(self, cur_time: float, msgs: list[capnp.lib.capnp._DynamicStructReader | RawEvent]) -> None:
     self.frame += 1
     self.updated = dict.fromkeys(self.services, False)
     for msg in msgs:
@@ -256,7 +472,11 @@ class SubMaster:
       self.freq_tracker[s].record_recv_time(cur_time)
       self.recv_time[s] = cur_time
       self.recv_frame[s] = self.frame
-      self.data[s] = getattr(msg, s)
+      if isinstance(msg, RawEvent):
+        self._raw[s] = msg.dat
+      else:
+        self._raw.pop(s, None)
+        self.data[s] = getattr(msg, s)
       self.logMonoTime[s] = msg.logMonoTime
       self.valid[s] = msg.valid
 
@@ -279,15 +499,19 @@ class SubMaster:
 
 
 class PubMaster:
-  def __init__(self, services: list[str]):
+  def __init__(self, services: list[str], stats: bool | None = None):
     self.sock = {}
     for s in services:
       self.sock[s] = pub_sock(s)
+    self.stats = MessagingStats() if stats_enabled(stats) else None
 
   def send(self, s: str, dat: Union[bytes, capnp.lib.capnp._DynamicStructBuilder]) -> None:
     if not isinstance(dat, bytes):
       dat = dat.to_bytes()
     self.sock[s].send(dat)
+    if self.stats is not None:
+      self.stats.record_send(s, len(dat))
+      self.stats.maybe_report(time.monotonic())
 
   def wait_for_readers_to_update(self, s: str, timeout: int, dt: float = 0.05) -> bool:
     try:
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+"""
+Latency, drops and CPU use of msgq and the msgq to zmq bridge for a mix of services published at their
+SERVICE_LIST frequencies. Run it before and after messaging changes, or with --max-p99-ms/--max-drop-pct to gate them.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+
+import openpilot.cereal.messaging as messaging
+from openpilot.cereal.services import SERVICE_LIST
+from openpilot.common.basedir import BASEDIR
+
+BRIDGE = os.path.join(BASEDIR, "openpilot/cereal/messaging/bridge")
+DEFAULT_SERVICES = ["can", "sendcan", "carState", "carControl", "controlsState", "selfdriveState", "modelV2",
+                    "cameraOdometry", "roadCameraState", "accelerometer", "gyroscope", "livePose", "deviceState"]
+# time for the subscriber to connect before publishing, and to drain after
+SETTLE_TIME = 1.
+
+
+def get_traffic(services: list[str], route: str | None, max_msgs: int = 100) -> dict[str, list[bytes]]:
+  """Serialized messages to publish for each service, taken from a log for realistic sizes, or default initialized"""
+  traffic: dict[str, list[bytes]] = {s: [] for s in services}
+  if route is not None:
+    from openpilot.tools.lib.logreader import LogReader
+    for msg in LogReader(route):
+      s = msg.which()
+      if s in traffic and len(traffic[s]) < max_msgs:
+        traffic[s].append(msg.as_builder().to_bytes())
+
+  for s, dats in traffic.items():
+    if not len(dats):
+      try:
+        dats.append(messaging.new_message(s).to_bytes())
+      except Exception:
+        dats.append(messaging.new_message(s, 0).to_bytes())
+  return traffic
+
+
+def cpu_time(pid: int) -> float:
+  with open(f"/proc/{pid}/stat") as f:
+    fields = f.read().rsplit(")", 1)[1].split()
+  # utime and stime, fields 14 and 15
+  return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def publisher(traffic: dict[str, list[bytes]], duration: float, rate: float, results) -> None:
+  pm = messaging.PubMaster(list(traffic))
+  msgs = {s: [messaging.log_from_bytes(dat).as_builder() for dat in dats] for s, dats in traffic.items()}
+  intervals = {s: 1. / (SERVICE_LIST[s].frequency * rate) for s in traffic if SERVICE_LIST[s].frequency > 1e-5}
+  sent = dict.fromkeys(traffic, 0)
+
+  time.sleep(SETTLE_TIME)
+  start = time.monotonic()
+  next_send = dict.fromkeys(intervals, start)
+  cpu_start = time.process_time()
+  while (cur_time := time.monotonic()) - start < duration:
+    for s, t in next_send.items():
+      if cur_time >= t:
+        msg = msgs[s][sent[s] % len(msgs[s])]
+        msg.logMonoTime = time.monotonic_ns()
+        pm.send(s, msg.to_bytes())
+        sent[s] += 1
+        next_send[s] = t + intervals[s]
+    time.sleep(max(min(next_send.values()) - time.monotonic(), 0))
+  results.put(("publisher", sent, time.process_time() - cpu_start))
+
+
+def subscriber(services: list[str], duration: float, zmq: bool, results) -> None:
+  if zmq:
+    os.environ["ZMQ"] = "1"
+    messaging.reset_context()
+  poller = messaging.Poller()
+  socks = [messaging.sub_sock(s, poller=poller, conflate=False) for s in services]
+  stats = messaging.MessagingStats()
+
+  end_time = time.monotonic() + duration + 2 * SETTLE_TIME
+  cpu_start = time.process_time()
+  while time.monotonic() < end_time:
+    evts = messaging.drain_many(socks, poller, timeout=10, raw=True)
+    cur_time_ns = time.monotonic_ns()
+    for evt in evts:
+      stats.record_recv(evt.which(), evt.logMonoTime, len(evt.dat), cur_time_ns)
+  summary = stats.summary(time.monotonic())
+  summary["counts"] = {s: st.count for s, st in stats.recv.items()}
+  results.put(("subscriber", summary, time.process_time() - cpu_start))
+
+
+def run_benchmark(traffic: dict[str, list[bytes]], duration: float, rate: float, bridge: bool) -> dict:
+  """Publishes traffic over msgq for duration seconds, received directly or through the msgq to zmq bridge"""
+  results: multiprocessing.Queue = multiprocessing.Queue()
+  bridge_proc = subprocess.Popen([BRIDGE]) if bridge else None
+  procs = [
+    multiprocessing.Process(target=subscriber, args=(list(traffic), duration, bridge, results)),
+    multiprocessing.Process(target=publisher, args=(traffic, duration, rate, results)),
+  ]
+  try:
+    for p in procs:
+      p.start()
+    out = {name: (res, cpu) for name, res, cpu in (results.get(timeout=duration + 30) for _ in procs)}
+    bridge_cpu = cpu_time(bridge_proc.pid) if bridge_proc is not None else 0.
+  finally:
+    for p in procs:
+      p.join(timeout=5)
+    if bridge_proc is not None:
+      bridge_proc.terminate()
+      bridge_proc.wait()
+
+  sent, pub_cpu = out["publisher"]
+  summary, sub_cpu = out["subscriber"]
+  services = {}
+  for s, n in sent.items():
+    recv = summary["recv"].get(s, {})
+    received = summary["counts"].get(s, 0)
+    services[s] = {
+      "sent": n,
+      "received": received,
+      "drops": max(n - received, 0),
+      "bytes_per_sec": recv.get("bytes_per_sec", 0.),
+      "latency_p50_ms": recv.get("latency_p50_ms", float("nan")),
+      "latency_p99_ms": recv.get("latency_p99_ms", float("nan")),
+      "latency_max_ms": recv.get("latency_max_ms", float("nan")),
+    }
+  return {
+    "transport": "bridge" if bridge else "msgq",
+    "duration": duration,
+    "rate": rate,
+    "cpu": {"publisher": pub_cpu / duration, "subscriber": sub_cpu / duration, "bridge": bridge_cpu / duration},
+    "services": services,
+  }
+
+
+def print_results(res: dict) -> None:
+  cpu = ", ".join(f"{k} {v * 100:.1f}%" for k, v in res["cpu"].items())
+  print(f"\n***** {res['transport']}, {res['rate']}x rate, {res['duration']} s, cpu: {cpu} *****")
+  print(f"{'service':<20}{'sent':>8}{'drops':>7}{'KB/s':>10}{'p50 ms':>9}{'p99 ms':>9}{'max ms':>9}")
+  for s, st in res["services"].items():
+    latency = f"{st['latency_p50_ms']:>9.2f}{st['latency_p99_ms']:>9.2f}{st['latency_max_ms']:>9.2f}"
+    print(f"{s:<20}{st['sent']:>8}{st['drops']:>7}{st['bytes_per_sec'] / 1e3:>10.1f}{latency}")
+
+
+def check_results(res: dict, max_p99_ms: float | None, max_drop_pct: float | None) -> list[str]:
+  failures = []
+  for s, st in res["services"].items():
+    if max_p99_ms is not None and not st["latency_p99_ms"] <= max_p99_ms:
+      failures.append(f"{res['transport']} {s}: p99 latency {st['latency_p99_ms']:.2f} ms > {max_p99_ms} ms")
+    if max_drop_pct is not None and st["sent"] > 0 and 100. * st["drops"] / st["sent"] > max_drop_pct:
+      failures.append(f"{res['transport']} {s}: dropped {st['drops']}/{st['sent']} msgs")
+  return failures
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Benchmark latency, drops and CPU of msgq and the msgq to zmq bridge for a mix of services",
+                                   formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument("--services", nargs="*", default=DEFAULT_SERVICES, help="services to publish at their SERVICE_LIST frequency")
+  parser.add_argument("--route", help="take messages from this route or segment for realistic sizes, instead of default initialized ones")
+  parser.add_argument("--duration", type=float, default=10., help="seconds to publish for")
+  parser.add_argument("--rate", type=float, default=1., help="multiplier for the service frequencies")
+  parser.add_argument("--transport", choices=["msgq", "bridge", "both"], default="both")
+  parser.add_argument("--max-p99-ms", type=float, help="fail if any service has a higher p99 latency")
+  parser.add_argument("--max-drop-pct", type=float, help="fail if any service drops a larger share of its messages")
+  parser.add_argument("--json", help="write the results to this file")
+  args = parser.parse_args()
+
+  services = [s for s in args.services if SERVICE_LIST[s].frequency > 1e-5]
+  traffic = get_traffic(services, args.route)
+  transports = [False, True] if args.transport == "both" else [args.transport == "bridge"]
+  results = [run_benchmark(traffic, args.duration, args.rate, bridge) for bridge in transports]
+
+  failures = []
+  for res in results:
+    print_results(res)
+    failures += check_results(res, args.max_p99_ms, args.max_drop_pct)
+
+  if args.json:
+    with open(args.json, "w") as f:
+      json.dump(results, f, indent=2)
+
+  if failures:
+    print("\n" + "\n".join(failures))
+    print("BENCHMARK FAILED")
+  sys.exit(int(len(failures) > 0))
@@ -90,6 +90,33 @@ class TestMessaging(OpenpilotTestCase):
     assert all(isinstance(msg, expected_type) for msg in msgs)
     assert len(msgs) == num_msgs
 
+  @parameterized.expand([
+    (False, capnp._DynamicStructReader),
+    (True, messaging.RawEvent),
+  ])
+  def test_drain_many(self, raw, expected_type):
+    socks = ["carState", "carControl", "deviceState"]
+    pub_socks = [messaging.pub_sock(s) for s in socks]
+    poller = messaging.Poller()
+    sub_socks = [messaging.sub_sock(s, poller=poller, timeout=1000) for s in socks]
+
+    # no msgs in queue
+    msgs = messaging.drain_many(sub_socks, poller, timeout=10, raw=raw)
+    assert msgs == []
+
+    # msgs published out of order across sockets
+    num_msgs = random.randrange(3, 10)
+    for i in range(num_msgs):
+      for j, (s, pub_sock) in enumerate(zip(socks, pub_socks, strict=True)):
+        pub_sock.send(messaging.new_message(s, logMonoTime=1000 * i + len(socks) - j).to_bytes())
+    time.sleep(0.1)
+    out: list = []
+    msgs = messaging.drain_many(sub_socks, poller, raw=raw, out=out)
+    assert msgs is out
+    assert all(isinstance(msg, expected_type) for msg in msgs)
+    assert len(msgs) == num_msgs * len(socks)
+    assert [m.logMonoTime for m in msgs] == sorted(m.logMonoTime for m in msgs)
+
   def test_recv_sock(self):
     sock = "carState"
     pub_sock = messaging.pub_sock(sock)
@@ -44,6 +44,52 @@ class TestSubMaster(OpenpilotTestCase):
     sm.update(1000)
     assert_carstate(msg.carState, sm[sock])
 
+  def test_lazy_getitem(self):
+    sock = "carState"
+    pub_sock = messaging.pub_sock(sock)
+    sm = messaging.SubMaster([sock,], lazy=True)
+
+    for i, valid in enumerate((True, False)):
+      msg = random_carstate()
+      msg.valid = valid
+      pub_sock.send(msg.to_bytes())
+      sm.update(1000)
+      assert sm.updated[sock]
+      assert sm.valid[sock] == valid
+      assert sm.logMonoTime[sock] == msg.logMonoTime
+      assert sm.decode_count[sock] == i
+      assert_carstate(msg.carState, sm[sock])
+      # decoded once, on first access
+      assert_carstate(msg.carState, sm[sock])
+      assert sm.decode_count[sock] == i + 1
+
+  def test_stats(self):
+    sock = "carState"
+    pm = messaging.PubMaster([sock,], stats=True)
+    sm = messaging.SubMaster([sock,], stats=True)
+
+    n = 5
+    for _ in range(n):
+      msg = random_carstate()
+      pm.send(sock, msg)
+      sm.update(1000)
+    assert sm.stats is not None and pm.stats is not None
+    recv = sm.stats.summary(time.monotonic())["recv"][sock]
+    assert sum(recv["latency_hist"]) == n
+    assert recv["latency_max_ms"] >= recv["latency_p99_ms"] >= recv["latency_p50_ms"] >= 0
+    assert pm.stats.sent[sock][0] == n
+
+  def test_raw_event(self):
+    for sock in random_socks():
+      try:
+        msg = messaging.new_message(sock)
+      except Exception:
+        msg = messaging.new_message(sock, random.randrange(50))
+      msg.valid = random.choice([True, False])
+      raw = messaging.raw_event(msg.to_bytes())
+      assert raw is not None
+      assert (raw.which(), raw.logMonoTime, raw.valid) == (msg.which(), msg.logMonoTime, msg.valid)
+
   # TODO: break this test up to individually test SubMaster.update and SubMaster.update_msgs
   def test_update(self):
     sock = "carState"
@@ -0,0 +1,96 @@
+import ctypes
+import os
+import select
+import struct
+import sys
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+
+_EVENT = struct.Struct("iIII")
+
+if sys.platform.startswith("linux"):
+  _libc = ctypes.CDLL(None, use_errno=True)
+  _libc.inotify_init1.argtypes = [ctypes.c_int]
+  _libc.inotify_init1.restype = ctypes.c_int
+  _libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+  _libc.inotify_add_watch.restype = ctypes.c_int
+  _libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+  _libc.inotify_rm_watch.restype = ctypes.c_int
+
+
+def _raise_os_error(path: str | None = None) -> None:
+  error = ctypes.get_errno()
+  raise OSError(error, os.strerror(error), path)
+
+
+class Inotify:
+  """Non-blocking inotify instance. Raises OSError where inotify isn't available."""
+
+  def __init__(self) -> None:
+    self.fd = -1
+    if not sys.platform.startswith("linux"):
+      raise OSError("inotify is only supported on Linux")
+    self.fd = _libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    if self.fd < 0:
+      _raise_os_error()
+
+  def fileno(self) -> int:
+    return self.fd
+
+  def add_watch(self, path: str, mask: int) -> int:
+    wd = _libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+    if wd < 0:
+      _raise_os_error(path)
+    return wd
+
+  def rm_watch(self, wd: int) -> None:
+    _libc.inotify_rm_watch(self.fd, wd)
+
+  def read(self, timeout: float | None = 0) -> list[tuple[int, int, int, str]]:
+    """Returns the queued (wd, mask, cookie, name) events, waiting up to timeout seconds for the first one"""
+    if timeout != 0 and not select.select([self.fd], [], [], timeout)[0]:
+      return []
+
+    events = []
+    while True:
+      try:
+        buf = os.read(self.fd, 64 * 1024)
+      except BlockingIOError:
+        break
+      offset = 0
+      while offset < len(buf):
+        wd, mask, cookie, size = _EVENT.unpack_from(buf, offset)
+        offset += _EVENT.size
+        name = buf[offset:offset + size].rstrip(b"\0").decode(errors="replace")
+        offset += size
+        events.append((wd, mask, cookie, name))
+    return events
+
+  def close(self) -> None:
+    if self.fd >= 0:
+      os.close(self.fd)
+      self.fd = -1
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args) -> None:
+    self.close()
+
+  def __del__(self) -> None:
+    self.close()
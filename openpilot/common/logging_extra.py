@@ -71,6 +71,9 @@ class SwagFormatter(logging.Formatter):
   def format(self, record):
     if self.swaglogger is None:
       raise Exception("must set swaglogger before calling format()")
+    # already formatted by AsyncLogHandler when it was logged
+    if getattr(record, 'swaglog_formatted', None) is not None:
+      return record.swaglog_formatted
     return json_robust_dumps(self.format_dict(record))
 
 class SwagLogFileFormatter(SwagFormatter):
@@ -101,6 +104,8 @@ class SwagLogFileFormatter(SwagFormatter):
   def format(self, record):
     if isinstance(record, str):
       v = json.loads(record)
+    elif getattr(record, 'swaglog_formatted', None) is not None:
+      v = json.loads(record.swaglog_formatted)
     else:
       v = self.format_dict(record)
 
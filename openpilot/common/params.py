@@ -1,12 +1,16 @@
+import os
 import sys
 import json
 import ctypes
+import struct
 import weakref
 import builtins
 import datetime
 from pathlib import Path
 from enum import IntEnum, IntFlag
 
+from openpilot.common.inotify import Inotify, IN_CLOSE_WRITE, IN_DELETE, IN_DELETE_SELF, IN_IGNORED, IN_MOVED_FROM, IN_MOVED_TO, \
+                                     IN_ONLYDIR, IN_Q_OVERFLOW
 from openpilot.common.swaglog import cloudlog
 
 
@@ -69,6 +73,7 @@ params_check_key = _bind("params_check_key", [ParamsHandle, ctypes.c_char_p], ct
 params_get_key_type = _bind("params_get_key_type", [ParamsHandle, ctypes.c_char_p], ctypes.c_int)
 params_get_default = _bind("params_get_default", [ParamsHandle, ctypes.c_char_p], ParamsBuffer)
 params_get = _bind("params_get", [ParamsHandle, ctypes.c_char_p, ctypes.c_bool], ParamsBuffer)
+params_get_many = _bind("params_get_many", [ParamsHandle, ctypes.POINTER(ctypes.c_char_p), ctypes.c_size_t], ParamsBuffer)
 params_get_bool = _bind("params_get_bool", [ParamsHandle, ctypes.c_char_p, ctypes.c_bool], ctypes.c_bool)
 params_put = _bind("params_put", [ParamsHandle, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_size_t, ctypes.c_bool], ctypes.c_int)
 params_put_bool = _bind("params_put_bool", [ParamsHandle, ctypes.c_char_p, ctypes.c_bool, ctypes.c_bool], ctypes.c_int)
@@ -98,6 +103,11 @@ CPP_2_PYTHON = {
 }
 
 
+# param writes are a rename into the params directory, removals an unlink
+CACHE_WATCH_MASK = IN_MOVED_TO | IN_MOVED_FROM | IN_CLOSE_WRITE | IN_DELETE | IN_DELETE_SELF | IN_ONLYDIR
+_VALUE_SIZE = struct.Struct("=Q")
+
+
 def ensure_bytes(v):
   return v.encode() if isinstance(v, str) else v
 
@@ -108,19 +118,40 @@ def _copy_string(value):
   return ctypes.string_at(value.data, value.size)
 
 
+def _split_values(buf, count):
+  values = []
+  offset = 0
+  for _ in range(count):
+    size, = _VALUE_SIZE.unpack_from(buf, offset)
+    offset += _VALUE_SIZE.size
+    values.append(buf[offset:offset + size])
+    offset += size
+  return values
+
+
 class UnknownKeyName(Exception):
   pass
 
 
 class Params:
-  def __init__(self, d=""):
+  def __init__(self, d="", cache=False):
+    """With cache=True decoded values are kept until the param is written, as reported by inotify on
+    the params directory, so polling a param that hasn't changed costs no reads or decoding. Cached
+    values are shared between calls and must not be modified."""
     path = ensure_bytes(d)
     self.p = params_create(path, len(path))
     self._finalizer = weakref.finalize(self, params_destroy, self.p)
     self.d = d
+    self.cache = cache
+
+    self._types: dict[bytes, ParamKeyType] = {}
+    self._defaults: dict[bytes, object] = {}
+    self._values: dict[bytes, object] = {}
+    self._watcher: Inotify | None = None
+    self._watcher_pid = -1
 
   def __reduce__(self):
-    return (type(self), (self.d,))
+    return (type(self), (self.d, self.cache))
 
   def clear_all(self, tx_flag=ParamKeyFlag.ALL):
     params_clear_all(self.p, int(tx_flag))
@@ -131,6 +162,15 @@ class Params:
       raise UnknownKeyName(key)
     return key
 
+  def _check_key_type(self, key):
+    # key types are fixed, only check and look them up once
+    k = ensure_bytes(key)
+    t = self._types.get(k)
+    if t is None:
+      k = self.check_key(k)
+      t = self._types[k] = ParamKeyType(params_get_key_type(self.p, k))
+    return k, t
+
   def python2cpp(self, proposed_type, expected_type, value, key):
     cast = PYTHON_2_CPP.get((proposed_type, expected_type))
     if cast:
@@ -149,9 +189,65 @@ class Params:
   def _default(self, key):
     return _copy_string(params_get_default(self.p, key))
 
+  def _get_default(self, k, t, key):
+    if k not in self._defaults:
+      self._defaults[k] = self._cpp2python(t, self._default(k), None, key)
+    return self._defaults[k]
+
+  def _update_cache(self):
+    """Drops the cached values of params written since the last call"""
+    # inotify instances aren't shared with forked children
+    if self._watcher is None or self._watcher_pid != os.getpid():
+      self._values.clear()
+      try:
+        self._watcher = Inotify()
+        self._watcher.add_watch(self.get_param_path(), CACHE_WATCH_MASK)
+        self._watcher_pid = os.getpid()
+      except OSError:
+        cloudlog.exception("params: failed to watch params directory, disabling cache")
+        self._watcher = None
+        self.cache = False
+      return
+
+    for _, mask, _, name in self._watcher.read():
+      if mask & (IN_Q_OVERFLOW | IN_IGNORED):
+        # missed events or the directory is gone, start over
+        self._values.clear()
+        if mask & IN_IGNORED:
+          self._watcher = None
+      else:
+        self._values.pop(name.encode(), None)
+
+  def get_many(self, keys, return_default=False):
+    """Returns a dict of key to value, like get, reading all params not in the cache with a single call"""
+    key_types = [self._check_key_type(key) for key in keys]
+    if self.cache:
+      self._update_cache()
+    to_read = list({k: None for k, _ in key_types if not self.cache or k not in self._values})
+
+    read = {}
+    if len(to_read):
+      buf = _copy_string(params_get_many(self.p, (ctypes.c_char_p * len(to_read))(*to_read), len(to_read)))
+      read = dict(zip(to_read, _split_values(buf, len(to_read)), strict=True))
+
+    ret = {}
+    for key, (k, t) in zip(keys, key_types, strict=True):
+      if k in read:
+        value = self._cpp2python(t, read[k] or None, None, key)
+        if self.cache:
+          self._values[k] = value
+      else:
+        value = self._values[k]
+      if value is None and return_default:
+        value = self._get_default(k, t, key)
+      ret[key] = value
+    return ret
+
   def get(self, key, block=False, return_default=False):
-    k = self.check_key(key)
-    t = self.get_type(k)
+    if self.cache and not block:
+      return self.get_many([key], return_default)[key]
+
+    k, t = self._check_key_type(key)
     default = self._default(k) if return_default else None
     value = _copy_string(params_get(self.p, k, block))
     if value == b"":
@@ -161,6 +257,8 @@ class Params:
     return self._cpp2python(t, value, default, key)
 
   def get_bool(self, key, block=False):
+    if self.cache and not block and self._check_key_type(key)[1] == ParamKeyType.BOOL:
+      return self.get_many([key])[key] is True
     return bool(params_get_bool(self.p, self.check_key(key), block))
 
   def _put_cast(self, key, dat):
@@ -183,7 +281,7 @@ class Params:
     return _copy_string(params_get_path(self.p, key, len(key))).decode()
 
   def get_type(self, key):
-    return ParamKeyType(params_get_key_type(self.p, self.check_key(key)))
+    return self._check_key_type(key)[1]
 
   def all_keys(self):
     keys = []
@@ -192,8 +290,7 @@ class Params:
     return keys
 
   def get_default_value(self, key):
-    k = self.check_key(key)
-    return self._cpp2python(self.get_type(k), self._default(k), None, key)
+    return self._get_default(*self._check_key_type(key), key)
 
   def cpp2python(self, key, value):
     return self._cpp2python(self.get_type(key), value, None, key)
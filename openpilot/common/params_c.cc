@@ -1,4 +1,5 @@
 #include <cstddef>
+#include <cstdint>
 #include <cstdio>
 #include <exception>
 #include <string>
@@ -107,6 +108,20 @@ ParamsBuffer params_get(ParamsHandle *handle, const char *key, bool block) noexc
   });
 }
 
+// values of count keys, each prefixed with its uint64_t size, read in a single call
+ParamsBuffer params_get_many(ParamsHandle *handle, const char *const *keys, size_t count) noexcept {
+  return translate_exceptions(ParamsBuffer{nullptr, 0}, [&]() {
+    std::string out;
+    for (size_t i = 0; i < count; ++i) {
+      std::string value = handle->params.get(keys[i]);
+      uint64_t size = value.size();
+      out.append(reinterpret_cast<const char *>(&size), sizeof(size));
+      out += value;
+    }
+    return return_string(std::move(out));
+  });
+}
+
 bool params_get_bool(ParamsHandle *handle, const char *key, bool block) noexcept {
   return translate_exceptions(false, [&]() {
     return handle->params.getBool(key, block);
@@ -3,6 +3,11 @@ import gc
 import os
 import sys
 import time
+import weakref
+from bisect import bisect_left
+from collections import defaultdict
+from collections.abc import Callable
+from contextlib import nullcontext
 
 from setproctitle import getproctitle
 
@@ -16,6 +21,11 @@ DT_MDL = 0.05  # model
 DT_HW = 0.5  # hardwared and manager
 DT_DMON = 0.05  # driver monitoring
 
+# profile Ratekeeper loops, see LoopProfiler
+LOOP_PROFILE = bool(int(os.getenv("LOOP_PROFILE", "0")))
+# loop profiler histogram bucket edges, as fractions of the loop interval
+LOOP_BUCKETS = (0.1, 0.25, 0.5, 0.75, 0.9, 1., 1.25, 1.5, 2., 5.)
+
 
 class Priority:
   # CORE 2
@@ -46,9 +56,142 @@ def config_realtime_process(cores: int | list[int], priority: int) -> None:
   set_core_affinity(c)
 
 
+class Timings:
+  """Count, mean, max and histogram of durations"""
+  def __init__(self, edges: list[float]) -> None:
+    self.edges = edges
+    self.hist = [0] * (len(edges) + 1)
+    self.count = 0
+    self.total = 0.
+    self.max = 0.
+
+  def add(self, dt: float) -> None:
+    self.hist[bisect_left(self.edges, dt)] += 1
+    self.count += 1
+    self.total += dt
+    self.max = max(self.max, dt)
+
+  def summary(self) -> dict:
+    return {
+      "count": self.count,
+      "mean_ms": 1e3 * self.total / max(self.count, 1),
+      "max_ms": 1e3 * self.max,
+      "hist": self.hist,
+    }
+
+
+class _Phase:
+  __slots__ = ("profiler", "name", "start", "prev")
+
+  def __init__(self, profiler: 'LoopProfiler', name: str) -> None:
+    self.profiler = profiler
+    self.name = name
+
+  def __enter__(self) -> None:
+    self.prev = self.profiler.current_phase
+    self.profiler.current_phase = self.name
+    self.start = time.monotonic()
+
+  def __exit__(self, *args) -> None:
+    dt = time.monotonic() - self.start
+    self.profiler.current_phase = self.prev
+    self.profiler.phases[self.name].add(dt)
+    self.profiler.iteration_phases[self.name] += dt
+
+
+def _weak_gc_callback(ref: weakref.WeakMethod) -> Callable[[str, dict], None]:
+  def callback(phase: str, info: dict) -> None:
+    method = ref()
+    if method is not None:
+      method(phase, info)
+  return callback
+
+
+def _remove_gc_callback(callback: Callable[[str, dict], None]) -> None:
+  if callback in gc.callbacks:
+    gc.callbacks.remove(callback)
+
+
+class LoopProfiler:
+  """
+  Profiles the iterations of a Ratekeeper loop: a histogram of how long each iteration took, timings of
+  named phases within the iterations, and gc pauses by the phase they interrupted. For iterations that
+  missed their deadline the time spent in each phase is summed, showing which phase caused the misses.
+  The stats are logged every report_interval seconds as a loop_stats event.
+  """
+  def __init__(self, interval: float, name: str, report_interval: float = 10.) -> None:
+    self.interval = interval
+    self.name = name
+    self.report_interval = report_interval
+    self.edges = [b * interval for b in LOOP_BUCKETS]
+
+    self.current_phase: str | None = None
+    self._gc_start = 0.
+    # the hook in gc.callbacks only weakly references the profiler, so it can be collected, which removes the hook like close() does
+    self._gc_hook = _weak_gc_callback(weakref.WeakMethod(self._gc_callback))
+    gc.callbacks.append(self._gc_hook)
+    self._finalizer = weakref.finalize(self, _remove_gc_callback, self._gc_hook)
+
+    self.iteration_start = time.monotonic()
+    self.reset(self.iteration_start)
+
+  def reset(self, cur_time: float) -> None:
+    self.start_time = cur_time
+    self.iterations = Timings(self.edges)
+    self.phases: defaultdict[str, Timings] = defaultdict(lambda: Timings(self.edges))
+    self.gc: defaultdict[str, Timings] = defaultdict(lambda: Timings(self.edges))
+    self.iteration_phases: defaultdict[str, float] = defaultdict(float)
+    self.misses = 0
+    self.miss_phases: defaultdict[str, float] = defaultdict(float)
+
+  def close(self) -> None:
+    self._finalizer()
+
+  def phase(self, name: str) -> _Phase:
+    return _Phase(self, name)
+
+  def _gc_callback(self, phase: str, info: dict) -> None:
+    if phase == "start":
+      self._gc_start = time.monotonic()
+    else:
+      dt = time.monotonic() - self._gc_start
+      self.gc[self.current_phase or "loop"].add(dt)
+      self.iteration_phases["gc"] += dt
+
+  def end_iteration(self, cur_time: float, missed: bool) -> None:
+    self.iterations.add(cur_time - self.iteration_start)
+    if missed:
+      self.misses += 1
+      for name, dt in self.iteration_phases.items():
+        self.miss_phases[name] += dt
+    self.iteration_phases.clear()
+    self.iteration_start = cur_time
+    self.maybe_report(cur_time)
+
+  def summary(self, cur_time: float) -> dict:
+    return {
+      "name": self.name,
+      "duration": cur_time - self.start_time,
+      "interval_ms": 1e3 * self.interval,
+      "buckets": LOOP_BUCKETS,
+      "iterations": self.iterations.summary(),
+      "misses": self.misses,
+      "phases": {name: t.summary() for name, t in self.phases.items()},
+      "gc": {name: t.summary() for name, t in self.gc.items()},
+      "miss_phases_ms": {name: 1e3 * dt for name, dt in self.miss_phases.items()},
+    }
+
+  def maybe_report(self, cur_time: float) -> None:
+    if cur_time - self.start_time >= self.report_interval:
+      from openpilot.common.swaglog import cloudlog
+      cloudlog.event("loop_stats", **self.summary(cur_time))
+      self.reset(cur_time)
+
+
 class Ratekeeper:
-  def __init__(self, rate: float, print_delay_threshold: float | None = 0.0) -> None:
-    """Rate in Hz for ratekeeping. print_delay_threshold must be nonnegative."""
+  def __init__(self, rate: float, print_delay_threshold: float | None = 0.0, profile: bool | None = None) -> None:
+    """Rate in Hz for ratekeeping. print_delay_threshold must be nonnegative.
+    profile enables a LoopProfiler, defaults to the LOOP_PROFILE env var."""
     self._interval = 1. / rate
     self._print_delay_threshold = print_delay_threshold
     self._frame = 0
@@ -60,6 +203,8 @@ class Ratekeeper:
     self.avg_dt = MovingAverage(100)
     self.avg_dt.add_value(self._interval)
 
+    self.profiler = LoopProfiler(self._interval, self._process_name) if (LOOP_PROFILE if profile is None else profile) else None
+
   @property
   def frame(self) -> int:
     return self._frame
@@ -73,11 +218,19 @@ class Ratekeeper:
     expected_dt = self._interval * (1 / 0.9)
     return self.avg_dt.get_average() > expected_dt
 
+  # Times a named part of the loop when profiling, e.g. with rk.phase("publish"): ...
+  def phase(self, name: str) -> _Phase | nullcontext:
+    if self.profiler is None:
+      return _NO_PHASE
+    return self.profiler.phase(name)
+
   # Maintain loop rate by calling this at the end of each loop
   def keep_time(self) -> bool:
     lagged = self.monitor_time()
     if self._remaining > 0:
       time.sleep(self._remaining)
+    if self.profiler is not None:
+      self.profiler.iteration_start = time.monotonic()
     return lagged
 
   # Monitors the cumulative lag, but does not enforce a rate
@@ -98,4 +251,9 @@ class Ratekeeper:
       lagged = True
     self._frame += 1
     self._remaining = remaining
+    if self.profiler is not None:
+      self.profiler.end_iteration(self._last_monitor_time, remaining < 0)
     return lagged
+
+
+_NO_PHASE = nullcontext()
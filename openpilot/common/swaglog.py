@@ -1,15 +1,23 @@
+import atexit
+import copy
 import logging
 import os
+import threading
 import time
 import warnings
+from collections import deque
 from pathlib import Path
 from logging.handlers import BaseRotatingHandler
 
 import zmq
 
-from openpilot.common.logging_extra import SwagLogger, SwagFormatter, SwagLogFileFormatter
+from openpilot.common.logging_extra import SwagLogger, SwagFormatter, SwagLogFileFormatter, NiceOrderedDict
 from openpilot.common.hardware.hw import Paths
 
+# send records from a background thread, see AsyncLogHandler
+SWAGLOG_ASYNC = bool(int(os.getenv("SWAGLOG_ASYNC", "0")))
+SWAGLOG_QUEUE_SIZE = int(os.getenv("SWAGLOG_QUEUE_SIZE", "10000"))
+
 
 def get_file_handler():
   Path(Paths.swaglog_root()).mkdir(parents=True, exist_ok=True)
@@ -60,8 +68,10 @@ class SwaglogRotatingFileHandler(BaseRotatingHandler):
     if self.backup_count > 0:
       while len(self.log_files) > self.backup_count:
         to_delete = self.log_files.pop()
-        if os.path.exists(to_delete): # just being safe, should always exist
+        try:
           os.remove(to_delete)
+        except FileNotFoundError: # just being safe, should always exist
+          pass
 
 class UnixDomainSocketHandler(logging.Handler):
   def __init__(self, formatter):
@@ -104,6 +114,105 @@ class UnixDomainSocketHandler(logging.Handler):
       pass
 
 
+class AsyncLogHandler(logging.Handler):
+  """
+  Formats records when they're logged and queues them for its handlers, which emit them one at a time from a
+  background thread, so logging calls never block on IPC or disk. Records are dropped when max_queue are pending,
+  the number dropped is logged once the queue drains.
+  """
+  def __init__(self, swaglogger, handlers, max_queue=SWAGLOG_QUEUE_SIZE, flush_interval=1.):
+    super().__init__()
+    self.setFormatter(SwagFormatter(swaglogger))
+    self.swaglogger = swaglogger
+    self.handlers = list(handlers)
+    self.max_queue = max_queue
+    self.flush_interval = flush_interval
+
+    self.dropped = 0
+    self.reported_dropped = 0
+    self.pid = None
+    atexit.register(self.flush)
+
+  def _start(self):
+    # deque appends and pops are thread-safe, no lock that a fork could leave held
+    self.queue = deque()
+    self.wakeup = threading.Event()
+    self.busy = False
+    self.thread = threading.Thread(target=self._run, name="swaglog", daemon=True)
+    self.thread.start()
+    self.pid = os.getpid()
+
+  def add_handler(self, handler):
+    self.handlers = self.handlers + [handler]
+
+  def prepare(self, record):
+    # like QueueHandler.prepare, format with the caller's log context and the current values of the dicts
+    # and lists passed to cloudlog.event, which the caller may change before the record is emitted
+    msg = self.format(record)
+    record = copy.copy(record)
+    record.swaglog_formatted = msg
+    record.message = msg
+    record.msg = msg
+    record.args = None
+    record.exc_info = None
+    record.exc_text = None
+    record.stack_info = None
+    return record
+
+  def emit(self, record):
+    if self.pid != os.getpid():
+      # the first records after a fork start the thread once, the handler's lock is reinitialized in the child
+      with self.lock:
+        if self.pid != os.getpid():
+          self._start()
+
+    if len(self.queue) >= self.max_queue:
+      self.dropped += 1
+      return
+
+    self.queue.append(self.prepare(record))
+    if len(self.queue) == 1:
+      self.wakeup.set()
+
+  def _handle(self, record):
+    for handler in self.handlers:
+      if record.levelno >= handler.level:
+        handler.handle(record)
+
+  def _run(self):
+    while True:
+      self.wakeup.wait(self.flush_interval)
+      self.wakeup.clear()
+
+      self.busy = True
+      while len(self.queue):
+        self._handle(self.queue.popleft())
+
+      if self.dropped > self.reported_dropped:
+        msg = NiceOrderedDict(event="swaglog_dropped", count=self.dropped - self.reported_dropped)
+        self.reported_dropped = self.dropped
+        record = self.swaglogger.makeRecord(self.swaglogger.name, logging.WARNING, __file__, 0, msg, (), None)
+        self._handle(self.prepare(record))
+      self.busy = False
+
+  def flush(self, timeout=1.):
+    """Waits up to timeout seconds for the queued records to be emitted"""
+    if self.pid != os.getpid():
+      return
+    self.wakeup.set()
+    deadline = time.monotonic() + timeout
+    while (len(self.queue) or self.busy) and time.monotonic() < deadline:
+      time.sleep(0.001)
+    for handler in self.handlers:
+      handler.flush()
+
+  def close(self):
+    self.flush()
+    for handler in self.handlers:
+      handler.close()
+    super().close()
+
+
 class ForwardingHandler(logging.Handler):
   def __init__(self, target_logger):
     super().__init__()
@@ -120,7 +229,10 @@ def add_file_handler(log):
   """
   handler = get_file_handler()
   handler.setFormatter(SwagLogFileFormatter(log))
-  log.addHandler(handler)
+  if asynchandler is not None:
+    asynchandler.add_handler(handler)
+  else:
+    log.addHandler(handler)
 
 
 cloudlog = log = SwagLogger()
@@ -141,4 +253,9 @@ ipchandler = UnixDomainSocketHandler(SwagFormatter(log))
 
 log.addHandler(outhandler)
 # logs are sent through IPC before writing to disk to prevent disk I/O blocking
-log.addHandler(ipchandler)
+asynchandler = None
+if SWAGLOG_ASYNC:
+  asynchandler = AsyncLogHandler(log, [ipchandler])
+  log.addHandler(asynchandler)
+else:
+  log.addHandler(ipchandler)
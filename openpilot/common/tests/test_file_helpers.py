@@ -1,8 +1,13 @@
 import os
+import shutil
 from uuid import uuid4
 
+import zstandard as zstd
+
+from openpilot.common import utils
 from openpilot.common.test import OpenpilotTestCase
-from openpilot.common.utils import atomic_write
+from openpilot.common.utils import UPLOAD_CACHE_BYTES, UPLOAD_COMPRESSION_LEVEL, CompressionCache, atomic_write, discard_upload_stream, \
+                                   get_upload_stream
 
 
 class TestFileHelpers(OpenpilotTestCase):
@@ -18,3 +23,90 @@ class TestFileHelpers(OpenpilotTestCase):
 
   def test_atomic_write(self):
     self.run_atomic_write_func(atomic_write)
+
+
+class TestUploadStream(OpenpilotTestCase):
+  def setup_method(self):
+    self.path = f"/tmp/tmp{uuid4()}"
+    self.data = os.urandom(1024 * 1024) * 4
+    with open(self.path, "wb") as f:
+      f.write(self.data)
+    self.cache = CompressionCache(f"/tmp/tmp{uuid4()}", UPLOAD_CACHE_BYTES)
+
+  def teardown_method(self):
+    os.remove(self.path)
+    shutil.rmtree(self.cache.root, ignore_errors=True)
+
+  def read_upload_stream(self, compressed=True):
+    stream, size = get_upload_stream(self.path, compressed)
+    with stream:
+      data = stream.read()
+    assert size == len(data)
+    return zstd.ZstdDecompressor().decompressobj().decompress(data) if compressed else data
+
+  def test_uncompressed(self):
+    assert self.read_upload_stream(False) == self.data
+
+  def test_compressed_cache(self, mocker):
+    mocker.patch("openpilot.common.utils.upload_compression_cache", self.cache)
+    compress = mocker.patch("openpilot.common.utils.compress_file", wraps=utils.compress_file)
+    for _ in range(2):
+      assert self.read_upload_stream() == self.data
+    assert compress.call_count == 1
+
+    # a changed file is compressed again
+    with open(self.path, "ab") as f:
+      f.write(b"1")
+    assert self.read_upload_stream() == self.data + b"1"
+    assert compress.call_count == 2
+
+  def test_large_file(self, mocker):
+    # compressed rlogs are often larger than the 16 MiB the cache used to hold
+    self.data = os.urandom(17 * 1024 * 1024)
+    with open(self.path, "wb") as f:
+      f.write(self.data)
+    mocker.patch("openpilot.common.utils.upload_compression_cache", self.cache)
+    compress = mocker.patch("openpilot.common.utils.compress_file", wraps=utils.compress_file)
+    for _ in range(2):
+      assert self.read_upload_stream() == self.data
+    assert compress.call_count == 1
+
+    # the cache is on disk, shared with other processes and kept across restarts
+    stream = CompressionCache(self.cache.root, UPLOAD_CACHE_BYTES).get(CompressionCache.key(self.path, UPLOAD_COMPRESSION_LEVEL))
+    assert stream is not None
+    stream.close()
+
+  def test_cache_eviction(self):
+    def get(key):
+      stream = cache.get(key)
+      if stream is None:
+        return None
+      with stream:
+        return stream.read()
+
+    cache = CompressionCache(self.cache.root, 10)
+    for i in range(4):
+      cache.put((i,), b"1234")
+    assert get((0,)) is None and get((1,)) is None
+    assert get((2,)) == get((3,)) == b"1234"
+    assert cache.size == 8
+
+    # the least recently used entry is evicted
+    get((2,))
+    cache.put((4,), b"1234")
+    assert get((3,)) is None and get((2,)) == b"1234"
+
+    cache.put((5,), b"x" * 11)
+    assert get((5,)) is None
+
+    cache.discard((4,))
+    assert get((4,)) is None
+    assert cache.size == 4
+
+  def test_discard(self, mocker):
+    mocker.patch("openpilot.common.utils.upload_compression_cache", self.cache)
+    compress = mocker.patch("openpilot.common.utils.compress_file", wraps=utils.compress_file)
+    self.read_upload_stream()
+    discard_upload_stream(self.path)
+    self.read_upload_stream()
+    assert compress.call_count == 2
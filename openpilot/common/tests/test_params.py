@@ -144,3 +144,39 @@ class TestParams(OpenpilotTestCase):
     now = datetime.datetime.now(datetime.UTC)
     self.params.put("InstallDate", now, block=True)
     assert self.params.get("InstallDate") == now
+
+  def test_get_many(self):
+    self.params.put("DongleId", "cb38263377b873ee", block=True)
+    self.params.put("BootCount", 1441, block=True)
+    self.params.remove("CarParams")
+    self.params.remove("LanguageSetting")
+
+    keys = ["DongleId", "BootCount", "CarParams", b"LanguageSetting"]
+    assert self.params.get_many(keys) == {k: self.params.get(k) for k in keys}
+    assert self.params.get_many(keys, return_default=True) == {k: self.params.get(k, return_default=True) for k in keys}
+    assert self.params.get_many([]) == {}
+    with self.assertRaises(UnknownKeyName):
+      self.params.get_many(["DongleId", "swag"])
+
+  def test_cache(self):
+    q = Params(cache=True)
+    self.params.put("BootCount", 1, block=True)
+    self.params.put_bool("IsMetric", True, block=True)
+    assert q.get("BootCount") == 1
+    assert q.get_bool("IsMetric")
+
+    # writes from another instance invalidate the cached values
+    self.params.put("BootCount", 2, block=True)
+    self.params.remove("IsMetric")
+    assert q.get("BootCount") == 2
+    assert not q.get_bool("IsMetric")
+
+    Params().put("BootCount", 3)
+    for _ in range(100):
+      if q.get("BootCount") == 3:
+        break
+      time.sleep(0.01)
+    assert q.get("BootCount") == 3
+
+    self.params.clear_all(ParamKeyFlag.PERSISTENT)
+    assert q.get_many(["BootCount", "IsMetric"]) == {"BootCount": None, "IsMetric": None}
@@ -0,0 +1,97 @@
+import gc
+import time
+
+from openpilot.common.test import OpenpilotTestCase
+from openpilot.common.realtime import LOOP_BUCKETS, LoopProfiler, Ratekeeper
+
+INTERVAL = 0.01
+
+
+class TestLoopProfiler(OpenpilotTestCase):
+  def setup_method(self):
+    self.profiler = LoopProfiler(INTERVAL, "test", report_interval=1e9)
+
+  def teardown_method(self):
+    self.profiler.close()
+
+  def test_phases(self):
+    p = self.profiler
+    with p.phase("update"):
+      time.sleep(INTERVAL)
+      # nested and re-entered phases are timed separately
+      with p.phase("publish"):
+        with p.phase("publish"):
+          assert p.current_phase == "publish"
+        time.sleep(INTERVAL)
+      assert p.current_phase == "update"
+    assert p.current_phase is None
+
+    assert p.phases["update"].count == 1
+    assert p.phases["publish"].count == 2
+    assert p.phases["update"].total >= p.phases["publish"].total + INTERVAL
+    assert p.phases["publish"].max >= INTERVAL
+    assert sum(p.phases["update"].hist) == 1
+
+  def test_summary(self):
+    p = self.profiler
+    for missed in (False, True, True):
+      with p.phase("update"):
+        time.sleep(INTERVAL / 2)
+      p.end_iteration(time.monotonic(), missed)
+
+    summary = p.summary(time.monotonic())
+    assert summary["name"] == "test"
+    assert summary["interval_ms"] == 1e3 * INTERVAL
+    assert summary["buckets"] == LOOP_BUCKETS
+    assert summary["iterations"]["count"] == 3
+    assert len(summary["iterations"]["hist"]) == len(LOOP_BUCKETS) + 1
+    assert summary["misses"] == 2
+    assert summary["phases"]["update"]["count"] == 3
+    assert summary["phases"]["update"]["mean_ms"] >= 1e3 * INTERVAL / 2
+    # only the phases of the missed iterations are summed
+    assert 1e3 * INTERVAL <= summary["miss_phases_ms"]["update"] < 1e3 * INTERVAL * 3 / 2 + 5
+
+    p.reset(time.monotonic())
+    assert p.summary(time.monotonic())["iterations"]["count"] == 0
+
+  def test_gc_callback(self):
+    # only count the explicit collections
+    gc.disable()
+    self.addCleanup(gc.enable)
+
+    p = self.profiler
+    with p.phase("update"):
+      gc.collect()
+    gc.collect()
+    assert p.gc["update"].count == 1
+    assert p.gc["loop"].count == 1
+    assert p.iteration_phases["gc"] > 0
+
+    # closing removes the callback
+    p.close()
+    gc.collect()
+    assert p.gc["loop"].count == 1
+
+  def test_gc_callback_collected(self):
+    n_callbacks = len(gc.callbacks)
+    profiler = LoopProfiler(INTERVAL, "collected")
+    assert len(gc.callbacks) == n_callbacks + 1
+    del profiler
+    gc.collect()
+    assert len(gc.callbacks) == n_callbacks
+
+
+class TestRatekeeper(OpenpilotTestCase):
+  def test_profile(self):
+    rk = Ratekeeper(1. / INTERVAL, print_delay_threshold=None, profile=True)
+    for _ in range(3):
+      with rk.phase("update"):
+        pass
+      rk.keep_time()
+    assert rk.profiler.iterations.count == 3
+    assert rk.profiler.phases["update"].count == 3
+
+    rk = Ratekeeper(1. / INTERVAL, print_delay_threshold=None, profile=False)
+    assert rk.profiler is None
+    with rk.phase("update"):
+      pass
@@ -0,0 +1,93 @@
+import json
+import logging
+import threading
+
+from openpilot.common.test import OpenpilotTestCase
+from openpilot.common.logging_extra import SwagLogger, SwagFormatter
+from openpilot.common.swaglog import AsyncLogHandler
+
+
+class ListHandler(logging.Handler):
+  def __init__(self, formatter, block=None):
+    super().__init__()
+    self.setFormatter(formatter)
+    self.block = block
+    self.msgs = []
+
+  def emit(self, record):
+    if self.block is not None:
+      self.block.wait()
+    self.msgs.append(json.loads(self.format(record)))
+
+
+class TestAsyncLogHandler(OpenpilotTestCase):
+  def setup_method(self):
+    self.log = SwagLogger()
+    self.log.setLevel(logging.DEBUG)
+
+  def test_order_and_ctx(self):
+    handler = ListHandler(SwagFormatter(self.log))
+    self.log.addHandler(AsyncLogHandler(self.log, [handler]))
+
+    with self.log.ctx(user="a"):
+      for i in range(500):
+        self.log.info("msg %d", i)
+    self.log.event("done")
+    self.log.handlers[0].flush()
+
+    assert [m["msg"] for m in handler.msgs[:-1]] == [f"msg {i}" for i in range(500)]
+    assert all(m["ctx"] == {"user": "a"} for m in handler.msgs[:-1])
+    assert handler.msgs[-1]["msg"] == {"event": "done"}
+    assert handler.msgs[-1]["ctx"] == {}
+
+  def test_drops(self):
+    block = threading.Event()
+    handler = ListHandler(SwagFormatter(self.log), block)
+    async_handler = AsyncLogHandler(self.log, [handler], max_queue=10)
+    self.log.addHandler(async_handler)
+
+    # logging doesn't block while the handler is stuck
+    n = 100
+    for i in range(n):
+      self.log.info("msg %d", i)
+    assert async_handler.dropped > 0
+
+    block.set()
+    async_handler.flush()
+    assert len(handler.msgs) == n - async_handler.dropped + 1
+    assert handler.msgs[-1]["msg"] == {"event": "swaglog_dropped", "count": async_handler.dropped}
+
+  def test_formatted_when_logged(self):
+    block = threading.Event()
+    handler = ListHandler(SwagFormatter(self.log), block)
+    async_handler = AsyncLogHandler(self.log, [handler])
+    self.log.addHandler(async_handler)
+
+    # changes made after the call aren't logged
+    data = {"values": [1]}
+    self.log.event("changed", data=data)
+    data["values"].append(2)
+    block.set()
+    async_handler.flush()
+    assert handler.msgs[0]["msg"] == {"event": "changed", "data": {"values": [1]}}
+
+  def test_start_once(self, mocker):
+    handler = ListHandler(SwagFormatter(self.log))
+    async_handler = AsyncLogHandler(self.log, [handler])
+    start = mocker.patch.object(AsyncLogHandler, "_start", autospec=True, side_effect=AsyncLogHandler._start)
+
+    # threads logging at the same time, such as the first records after a fork, start the thread once
+    n = 8
+    barrier = threading.Barrier(n)
+    def log(i):
+      barrier.wait()
+      async_handler.emit(self.log.makeRecord(self.log.name, logging.INFO, __file__, 0, "msg %d", (i,), None))
+    threads = [threading.Thread(target=log, args=(i,)) for i in range(n)]
+    for t in threads:
+      t.start()
+    for t in threads:
+      t.join()
+    async_handler.flush()
+
+    assert start.call_count == 1
+    assert sorted(m["msg"] for m in handler.msgs) == sorted(f"msg {i}" for i in range(n))
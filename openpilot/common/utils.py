@@ -9,6 +9,11 @@ from subprocess import Popen, PIPE, TimeoutExpired
 import zstandard as zstd
 
 LOG_COMPRESSION_LEVEL = 10  # little benefit up to level 15. level ~17 is a small step change
+UPLOAD_COMPRESSION_LEVEL = int(os.getenv("UPLOAD_COMPRESSION_LEVEL", str(LOG_COMPRESSION_LEVEL)))
+UPLOAD_COMPRESSION_THREADS = int(os.getenv("UPLOAD_COMPRESSION_THREADS", "2"))  # zstd worker threads, 0 compresses on the calling thread
+# compressed files of failed uploads kept on disk for their retry, by the uploader and athenad. large enough for several rlogs
+UPLOAD_CACHE_ROOT = os.getenv("UPLOAD_CACHE_ROOT", "/tmp/upload_compression_cache" + os.environ.get("OPENPILOT_PREFIX", ""))
+UPLOAD_CACHE_BYTES = int(os.getenv("UPLOAD_CACHE_BYTES", str(256 * 1024 * 1024)))
 
 class Timer:
   """Simple lap timer for profiling sequential operations."""
@@ -79,26 +84,6 @@ class MovingAverage:
     return self.sum / self.count
 
 
-class CallbackReader:
-  """Wraps a file, but overrides the read method to also
-  call a callback function with the number of bytes read so far."""
-
-  def __init__(self, f, callback, *args):
-    self.f = f
-    self.callback = callback
-    self.cb_args = args
-    self.total_read = 0
-
-  def __getattr__(self, attr):
-    return getattr(self.f, attr)
-
-  def read(self, *args, **kwargs):
-    chunk = self.f.read(*args, **kwargs)
-    self.total_read += len(chunk)
-    self.callback(*self.cb_args, self.total_read)
-    return chunk
-
-
 @contextlib.contextmanager
 def atomic_write(path: str, mode: str = 'w', buffering: int = -1, encoding: str | None = None, newline: str | None = None,
                  overwrite: bool = False):
@@ -114,21 +99,108 @@ def atomic_write(path: str, mode: str = 'w', buffering: int = -1, encoding: str
   os.replace(tmp_file_name, path)
 
 
+class CompressionCache:
+  """Least recently used compressed files, stored in root up to max_bytes in total so they're shared between processes
+  and kept across restarts. Keyed by file identity, size, mtime and level, which is enough for log files since they're
+  written once."""
+
+  def __init__(self, root: str, max_bytes: int):
+    self.root = root
+    self.max_bytes = max_bytes
+
+  @staticmethod
+  def key(filepath: str, level: int) -> tuple:
+    st = os.stat(filepath)
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, level)
+
+  def path(self, key: tuple) -> str:
+    return os.path.join(self.root, "_".join(str(k) for k in key) + ".zst")
+
+  @staticmethod
+  def _touch(path: str) -> None:
+    # entries are evicted by mtime, set explicitly since filesystem timestamps can be coarser
+    now = time.time_ns()
+    os.utime(path, ns=(now, now))
+
+  @property
+  def size(self) -> int:
+    return sum(size for _, size, _ in self._entries())
+
+  def _entries(self) -> list[tuple[int, int, str]]:
+    entries = []
+    with contextlib.suppress(FileNotFoundError), os.scandir(self.root) as it:
+      for entry in it:
+        with contextlib.suppress(FileNotFoundError):
+          st = entry.stat()
+          entries.append((st.st_mtime_ns, st.st_size, entry.path))
+    return entries
+
+  def get(self, key: tuple) -> io.BufferedReader | None:
+    try:
+      f = open(self.path(key), "rb")
+    except FileNotFoundError:
+      return None
+    with contextlib.suppress(OSError):
+      self._touch(f.name)
+    return f
+
+  def put(self, key: tuple, data: bytes) -> None:
+    if len(data) > self.max_bytes:
+      return
+    # best effort, other processes may be writing and evicting at the same time
+    with contextlib.suppress(OSError):
+      os.makedirs(self.root, exist_ok=True)
+      path = self.path(key)
+      with atomic_write(path, mode="wb", overwrite=True) as f:
+        f.write(data)
+      self._touch(path)
+
+      entries = sorted(self._entries())
+      size = sum(size for _, size, _ in entries)
+      for _, entry_size, entry_path in entries:
+        if size <= self.max_bytes:
+          break
+        with contextlib.suppress(FileNotFoundError):
+          os.unlink(entry_path)
+        size -= entry_size
+
+  def discard(self, key: tuple) -> None:
+    with contextlib.suppress(FileNotFoundError):
+      os.unlink(self.path(key))
+
+
+upload_compression_cache = CompressionCache(UPLOAD_CACHE_ROOT, UPLOAD_CACHE_BYTES)
+
+
+def compress_file(filepath: str, level: int = UPLOAD_COMPRESSION_LEVEL, threads: int = UPLOAD_COMPRESSION_THREADS) -> bytes:
+  """zstd compresses a file, streaming it through threads worker threads"""
+  compressed_stream = io.BytesIO()
+  compressor = zstd.ZstdCompressor(level=level, threads=threads)
+  with open(filepath, "rb") as f:
+    compressor.copy_stream(f, compressed_stream, size=os.fstat(f.fileno()).st_size)
+  return compressed_stream.getvalue()
+
+
 def get_upload_stream(filepath: str, should_compress: bool) -> tuple[io.BufferedIOBase, int]:
   if not should_compress:
     file_size = os.path.getsize(filepath)
     file_stream = open(filepath, "rb")
     return file_stream, file_size
 
-  # Compress the file on the fly
-  compressed_stream = io.BytesIO()
-  compressor = zstd.ZstdCompressor(level=LOG_COMPRESSION_LEVEL)
+  # Compress the file on the fly, reusing the output of a previous attempt
+  key = CompressionCache.key(filepath, UPLOAD_COMPRESSION_LEVEL)
+  cached = upload_compression_cache.get(key)
+  if cached is not None:
+    return cached, os.fstat(cached.fileno()).st_size
+  data = compress_file(filepath)
+  upload_compression_cache.put(key, data)
+  return io.BytesIO(data), len(data)
 
-  with open(filepath, "rb") as f:
-    compressor.copy_stream(f, compressed_stream)
-    compressed_size = compressed_stream.tell()
-    compressed_stream.seek(0)
-    return compressed_stream, compressed_size
+
+def discard_upload_stream(filepath: str) -> None:
+  """Drops the compressed stream of filepath from the cache, once its upload succeeded"""
+  with contextlib.suppress(OSError):
+    upload_compression_cache.discard(CompressionCache.key(filepath, UPLOAD_COMPRESSION_LEVEL))
 
 
 # remove all keys that end in DEPRECATED, plus any "deprecated" group
@@ -240,14 +240,17 @@ class Car:
       self.CC_prev = CC
 
   def step(self):
-    CS, RD = self.state_update()
+    with self.rk.phase("update"):
+      CS, RD = self.state_update()
 
-    self.state_publish(CS, RD)
+    with self.rk.phase("publish"):
+      self.state_publish(CS, RD)
 
     initialized = (not any(e.name == EventName.selfdriveInitializing for e in self.sm['onroadEvents']) and
                    self.sm.seen['onroadEvents'])
     if not self.CP.passive and initialized:
-      self.controls_update(CS, self.sm['carControl'])
+      with self.rk.phase("control"):
+        self.controls_update(CS, self.sm['carControl'])
 
     self.initialized_prev = initialized
     self.CS_prev = CS
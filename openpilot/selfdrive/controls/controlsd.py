@@ -227,9 +227,12 @@ class Controls:
   def run(self):
     rk = Ratekeeper(100, print_delay_threshold=None)
     while True:
-      self.update()
-      CC, lac_log = self.state_control()
-      self.publish(CC, lac_log)
+      with rk.phase("update"):
+        self.update()
+      with rk.phase("control"):
+        CC, lac_log = self.state_control()
+      with rk.phase("publish"):
+        self.publish(CC, lac_log)
       rk.monitor_time()
 
 
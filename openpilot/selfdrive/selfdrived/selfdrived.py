@@ -553,12 +553,14 @@ class SelfdriveD:
     self.CS_prev = CS
 
   def params_thread(self, evt):
+    params = Params(cache=True)
     while not evt.is_set():
-      self.is_metric = self.params.get_bool("IsMetric")
-      self.is_ldw_enabled = self.params.get_bool("IsLdwEnabled")
-      self.disengage_on_accelerator = self.params.get_bool("DisengageOnAccelerator")
-      self.experimental_mode = self.params.get_bool("ExperimentalMode") and self.CP.openpilotLongitudinalControl
-      self.personality = self.params.get("LongitudinalPersonality", return_default=True)
+      p = params.get_many(["IsMetric", "IsLdwEnabled", "DisengageOnAccelerator", "ExperimentalMode"])
+      self.is_metric = bool(p["IsMetric"])
+      self.is_ldw_enabled = bool(p["IsLdwEnabled"])
+      self.disengage_on_accelerator = bool(p["DisengageOnAccelerator"])
+      self.experimental_mode = bool(p["ExperimentalMode"]) and self.CP.openpilotLongitudinalControl
+      self.personality = params.get("LongitudinalPersonality", return_default=True)
       time.sleep(0.1)
 
   def run(self):
@@ -41,8 +41,7 @@ def collect_logs(services, duration):
   logs = []
   start = time.monotonic()
   while time.monotonic() - start < duration:
-    for s in socks:
-      logs.extend(messaging.drain_sock(s))
+    logs.extend(messaging.drain_many(socks))
   return logs
 
 
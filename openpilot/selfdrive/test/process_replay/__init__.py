@@ -1,2 +1,3 @@
 from openpilot.selfdrive.test.process_replay.process_replay import CONFIGS, get_process_config, get_custom_params_from_lr, \
-                                                                  replay_process, replay_process_with_name  # noqa: F401
+                                                                  replay_process, replay_process_with_name, \
+                                                                  replay_process_parallel  # noqa: F401
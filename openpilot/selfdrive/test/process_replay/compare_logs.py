@@ -2,44 +2,138 @@
 import sys
 import math
 import capnp
+import struct
 import numbers
+import concurrent.futures
 from collections import Counter
+from typing import Any
 
-from openpilot.tools.lib.logreader import LogReader
+from openpilot.cereal import log
+
+from openpilot.tools.lib.logreader import CachedEventReader, LogReader
 
 EPSILON = sys.float_info.epsilon
+NO_TRAVERSAL_LIMIT = 2**64-1
 
 _DynamicStructReader = capnp.lib.capnp._DynamicStructReader
 _DynamicListReader = capnp.lib.capnp._DynamicListReader
 _DynamicEnum = capnp.lib.capnp._DynamicEnum
 
+# bits of the primitive field types, which can be masked out of a serialized message
+FIELD_BITS = {'bool': 1, 'int8': 8, 'uint8': 8, 'int16': 16, 'uint16': 16, 'enum': 16, 'int32': 32, 'uint32': 32, 'float32': 32,
+              'int64': 64, 'uint64': 64, 'float64': 64}
+NO_DISCRIMINANT = 0xffff
+
+
+def _zero_value(v):
+  if isinstance(v, bool):
+    return False
+  elif isinstance(v, numbers.Number):
+    return 0
+  elif isinstance(v, (list, capnp.lib.capnp._DynamicListBuilder, _DynamicListReader)):
+    return []
+  raise NotImplementedError(f"Unknown type: {type(v)}")
+
+
+def _event_field_masks(names: list[str]) -> list[tuple[int, int]] | None:
+  """(byte, mask of the bits to keep) clearing the named Event fields from its data section, None unless they're all primitives"""
+  masks: dict[int, int] = {}
+  for name in names:
+    field = log.Event.schema.fields.get(name)
+    if field is None or field.proto.which() != 'slot' or field.proto.discriminantValue != NO_DISCRIMINANT:
+      return None
+    bits = FIELD_BITS.get(field.proto.slot.type.which())
+    if bits is None:
+      return None
+    start = field.proto.slot.offset * bits
+    clear = 0xff if bits >= 8 else ((1 << bits) - 1) << (start % 8)
+    for byte in range(start // 8, (start + bits - 1) // 8 + 1):
+      masks[byte] = masks.get(byte, 0xff) & ~clear & 0xff
+  return sorted(masks.items())
+
+
+def _serialized(msg) -> bytes | memoryview:
+  # messages read from a log are a view of it, others are copied like save_log does so equal messages are laid out the same
+  if isinstance(msg, CachedEventReader):
+    return msg.as_bytes()
+  return msg.as_builder().to_bytes()
+
+
+def _masked(dat: bytes | memoryview, masks: list[tuple[int, int]]) -> bytearray | None:
+  """Copy of a serialized message with masks applied to its root struct's data section, None if the root isn't a struct in the first segment"""
+  # https://capnproto.org/encoding.html#serialization-over-a-stream
+  root = (4 * (struct.unpack_from('<I', dat)[0] + 2) + 7) & ~7
+  pointer = struct.unpack_from('<Q', dat, root)[0]
+  if pointer & 3:
+    return None
+  offset = (pointer & 0xffffffff) >> 2
+  if offset >= 1 << 29:
+    offset -= 1 << 30
+  data_start = root + 8 * (offset + 1)
+  data_size = 8 * ((pointer >> 32) & 0xffff)
+
+  masked = bytearray(dat)
+  for byte, keep in masks:
+    if byte < data_size:
+      masked[data_start + byte] &= keep
+  return masked
+
+
+class IgnoredFields:
+  def __init__(self, ignore):
+    """Dotted ignore paths split and grouped by message type once, with their zero values cached per message type"""
+    self._common: list[list[str]] = []
+    self._by_type: dict[str, list[list[str]]] = {}
+    for key in ignore:
+      keys = key.split(".")
+      if len(keys) > 1:
+        self._by_type.setdefault(keys[0], []).append(keys)
+      else:
+        self._common.append(keys)
+    self._paths: dict[str, list[tuple[list[str], Any]]] = {}
+    # top level fields like logMonoTime can be masked in the serialized messages, without zeroing them in a copy
+    self._masks = _event_field_masks([keys[0] for keys in self._common])
+
+  def equal_masked(self, msg1, msg2, typ: str) -> bool:
+    """
+    Whether msg1 and msg2 serialize the same with the ignored fields masked, for types with only top level ones.
+    Messages read from logs aren't copied. False doesn't mean they differ, equal messages can be laid out differently.
+    """
+    if self._masks is None or typ in self._by_type:
+      return False
+    dat1 = _masked(_serialized(msg1), self._masks)
+    return dat1 is not None and dat1 == _masked(_serialized(msg2), self._masks)
+
+  def _compile(self, msg, typ: str) -> list[tuple[list[str], Any]]:
+    paths = []
+    for keys in self._common + self._by_type.get(typ, []):
+      attr = msg
+      for k in keys[:-1]:
+        attr = attr[int(k)] if k.isdigit() else getattr(attr, k)
+      paths.append((keys, _zero_value(getattr(attr, keys[-1]))))
+    self._paths[typ] = paths
+    return paths
+
+  def remove(self, msg, typ: str | None = None):
+    """Returns a builder copy of msg with the ignored fields of its type zeroed"""
+    typ = msg.which() if typ is None else typ
+    paths = self._paths.get(typ)
+    if paths is None:
+      paths = self._compile(msg, typ)
+
+    # copy into one segment of the right size, the small default first segment splits large messages into many
+    msg = msg.as_builder(num_first_segment_words=msg.total_size.word_count + 1)
+    for keys, val in paths:
+      attr = msg
+      for k in keys[:-1]:
+        # indexing into list
+        attr = attr[int(k)] if k.isdigit() else getattr(attr, k)
+      setattr(attr, keys[-1], val)
+    return msg
 
-def remove_ignored_fields(msg, ignore):
-  msg = msg.as_builder()
-  for key in ignore:
-    attr = msg
-    keys = key.split(".")
-    if msg.which() != keys[0] and len(keys) > 1:
-      continue
 
-    for k in keys[:-1]:
-      # indexing into list
-      if k.isdigit():
-        attr = attr[int(k)]
-      else:
-        attr = getattr(attr, k)
-
-    v = getattr(attr, keys[-1])
-    if isinstance(v, bool):
-      val = False
-    elif isinstance(v, numbers.Number):
-      val = 0
-    elif isinstance(v, (list, capnp.lib.capnp._DynamicListBuilder)):
-      val = []
-    else:
-      raise NotImplementedError(f"Unknown type: {type(v)}")
-    setattr(attr, keys[-1], val)
-  return msg
+def remove_ignored_fields(msg, ignore):
+  return IgnoredFields(ignore).remove(msg)
 
 
 def _diff_capnp(r1, r2, path, tolerance):
@@ -97,34 +191,63 @@ def _diff_capnp_values(v1, v2, path, tolerance):
       yield 'change', '.'.join(path), (v1, v2)
 
 
-def compare_logs(log1, log2, ignore_fields=None, ignore_msgs=None, tolerance=None,):
+def _diff_serialized(args):
+  dat1, dat2, tolerance = args
+  with log.Event.from_bytes(dat1, traversal_limit_in_words=NO_TRAVERSAL_LIMIT) as r1, \
+       log.Event.from_bytes(dat2, traversal_limit_in_words=NO_TRAVERSAL_LIMIT) as r2:
+    return list(_diff_capnp(r1, r2, (), tolerance))
+
+
+def compare_logs(log1, log2, ignore_fields=None, ignore_msgs=None, tolerance=None, num_workers=1):
+  """
+  Compares aligned logs with the ignored fields zeroed. Messages that serialize identically are skipped,
+  the rest are diffed field by field, in num_workers processes if it's more than one.
+  """
   if ignore_fields is None:
     ignore_fields = []
   if ignore_msgs is None:
     ignore_msgs = []
   tolerance = EPSILON if tolerance is None else tolerance
 
+  # which() goes through capnp, call it once per message
   log1, log2 = (
-    [m for m in log if m.which() not in ignore_msgs]
+    [(m.which(), m) for m in log]
     for log in (log1, log2)
   )
+  if ignore_msgs:
+    log1, log2 = (
+      [(typ, m) for typ, m in log if typ not in ignore_msgs]
+      for log in (log1, log2)
+    )
 
   if len(log1) != len(log2):
-    cnt1 = Counter(m.which() for m in log1)
-    cnt2 = Counter(m.which() for m in log2)
+    cnt1 = Counter(typ for typ, _ in log1)
+    cnt2 = Counter(typ for typ, _ in log2)
     raise Exception(f"logs are not same length: {len(log1)} VS {len(log2)}\n\t\t{cnt1}\n\t\t{cnt2}")
 
-  diff = []
-  for msg1, msg2 in zip(log1, log2, strict=True):
-    if msg1.which() != msg2.which():
+  ignored = IgnoredFields(ignore_fields)
+  mismatched = []
+  for (typ, msg1), (typ2, msg2) in zip(log1, log2, strict=True):
+    if typ != typ2:
       raise Exception("msgs not aligned between logs")
 
-    msg1 = remove_ignored_fields(msg1, ignore_fields)
-    msg2 = remove_ignored_fields(msg2, ignore_fields)
+    # most messages are identical, settled without copying them when they were read from logs
+    if ignored.equal_masked(msg1, msg2, typ):
+      continue
+    dat1 = ignored.remove(msg1, typ).to_bytes()
+    dat2 = ignored.remove(msg2, typ).to_bytes()
+    # only walk the ones that still differ with the ignored fields zeroed
+    if dat1 != dat2:
+      mismatched.append((dat1, dat2, tolerance))
 
-    if msg1.to_bytes() != msg2.to_bytes():
-      dd = list(_diff_capnp(msg1.as_reader(), msg2.as_reader(), (), tolerance))
-      diff.extend(dd)
+  diff = []
+  if num_workers > 1 and len(mismatched) > 1:
+    with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers) as pool:
+      for dd in pool.map(_diff_serialized, mismatched, chunksize=max(1, len(mismatched) // (4 * num_workers))):
+        diff.extend(dd)
+  else:
+    for args in mismatched:
+      diff.extend(_diff_serialized(args))
   return diff
 
 
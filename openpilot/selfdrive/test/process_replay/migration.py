@@ -1,8 +1,9 @@
 from collections import defaultdict
-from collections.abc import Callable
-from typing import cast
+from collections.abc import Callable, Container, Iterator
+from typing import Any, cast
 import capnp
 import functools
+import heapq
 import traceback
 
 from openpilot.cereal import messaging, log
@@ -23,14 +24,22 @@ MessageWithIndex = tuple[int, capnp.lib.capnp._DynamicStructReader]
 MigrationOps = tuple[list[tuple[int, capnp.lib.capnp._DynamicStructReader]], list[capnp.lib.capnp._DynamicStructReader], list[int]]
 MigrationFunc = Callable[[list[MessageWithIndex]], MigrationOps]
 
+# seconds of log migrate_stream holds in memory and migrates at once
+MIGRATION_WINDOW = 60.
+
 
 # rules for migration functions
 # 1. must use the decorator @migration(inputs=[...], product="...") and MigrationFunc signature
 # 2. it only gets the messages that are in the inputs list
-# 3. product is the message type created by the migration function, and the function will be skipped if product type already exists in lr
+# 3. product is the message type created by the migration function, and the function will be skipped if product type already exists in lr,
+#    as it is if any of the skip_if types exist in lr
 # 4. it must return a list of operations to be applied to the logreader (replace, add, delete)
 # 5. all migration functions must be independent of each other
-def migrate_all(lr: LogIterable, manager_states: bool = False, panda_states: bool = False, camera_states: bool = False):
+# 6. conditions on the whole log go in requires=, a check every input message must pass for the function to run, not in the function
+# 7. inputs it reads from anywhere in the log, e.g. initData, go in context=. migrate_stream also passes their first message in the log
+#    and the latest one before the window. ops on those are dropped
+# 8. functions that need all of their inputs at once (whole_log=True) can't be used with migrate_stream
+def get_migrations(manager_states: bool = False, panda_states: bool = False, camera_states: bool = False) -> list[MigrationFunc]:
   migrations = [
     migrate_sensorEvents,
     migrate_carParams,
@@ -51,11 +60,45 @@ def migrate_all(lr: LogIterable, manager_states: bool = False, panda_states: boo
   if manager_states:
     migrations.append(migrate_managerState)
   if panda_states:
-    migrations.extend([migrate_pandaStates, migrate_peripheralState])
+    migrations.extend([migrate_pandaStates, migrate_peripheralState, migrate_peripheralStateDEPRECATED])
   if camera_states:
     migrations.append(migrate_cameraStates)
+  return migrations
+
+
+def migrate_all(lr: LogIterable, manager_states: bool = False, panda_states: bool = False, camera_states: bool = False):
+  return migrate(lr, get_migrations(manager_states, panda_states, camera_states))
+
+
+def migrate_all_stream(lr: LogIterable, manager_states: bool = False, panda_states: bool = False,
+                       window: float = MIGRATION_WINDOW) -> Iterator[capnp.lib.capnp._DynamicStructReader]:
+  return migrate_stream(lr, get_migrations(manager_states, panda_states), window)
+
+
+def _is_skipped(migration: MigrationFunc, types: Container[str], failed: Container[MigrationFunc]) -> bool:
+  assert hasattr(migration, "inputs") and hasattr(migration, "product"), "Migration functions must use @migration decorator"
+  return migration.product in types or any(t in types for t in migration.skip_if) or migration in failed
+
+
+def _apply_migrations(lr: list, grouped: dict[str, list[int]], migration_funcs: list[MigrationFunc], types: Container[str],
+                      failed: Container[MigrationFunc], offset: int = 0, context: dict[str, list[tuple[int, Any]]] | None = None):
+  """Returns the replace, add and delete ops of the migrations on lr, with the add ops as (migration index, message).
+  Messages in context are (position in the log, message) outside of lr, whose position in the log starts at offset."""
+  replace_ops, add_ops, del_ops = [], [], []
+  for n, migration in enumerate(migration_funcs):
+    if _is_skipped(migration, types, failed):
+      continue
 
-  return migrate(lr, migrations)
+    inputs = cast(list[str], migration.inputs)
+    msg_gen = [(offset + i, i, lr[i]) for typ in inputs for i in grouped.get(typ, [])]
+    if context is not None:
+      msg_gen += [(pos, -1, msg) for typ in migration.context for pos, msg in context.get(typ, [])]
+    msg_gen.sort(key=lambda x: x[0])
+    r_ops, a_ops, d_ops = migration([(i, msg) for _, i, msg in msg_gen])
+    replace_ops.extend(op for op in r_ops if op[0] >= 0)
+    add_ops.extend((n, msg) for msg in a_ops)
+    del_ops.extend(i for i in d_ops if i >= 0)
+  return replace_ops, add_ops, del_ops
 
 
 def migrate(lr: LogIterable, migration_funcs: list[MigrationFunc]):
@@ -64,41 +107,119 @@ def migrate(lr: LogIterable, migration_funcs: list[MigrationFunc]):
   for i, msg in enumerate(lr):
     grouped[msg.which()].append(i)
 
-  replace_ops, add_ops, del_ops = [], [], []
-  for migration in migration_funcs:
-    assert hasattr(migration, "inputs") and hasattr(migration, "product"), "Migration functions must use @migration decorator"
-    if migration.product in grouped: # skip if product already exists
-      continue
-
-    sorted_indices = sorted(ii for i in cast(list[str], migration.inputs) for ii in grouped.get(i, []))
-    msg_gen = [(i, lr[i]) for i in sorted_indices]
-    r_ops, a_ops, d_ops = migration(msg_gen)
-    replace_ops.extend(r_ops)
-    add_ops.extend(a_ops)
-    del_ops.extend(d_ops)
+  failed = {m for m in migration_funcs if m.requires is not None and
+            not all(m.requires(lr[i]) for typ in cast(list[str], m.inputs) for i in grouped.get(typ, []))}
+  replace_ops, add_ops, del_ops = _apply_migrations(lr, grouped, migration_funcs, grouped, failed)
 
   for index, msg in replace_ops:
     lr[index] = msg
   for index in sorted(del_ops, reverse=True):
     del lr[index]
-  for msg in add_ops:
+  for _, msg in add_ops:
     lr.append(msg)
   lr = sorted(lr, key=lambda x: x.logMonoTime)
 
   return lr
 
 
+def _windows(lr: LogIterable, window: float) -> Iterator[list[capnp.lib.capnp._DynamicStructReader]]:
+  msgs: list[capnp.lib.capnp._DynamicStructReader] = []
+  for msg in lr:
+    if len(msgs) and msg.logMonoTime - msgs[0].logMonoTime >= window * 1e9:
+      yield msgs
+      msgs = []
+    msgs.append(msg)
+  if len(msgs):
+    yield msgs
+
+
+def migrate_stream(lr: LogIterable, migration_funcs: list[MigrationFunc],
+                   window: float = MIGRATION_WINDOW) -> Iterator[capnp.lib.capnp._DynamicStructReader]:
+  """
+  Streaming version of migrate, with the same output. lr is read twice, so it must be re-iterable, e.g. a LogReader.
+  A first pass evaluates the whole log conditions (types present, requires=, first context messages and the
+  earliest logMonoTime after each window). The second applies the migrations to consecutive windows of window
+  seconds, holding one window and the messages that can't be ordered yet in memory.
+  """
+  if iter(lr) is lr:
+    raise TypeError("migrate_stream reads lr twice, it can't be an iterator")
+  whole_log = [m.__name__ for m in migration_funcs if m.whole_log]
+  if whole_log:
+    raise ValueError(f"migrations need the whole log: {whole_log}")
+
+  context_types = {typ for m in migration_funcs for typ in m.context}
+  types: set[str] = set()
+  failed: set[MigrationFunc] = set()
+  first_context: dict[str, tuple[int, capnp.lib.capnp._DynamicStructReader]] = {}
+  window_min_times: list[int] = []
+  pos = 0
+  for msgs in _windows(lr, window):
+    for msg in msgs:
+      typ = msg.which()
+      types.add(typ)
+      for m in migration_funcs:
+        if m.requires is not None and m not in failed and typ in m.inputs and not m.requires(msg):
+          failed.add(m)
+      if typ in context_types and typ not in first_context:
+        first_context[typ] = (pos, msg)
+      pos += 1
+    window_min_times.append(min(msg.logMonoTime for msg in msgs))
+  # earliest logMonoTime after each window, messages before it can be output
+  later_min_times: list[int | None] = [None] * len(window_min_times)
+  for i in range(len(window_min_times) - 2, -1, -1):
+    later = later_min_times[i + 1]
+    later_min_times[i] = window_min_times[i + 1] if later is None else min(window_min_times[i + 1], later)
+
+  latest_context: dict[str, tuple[int, capnp.lib.capnp._DynamicStructReader]] = {}
+  # (logMonoTime, kept before added, position or (migration, window, index), message), the order of migrate's stable sort
+  pending: list[tuple] = []
+  offset = 0
+  for w, msgs in enumerate(_windows(lr, window)):
+    grouped = defaultdict(list)
+    for i, msg in enumerate(msgs):
+      grouped[msg.which()].append(i)
+
+    context: dict[str, list[tuple[int, Any]]] = defaultdict(list)
+    for typ in context_types:
+      for ctx in (first_context.get(typ), latest_context.get(typ)):
+        if ctx is not None and not (offset <= ctx[0] < offset + len(msgs)) and ctx not in context[typ]:
+          context[typ].append(ctx)
+
+    replace_ops, add_ops, del_ops = _apply_migrations(msgs, grouped, migration_funcs, types, failed, offset, context)
+    for typ in context_types:
+      if typ in grouped:
+        latest_context[typ] = (offset + grouped[typ][-1], msgs[grouped[typ][-1]])
+
+    for index, msg in replace_ops:
+      msgs[index] = msg
+    deleted = set(del_ops)
+    for i, msg in enumerate(msgs):
+      if i not in deleted:
+        heapq.heappush(pending, (msg.logMonoTime, 0, offset + i, msg))
+    for i, (n, msg) in enumerate(add_ops):
+      heapq.heappush(pending, (msg.logMonoTime, 1, (n, w, i), msg))
+    offset += len(msgs)
+
+    while len(pending) and (later_min_times[w] is None or pending[0][0] < later_min_times[w]):
+      yield heapq.heappop(pending)[3]
+
+
 def as_reader(builder) -> capnp.lib.capnp._DynamicStructReader:
   return log.Event.from_bytes(builder.to_bytes()).__enter__()  # round-trip through bytes, 2x faster and 30x less memory than builder.as_reader()
 
 
-def migration(inputs: list[str], product: str|None=None):
+def migration(inputs: list[str], product: str|None=None, skip_if: list[str]|None=None, requires: Callable|None=None,
+              context: list[str]|None=None, whole_log: bool=False):
   def decorator(func):
     @functools.wraps(func)
     def wrapper(*args, **kwargs):
       return func(*args, **kwargs)
     wrapper.inputs = inputs
     wrapper.product = product
+    wrapper.skip_if = skip_if or []
+    wrapper.requires = requires
+    wrapper.context = context or []
+    wrapper.whole_log = whole_log
     return wrapper
   return decorator
 
@@ -114,13 +235,13 @@ def migrate_onroad_event(event: capnp.lib.capnp._DynamicStructReader):
     raise
 
 
-@migration(inputs=["longitudinalPlan", "carParams"])
+@migration(inputs=["longitudinalPlan", "carParams"], context=["carParams"],
+           requires=lambda msg: msg.which() != 'longitudinalPlan' or msg.longitudinalPlan.aTarget == 0.0)
 def migrate_longitudinalPlan(msgs):
   ops = []
 
-  needs_migration = all(msg.longitudinalPlan.aTarget == 0.0 for _, msg in msgs if msg.which() == 'longitudinalPlan')
   CP = next((m.carParams for _, m in msgs if m.which() == 'carParams'), None)
-  if not needs_migration or CP is None:
+  if CP is None:
     return [], [], []
 
   for index, msg in msgs:
@@ -202,13 +323,9 @@ def migrate_liveLocationKalman(msgs):
   return ops, [], []
 
 
-@migration(inputs=["livePose"])
+@migration(inputs=["livePose"], requires=lambda msg: msg.livePose.timestamp == 0)
 def migrate_livePose(msgs):
   ops = []
-  needs_migration = all(msg.livePose.timestamp == 0 for _, msg in msgs if msg.which() == 'livePose')
-  if not needs_migration:
-    return [], [], []
-
   for index, msg in msgs:
     if msg.which() == "livePose":
       new_msg = msg.as_builder()
@@ -233,7 +350,7 @@ def migrate_controlsState(msgs):
   return [], add_ops, []
 
 
-@migration(inputs=["carState", "controlsState"])
+@migration(inputs=["carState", "controlsState"], context=["controlsState"])
 def migrate_carState(msgs):
   ops = []
   last_cs = None
@@ -272,7 +389,7 @@ def migrate_gpsLocation(msgs):
   return ops, [], []
 
 
-@migration(inputs=["deviceState", "initData"])
+@migration(inputs=["deviceState", "initData"], context=["initData"])
 def migrate_deviceState(msgs):
   init_data = next((m.initData for _, m in msgs if m.which() == 'initData'), None)
   device_state = next((m.deviceState for _, m in msgs if m.which() == 'deviceState'), None)
@@ -300,7 +417,7 @@ def migrate_carOutput(msgs):
   return [], add_ops, []
 
 
-@migration(inputs=["pandaStates", "pandaStateDEPRECATED", "carParams"])
+@migration(inputs=["pandaStates", "pandaStateDEPRECATED", "carParams"], context=["carParams"])
 def migrate_pandaStates(msgs):
   # TODO: safety param migration should be handled automatically
   safety_param_migration = {
@@ -344,14 +461,10 @@ def migrate_pandaStates(msgs):
   return ops, [], []
 
 
-@migration(inputs=["pandaStates", "pandaStateDEPRECATED"], product="peripheralState")
+@migration(inputs=["pandaStates"], product="peripheralState")
 def migrate_peripheralState(msgs):
   add_ops = []
-
-  which = "pandaStates" if any(msg.which() == "pandaStates" for _, msg in msgs) else "pandaStateDEPRECATED"
   for _, msg in msgs:
-    if msg.which() != which:
-      continue
     new_msg = messaging.new_message("peripheralState")
     new_msg.valid = msg.valid
     new_msg.logMonoTime = msg.logMonoTime
@@ -359,7 +472,13 @@ def migrate_peripheralState(msgs):
   return [], add_ops, []
 
 
-@migration(inputs=["roadEncodeIdx", "wideRoadEncodeIdx", "driverEncodeIdx", "roadCameraState", "wideRoadCameraState", "driverCameraState"])
+@migration(inputs=["pandaStateDEPRECATED"], product="peripheralState", skip_if=["pandaStates"])
+def migrate_peripheralStateDEPRECATED(msgs):
+  return migrate_peripheralState(msgs)
+
+
+@migration(inputs=["roadEncodeIdx", "wideRoadEncodeIdx", "driverEncodeIdx", "roadCameraState", "wideRoadCameraState", "driverCameraState"],
+           whole_log=True)
 def migrate_cameraStates(msgs):
   add_ops, del_ops = [], []
   frame_to_encode_id = defaultdict(dict)
@@ -4,6 +4,7 @@ import time
 import copy
 import heapq
 import signal
+import concurrent.futures
 import numpy as np
 from collections import Counter
 from dataclasses import dataclass, field
@@ -36,6 +37,8 @@ from openpilot.tools.lib.framereader import FrameReader
 NUMPY_TOLERANCE = 1e-2
 PROC_REPLAY_DIR = os.path.dirname(os.path.abspath(__file__))
 FAKEDATA = os.path.join(PROC_REPLAY_DIR, "fakedata/")
+# the latest of these before a shard are replayed with it, processes are set up from them
+SHARD_CONTEXT_MSGS = ("initData", "carParams")
 
 
 class LauncherWithCapture:
@@ -653,10 +656,7 @@ def replay_process(
   return log_msgs
 
 
-def _replay_multi_process(
-  cfgs: list[ProcessConfig], lr: LogIterable, frs: dict[str, FrameReader] | None, fingerprint: str | None,
-  custom_params: dict[str, Any] | None, captured_output_store: dict[str, dict[str, str]] | None, disable_progress: bool
-) -> list[capnp._DynamicStructReader]:
+def generate_replay_configs(lr: LogIterable, fingerprint: str | None, custom_params: dict[str, Any] | None) -> tuple[dict[str, Any], dict[str, Any]]:
   if fingerprint is not None:
     params_config = generate_params_config(lr=lr, fingerprint=fingerprint, custom_params=custom_params)
     env_config = generate_environ_config(fingerprint=fingerprint)
@@ -664,6 +664,17 @@ def _replay_multi_process(
     CP = next((m.carParams for m in lr if m.which() == "carParams"), None)
     params_config = generate_params_config(lr=lr, CP=CP, custom_params=custom_params)
     env_config = generate_environ_config(CP=CP)
+  return params_config, env_config
+
+
+def _replay_multi_process(
+  cfgs: list[ProcessConfig], lr: LogIterable, frs: dict[str, FrameReader] | None, fingerprint: str | None,
+  custom_params: dict[str, Any] | None, captured_output_store: dict[str, dict[str, str]] | None, disable_progress: bool,
+  replay_configs: tuple[dict[str, Any], dict[str, Any]] | None = None
+) -> list[capnp._DynamicStructReader]:
+  if replay_configs is None:
+    replay_configs = generate_replay_configs(lr, fingerprint, custom_params)
+  params_config, env_config = replay_configs
 
   # validate frs and vision pubs
   all_vision_pubs = [pub for cfg in cfgs for pub in cfg.vision_pubs]
@@ -728,6 +739,117 @@ def _replay_multi_process(
   return log_msgs
 
 
+def get_independent_process_groups(cfgs: list[ProcessConfig]) -> list[list[ProcessConfig]]:
+  """Groups cfgs so that no process subscribes to the outputs of another group, each group can be replayed on its own"""
+  group = list(range(len(cfgs)))
+
+  def find(i: int) -> int:
+    while group[i] != i:
+      group[i] = group[group[i]]
+      i = group[i]
+    return i
+
+  for i, a in enumerate(cfgs):
+    for j, b in enumerate(cfgs):
+      if set(a.subs) & set(b.pubs):
+        group[find(i)] = find(j)
+
+  groups: dict[int, list[ProcessConfig]] = {}
+  for i, cfg in enumerate(cfgs):
+    groups.setdefault(find(i), []).append(cfg)
+  return list(groups.values())
+
+
+def get_replay_shards(msgs: list[capnp._DynamicStructReader], shard_duration: float | None,
+                      warmup: float) -> list[tuple[list[int], int | None, int | None]]:
+  """
+  Splits time sorted msgs into windows of shard_duration seconds. Returns the indices of the messages to replay
+  for each window, starting warmup seconds early so process state can converge, and the [start, end) logMonoTime
+  range of the outputs it keeps. The latest SHARD_CONTEXT_MSGS before a window are replayed with it.
+  """
+  if shard_duration is None or len(msgs) == 0:
+    return [(list(range(len(msgs))), None, None)]
+
+  mono_times = np.array([m.logMonoTime for m in msgs], dtype=np.uint64)
+  context_idxs = {typ: np.array([i for i, m in enumerate(msgs) if m.which() == typ], dtype=np.int64) for typ in SHARD_CONTEXT_MSGS}
+  boundaries = list(range(int(mono_times[0]), int(mono_times[-1]) + 1, int(shard_duration * 1e9)))[1:]
+
+  shards = []
+  for k in range(len(boundaries) + 1):
+    start = boundaries[k - 1] if k > 0 else None
+    end = boundaries[k] if k < len(boundaries) else None
+    first = 0 if start is None else int(np.searchsorted(mono_times, max(start - int(warmup * 1e9), 0)))
+    last = len(msgs) if end is None else int(np.searchsorted(mono_times, end))
+
+    context = []
+    for idxs in context_idxs.values():
+      n = np.searchsorted(idxs, first)
+      if n > 0:
+        context.append(int(idxs[n - 1]))
+    shards.append((sorted(context) + list(range(first, last)), start, end))
+  return shards
+
+
+def _replay_shard(job) -> tuple[list[bytes], dict[str, dict[str, str]] | None]:
+  cfgs, dats, frs, fingerprint, custom_params, replay_configs, capture_output, start, end = job
+  captured_output_store: dict[str, dict[str, str]] | None = {} if capture_output else None
+  msgs = [messaging.log_from_bytes(dat) for dat in dats]
+  log_msgs = _replay_multi_process(cfgs, msgs, frs, fingerprint, custom_params, captured_output_store, True, replay_configs)
+  # outputs during the warmup belong to the previous shard
+  log_msgs = [m for m in log_msgs if (start is None or m.logMonoTime >= start) and (end is None or m.logMonoTime < end)]
+  return [m.as_builder().to_bytes() for m in log_msgs], captured_output_store
+
+
+def replay_process_parallel(
+  cfg: ProcessConfig | Iterable[ProcessConfig], lr: LogIterable, frs: dict[str, FrameReader] | None = None,
+  fingerprint: str | None = None, return_all_logs: bool = False, custom_params: dict[str, Any] | None = None,
+  captured_output_store: dict[str, dict[str, str]] | None = None, disable_progress: bool = False,
+  shard_duration: float | None = None, warmup: float = 60., num_workers: int | None = None
+) -> list[capnp._DynamicStructReader]:
+  """
+  Same as replay_process, but split into jobs that are replayed concurrently in num_workers processes.
+  Groups of processes that don't consume each other's outputs are replayed separately, and with shard_duration
+  (seconds) the log is split into windows that are each replayed from warmup seconds before their start.
+  Outputs of stateful processes may differ from a full replay around shard boundaries if warmup is shorter
+  than their convergence time. frs must be picklable, and the outputs are sorted by logMonoTime.
+  """
+  if isinstance(cfg, ProcessConfig):
+    cfgs = [cfg]
+  else:
+    cfgs = list(cfg)
+
+  all_msgs = migrate_all(lr,
+                         manager_states=True,
+                         panda_states=any("pandaStates" in cfg.pubs for cfg in cfgs),
+                         camera_states=any(len(cfg.vision_pubs) != 0 for cfg in cfgs))
+  all_msgs = sorted(all_msgs, key=lambda msg: msg.logMonoTime)
+  replay_configs = generate_replay_configs(all_msgs, fingerprint, custom_params)
+
+  dats = [m.as_builder().to_bytes() for m in all_msgs]
+  shards = get_replay_shards(all_msgs, shard_duration, warmup)
+  jobs = [(group, [dats[i] for i in idxs], frs, fingerprint, custom_params, replay_configs, captured_output_store is not None, start, end)
+          for group in get_independent_process_groups(cfgs) for idxs, start, end in shards]
+
+  process_logs = []
+  with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers) as pool:
+    for out_dats, store in tqdm(pool.map(_replay_shard, jobs), total=len(jobs), disable=disable_progress):
+      process_logs.extend(messaging.log_from_bytes(dat) for dat in out_dats)
+      if captured_output_store is not None and store is not None:
+        for proc_name, outerr in store.items():
+          prev = captured_output_store.setdefault(proc_name, {"out": "", "err": ""})
+          prev["out"] += outerr["out"]
+          prev["err"] += outerr["err"]
+  process_logs.sort(key=lambda m: int(m.logMonoTime))
+
+  if return_all_logs:
+    keys = {m.which() for m in process_logs}
+    modified_logs = [m for m in all_msgs if m.which() not in keys]
+    modified_logs.extend(process_logs)
+    modified_logs.sort(key=lambda m: int(m.logMonoTime))
+    return modified_logs
+  return process_logs
+
+
 def generate_params_config(lr=None, CP=None, fingerprint=None, custom_params=None) -> dict[str, Any]:
   params_dict = {
     "OpenpilotEnabledToggle": True,
@@ -0,0 +1,76 @@
+import os
+import tempfile
+from collections import Counter
+
+import openpilot.cereal.messaging as messaging
+from openpilot.common.test import OpenpilotTestCase
+
+from openpilot.selfdrive.test.process_replay.compare_logs import IgnoredFields, compare_logs
+from openpilot.tools.lib.logreader import LogReader, save_log
+
+IGNORE_FIELDS = ["logMonoTime", "carState.vEgo", "carState.cruiseState.speed", "pandaStates.0.safetyParam"]
+
+
+def generate_logs():
+  log1, log2 = [], []
+  for i in range(6):
+    for log, changed in ((log1, False), (log2, True)):
+      cs = messaging.new_message('carState', logMonoTime=i + 100 * changed)
+      cs.carState.vEgo = i + changed
+      cs.carState.cruiseState.speed = 1 + changed
+      if i % 2:
+        cs.carState.aEgo = float(changed)
+        cs.carState.cruiseState.enabled = changed
+      log.append(cs.as_reader())
+
+      ps = messaging.new_message('pandaStates', 1, logMonoTime=i)
+      ps.pandaStates[0].safetyParam = int(changed)
+      ps.pandaStates[0].ignitionLine = changed and i == 2
+      log.append(ps.as_reader())
+  return log1, log2
+
+
+class TestCompareLogs(OpenpilotTestCase):
+  def test_ignored_fields(self):
+    log1, log2 = generate_logs()
+    assert compare_logs(log1, log1, IGNORE_FIELDS) == []
+
+    expected = Counter({
+      ('change', 'carState.aEgo', (0., 1.)): 3,
+      ('change', 'carState.cruiseState.enabled', (False, True)): 3,
+      ('change', 'pandaStates.0.ignitionLine', (False, True)): 1,
+    })
+    diff = compare_logs(log1, log2, IGNORE_FIELDS)
+    assert Counter(diff) == expected
+
+    # without ignoring them, the nested fields show up
+    paths = {path for _, path, _ in compare_logs(log1, log2)}
+    assert {'logMonoTime', 'carState.vEgo', 'carState.cruiseState.speed', 'pandaStates.0.safetyParam'} <= paths
+
+  def test_num_workers(self):
+    log1, log2 = generate_logs()
+    for ignore in (IGNORE_FIELDS, None):
+      assert compare_logs(log1, log2, ignore, num_workers=2) == compare_logs(log1, log2, ignore)
+
+  def test_ignore_msgs(self):
+    log1, log2 = generate_logs()
+    diff = compare_logs(log1, log2, IGNORE_FIELDS, ignore_msgs=["carState"], num_workers=2)
+    assert diff == [('change', 'pandaStates.0.ignitionLine', (False, True))]
+
+  def test_read_logs(self, mocker):
+    log1, log2 = generate_logs()
+    with tempfile.TemporaryDirectory() as tmpdir:
+      read1, read2 = [], []
+      for log, read, fn in ((log1, read1, "rlog1"), (log2, read2, "rlog2")):
+        save_log(os.path.join(tmpdir, fn), log)
+        read.extend(LogReader(os.path.join(tmpdir, fn)))
+
+      for ignore in (IGNORE_FIELDS, ["logMonoTime"], None):
+        expected = compare_logs(log1, log2, ignore)
+        assert compare_logs(read1, read2, ignore) == expected
+        assert compare_logs(log1, read2, ignore) == expected
+
+      # messages that only differ in top level ignored fields are compared without copying them
+      remove = mocker.spy(IgnoredFields, "remove")
+      assert compare_logs(read1, read1, ["logMonoTime"]) == []
+      assert remove.call_count == 0
@@ -0,0 +1,58 @@
+import openpilot.cereal.messaging as messaging
+from openpilot.common.test import OpenpilotTestCase
+from openpilot.common.parameterized import parameterized
+
+from openpilot.selfdrive.test.process_replay.migration import migrate_all, migrate_all_stream
+from openpilot.tools.lib.openpilotci import get_url
+from openpilot.tools.lib.logreader import LogReader
+
+TESTED_SEGMENTS = [
+  ("PRIUS_C2", "0982d79ebb0de295|2021-01-04--17-13-21--13"),  # pandaStateDEPRECATED, no peripheralState, sensorEventsDEPRECATED
+]
+
+
+def serialize(msgs):
+  return [m.as_builder().to_bytes() for m in msgs]
+
+
+def new_message(service, t, **kwargs):
+  msg = messaging.new_message(service, logMonoTime=int(t * 1e9), **kwargs)
+  return msg.as_reader()
+
+
+class TestMigration(OpenpilotTestCase):
+  def test_stream_synthetic(self, subtests):
+    # carParams only shows up after the first windows, and one longitudinalPlan was already migrated
+    lr = []
+    for t in range(10):
+      lr.append(new_message('pandaStates', t, size=1))
+      lr.append(new_message('controlsState', t + 0.1))
+      lr.append(new_message('carState', t + 0.2))
+      lr.append(new_message('longitudinalPlan', t + 0.3))
+    cp = messaging.new_message('carParams', logMonoTime=int(7.5e9))
+    cp.carParams.carFingerprint = "TOYOTA_PRIUS"
+    lr.append(cp.as_reader())
+    plan = messaging.new_message('longitudinalPlan', logMonoTime=int(8.5e9))
+    plan.longitudinalPlan.aTarget = 1.
+    lr.append(plan.as_reader())
+    lr.sort(key=lambda m: m.logMonoTime)
+
+    expected = serialize(migrate_all(lr, panda_states=True))
+    for window in (1., 3., 100.):
+      with subtests.test(window=window):
+        assert serialize(migrate_all_stream(lr, panda_states=True, window=window)) == expected
+
+  def test_stream_requires_reiterable(self):
+    with self.assertRaises(TypeError):
+      list(migrate_all_stream(iter([])))
+
+
+class TestMigrationSegments(OpenpilotTestCase):
+  SLOW_TEST = True
+
+  @parameterized.expand(TESTED_SEGMENTS)
+  def test_stream_matches_migrate_all(self, case_name, segment):
+    route, sidx = segment.rsplit("--", 1)
+    lr = LogReader(get_url(route, sidx, "rlog.bz2"))
+    expected = serialize(migrate_all(lr, manager_states=True, panda_states=True))
+    assert serialize(migrate_all_stream(lr, manager_states=True, panda_states=True, window=5.)) == expected, case_name
@@ -0,0 +1,72 @@
+from dataclasses import replace
+
+import openpilot.cereal.messaging as messaging
+from openpilot.common.test import OpenpilotTestCase
+from openpilot.common.parameterized import parameterized
+
+from openpilot.selfdrive.test.process_replay.compare_logs import compare_logs
+from openpilot.selfdrive.test.process_replay.process_replay import CONFIGS, get_independent_process_groups, get_replay_shards, \
+                                                                   replay_process, replay_process_parallel
+from openpilot.tools.lib.openpilotci import get_url
+from openpilot.tools.lib.logreader import LogReader
+
+CONFIGS_BY_NAME = {cfg.proc_name: cfg for cfg in CONFIGS}
+
+
+def new_message(service, t):
+  return messaging.new_message(service, logMonoTime=int(t * 1e9)).as_reader()
+
+
+class TestProcessReplayJobs(OpenpilotTestCase):
+  def test_process_groups(self):
+    # every process consumes an output of another one, they all need to be replayed together
+    groups = get_independent_process_groups(CONFIGS)
+    assert groups == [CONFIGS]
+
+    ubloxd, calibrationd, dmonitoringmodeld = (CONFIGS_BY_NAME[name] for name in ("ubloxd", "calibrationd", "dmonitoringmodeld"))
+    assert get_independent_process_groups([ubloxd]) == [[ubloxd]]
+    assert get_independent_process_groups([ubloxd, dmonitoringmodeld]) == [[ubloxd], [dmonitoringmodeld]]
+    # calibrationd publishes liveCalibration, which dmonitoringmodeld subscribes to
+    assert get_independent_process_groups([ubloxd, calibrationd, dmonitoringmodeld]) == [[ubloxd], [calibrationd, dmonitoringmodeld]]
+
+    # dependencies are transitive
+    a = replace(ubloxd, proc_name="a", pubs=["carState"], subs=["liveCalibration"])
+    b = replace(ubloxd, proc_name="b", pubs=["liveCalibration"], subs=["livePose"])
+    c = replace(ubloxd, proc_name="c", pubs=["livePose"], subs=["radarState"])
+    assert get_independent_process_groups([a, ubloxd, c, b]) == [[a, c, b], [ubloxd]]
+
+  def test_replay_shards(self):
+    msgs = [new_message('initData', 0), new_message('carState', 0), new_message('carParams', 0.5)]
+    msgs += [new_message('carState', t) for t in range(1, 10)]
+    idx = {t: t + 2 for t in range(1, 10)}  # index of the carState at t seconds
+
+    assert get_replay_shards(msgs, None, 1.) == [(list(range(len(msgs))), None, None)]
+    assert get_replay_shards([], 3., 1.) == [([], None, None)]
+
+    shards = get_replay_shards(msgs, 3., 1.)
+    assert [(start, end) for _, start, end in shards] == [(None, int(3e9)), (int(3e9), int(6e9)), (int(6e9), int(9e9)), (int(9e9), None)]
+
+    # each shard starts a second early, with the latest initData and carParams before it
+    assert shards[0][0] == list(range(idx[3]))
+    assert shards[1][0] == [0, 2] + list(range(idx[2], idx[6]))
+    assert shards[2][0] == [0, 2] + list(range(idx[5], idx[9]))
+    assert shards[3][0] == [0, 2] + list(range(idx[8], len(msgs)))
+
+    # every message is in the output range of exactly one shard
+    for m in msgs:
+      assert sum((start is None or m.logMonoTime >= start) and (end is None or m.logMonoTime < end) for _, start, end in shards) == 1
+
+
+class TestProcessReplayParallel(OpenpilotTestCase):
+  SLOW_TEST = True
+
+  @parameterized.expand([(None, 60.), (30., 60.)])
+  def test_matches_replay_process(self, shard_duration, warmup):
+    # with a warmup covering the whole segment, the shards replay the same inputs as a full replay
+    lr = list(LogReader(get_url("0982d79ebb0de295|2021-01-04--17-13-21", "13", "rlog.bz2")))
+    cfg = CONFIGS_BY_NAME["calibrationd"]
+
+    expected = replay_process(cfg, lr, disable_progress=True)
+    output = replay_process_parallel(cfg, lr, disable_progress=True, shard_duration=shard_duration, warmup=warmup, num_workers=2)
+    assert len(output) == len(expected)
+    assert compare_logs(expected, output, cfg.ignore) == []
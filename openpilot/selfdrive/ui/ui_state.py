@@ -35,6 +35,8 @@ class UIState:
 
   def _initialize(self):
     self.params = Params()
+    # polled by update_params, only rereads params that changed
+    self._cached_params = Params(cache=True)
     self.sm = messaging.SubMaster(
       [
         "modelV2",
@@ -194,24 +196,26 @@ class UIState:
   def update_params(self) -> None:
     # For slower operations
     # Update longitudinal control state
-    CP_bytes = self.params.get("CarParamsPersistent")
+    p = self._cached_params.get_many(["CarParamsPersistent", "AlphaLongitudinalEnabled", "RecordAudio", "IsMetric", "AlwaysOnDM",
+                                      "ExperimentalMode", "UsbGpuActive", "UsbGpuLoading"])
+    CP_bytes = p["CarParamsPersistent"]
     if CP_bytes is not None:
       self.CP = messaging.log_from_bytes(CP_bytes, car.CarParams)
       if self.CP.alphaLongitudinalAvailable:
-        self.has_longitudinal_control = self.params.get_bool("AlphaLongitudinalEnabled")
+        self.has_longitudinal_control = bool(p["AlphaLongitudinalEnabled"])
       else:
         self.has_longitudinal_control = self.CP.openpilotLongitudinalControl
 
-    self.recording_audio = self.params.get_bool("RecordAudio") and self.started
-    self.is_metric = self.params.get_bool("IsMetric")
-    self.always_on_dm = self.params.get_bool("AlwaysOnDM")
-    self.experimental_mode = self.params.get_bool("ExperimentalMode")
+    self.recording_audio = bool(p["RecordAudio"]) and self.started
+    self.is_metric = bool(p["IsMetric"])
+    self.always_on_dm = bool(p["AlwaysOnDM"])
+    self.experimental_mode = bool(p["ExperimentalMode"])
     # keep usbgpu UI active until offroad transition when gpu disappears
     self.usbgpu = self.sm["deviceState"].chestnutPresent or (self.usbgpu and self.started)
     if not self.usbgpu_compiled:
       self.usbgpu_compiled = usbgpu_compiled()
-    self.usbgpu_active = self.params.get_bool("UsbGpuActive")
-    self.usbgpu_loading = self.params.get_bool("UsbGpuLoading")
+    self.usbgpu_active = bool(p["UsbGpuActive"])
+    self.usbgpu_loading = bool(p["UsbGpuLoading"])
 
 
 class Device:
@@ -20,7 +20,6 @@ from typing import cast
 from collections.abc import Callable
 
 import requests
-from requests.adapters import HTTPAdapter, DEFAULT_POOLBLOCK
 from websocket import (ABNF, WebSocket, WebSocketException, WebSocketTimeoutException,
                        create_connection)
 
@@ -29,10 +28,11 @@ from openpilot.cereal import log
 from opendbc.car.structs import car
 from openpilot.cereal.services import SERVICE_LIST
 from openpilot.common.api import Api, get_key_pair
-from openpilot.common.utils import CallbackReader, get_upload_stream
+from openpilot.common.inotify import Inotify, IN_CREATE, IN_DELETE, IN_IGNORED, IN_MOVED_FROM, IN_MOVED_TO, IN_ONLYDIR, IN_Q_OVERFLOW
 from openpilot.common.params import Params
 from openpilot.common.realtime import set_core_affinity
 from openpilot.common.hardware import HARDWARE, PC
+from openpilot.system.loggerd.upload_engine import UploadEngine
 from openpilot.system.loggerd.xattr_cache import getxattr, setxattr
 from openpilot.common.swaglog import cloudlog
 from openpilot.common.version import get_build_metadata
@@ -46,6 +46,12 @@ LOCAL_PORT_WHITELIST = {22, }  # SSH
 
 LOG_ATTR_NAME = 'user.upload'
 LOG_ATTR_VALUE_MAX_UNIX_TIME = int.to_bytes(2147483647, 4, sys.byteorder)
+LOG_BATCH_FILES = 8  # most logs sent in one forwardLogs call
+LOG_BATCH_BYTES = 512 * 1024  # no more logs are added to a batch past this size
+LOG_WINDOW = 4  # most forwardLogs calls awaiting a response
+LOG_RESPONSE_TIMEOUT = 100  # seconds until a forwardLogs call no longer counts towards the window
+LOG_RESEND_TIMEOUT = 3600  # seconds until logs without a response are sent again
+LOG_SCAN_INTERVAL = 10  # seconds between scans of the log directory without inotify
 RECONNECT_TIMEOUT_S = 70
 
 RETRY_DELAY = 10  # seconds
@@ -60,7 +66,6 @@ SEND_PRIORITY_LOW = 1
 
 # https://bytesolutions.com/dscp-tos-cos-precedence-conversion-chart,
 # https://en.wikipedia.org/wiki/Differentiated_services
-UPLOAD_TOS = 0x20  # CS1, low priority background traffic
 SSH_TOS = 0x90  # AF42, DSCP of 36/HDD_LINUX_AC_VI with the minimum delay flag
 
 NetworkType = log.DeviceState.NetworkType
@@ -71,15 +76,10 @@ UploadItemDict = dict[str, str | bool | int | float | dict[str, str]]
 UploadFilesToUrlResponse = dict[str, int | list[UploadItemDict] | list[str]]
 
 
-class UploadTOSAdapter(HTTPAdapter):
-  def init_poolmanager(self, connections, maxsize, block=DEFAULT_POOLBLOCK, **pool_kwargs):
-    pool_kwargs["socket_options"] = [(socket.IPPROTO_IP, socket.IP_TOS, UPLOAD_TOS)]
-    super().init_poolmanager(connections, maxsize, block, **pool_kwargs)
-
-
-UPLOAD_SESS = requests.Session()
-UPLOAD_SESS.mount("http://", UploadTOSAdapter())
-UPLOAD_SESS.mount("https://", UploadTOSAdapter())
+# shared by the upload handler threads, for connection reuse. Its network is never set to metered: on metered networks
+# athena only uploads the files requested with allow_cellular, which aren't throttled
+UPLOAD_ENGINE = UploadEngine(HANDLER_THREADS)
+UPLOAD_SESS = UPLOAD_ENGINE.session
 
 
 @dataclass
@@ -328,17 +328,7 @@ def _do_upload(upload_item: UploadItem, callback: Callable | None = None) -> req
     path = strip_zst_extension(path)
     compress = True
 
-  stream = None
-  try:
-    stream, content_length = get_upload_stream(path, compress)
-    response = UPLOAD_SESS.put(upload_item.url,
-                               data=CallbackReader(stream, callback, content_length) if callback else stream,
-                               headers={**upload_item.headers, 'Content-Length': str(content_length)},
-                               timeout=30)
-    return response
-  finally:
-    if stream:
-      stream.close()
+  return UPLOAD_ENGINE.upload(upload_item.url, upload_item.headers, path, compress, callback, timeout=30)
 
 
 # security: user should be able to request any message from their car
@@ -592,75 +582,134 @@ def startStream(sdp: str, enabled: bool) -> dict:
   return post_stream_request(StreamRequestBody(sdp, "wideRoad", enabled, bridge_services_in, ["carState", "deviceState"]))
 
 
-def get_logs_to_send_sorted() -> list[str]:
-  # TODO: scan once then use inotify to detect file creation/deletion
-  curr_time = int(time.time())  # noqa: TID251
-  logs = []
-  for log_entry in os.listdir(Paths.swaglog_root()):
-    log_path = os.path.join(Paths.swaglog_root(), log_entry)
-    time_sent = 0
+def get_log_time_sent(log_path: str) -> int:
+  try:
+    value = getxattr(log_path, LOG_ATTR_NAME)
+    if value is not None:
+      return int.from_bytes(value, sys.byteorder)
+  except (ValueError, TypeError):
+    pass
+  return 0
+
+
+def is_log_pending(time_sent: int, curr_time: int) -> bool:
+  # assume send failed and we lost the response if sent more than one hour ago
+  return not time_sent or curr_time - time_sent > LOG_RESEND_TIMEOUT
+
+
+class LogIndex:
+  """
+  Send times of the swaglog files, from one scan of the directory, then kept up to date with inotify.
+  Without inotify, or after its queue overflows, the directory is scanned again.
+  """
+
+  def __init__(self, root: str):
+    self.root = root
+    self.sent: dict[str, int] = {}  # file name -> time sent, 0 if not sent
+    self.inotify: Inotify | None = None
+    self.last_scan: float | None = None
+
+  def scan(self) -> None:
+    if self.inotify is None:
+      try:
+        self.inotify = Inotify()
+        self.inotify.add_watch(self.root, IN_CREATE | IN_MOVED_TO | IN_DELETE | IN_MOVED_FROM | IN_ONLYDIR)
+      except OSError:
+        cloudlog.exception("athena.log_handler.inotify_failed")
+        if self.inotify is not None:
+          self.inotify.close()
+        self.inotify = None
+
+    self.last_scan = time.monotonic()
+    self.sent = {f: get_log_time_sent(os.path.join(self.root, f)) for f in os.listdir(self.root)}
+
+  def update(self) -> None:
+    if self.inotify is None:
+      if self.last_scan is None or time.monotonic() - self.last_scan > LOG_SCAN_INTERVAL:
+        self.scan()
+      return
+
+    for _, mask, _, name in self.inotify.read():
+      if mask & (IN_Q_OVERFLOW | IN_IGNORED):
+        if mask & IN_IGNORED:
+          self.inotify.close()
+          self.inotify = None
+        self.scan()
+        return
+      if mask & (IN_CREATE | IN_MOVED_TO):
+        self.sent.setdefault(name, 0)
+      elif mask & (IN_DELETE | IN_MOVED_FROM):
+        self.sent.pop(name, None)
+
+  def mark_sent(self, name: str, value: bytes) -> bool:
     try:
-      value = getxattr(log_path, LOG_ATTR_NAME)
-      if value is not None:
-        time_sent = int.from_bytes(value, sys.byteorder)
-    except (ValueError, TypeError):
-      pass
-    # assume send failed and we lost the response if sent more than one hour ago
-    if not time_sent or curr_time - time_sent > 3600:
-      logs.append(log_entry)
-  # excluding most recent (active) log file
-  return sorted(logs)[:-1]
+      setxattr(os.path.join(self.root, name), LOG_ATTR_NAME, value)
+    except OSError:
+      return False  # file could be deleted by log rotation
+    if name in self.sent:
+      self.sent[name] = int.from_bytes(value, sys.byteorder)
+    return True
+
+  def pending(self, curr_time: int) -> list[str]:
+    """Logs to send, oldest first, excluding the most recent (active) log file"""
+    if not self.sent:
+      return []
+    newest = max(self.sent)
+    return sorted(f for f, time_sent in self.sent.items() if f != newest and is_log_pending(time_sent, curr_time))
 
 
 def log_handler(end_event: threading.Event) -> None:
   if PC:
     return
 
-  log_files = []
-  last_scan = 0.
+  index = LogIndex(Paths.swaglog_root())
+  # request id -> time sent, for the batches awaiting a response
+  in_flight: dict[str, float] = {}
   while not end_event.is_set():
     try:
-      curr_scan = time.monotonic()
-      if curr_scan - last_scan > 10:
-        log_files = get_logs_to_send_sorted()
-        last_scan = curr_scan
-
-      # send one log
-      curr_log = None
-      if len(log_files) > 0:
-        log_entry = log_files.pop() # newest log file
-        cloudlog.debug(f"athena.log_handler.forward_request {log_entry}")
-        try:
-          curr_time = int(time.time())  # noqa: TID251
-          log_path = os.path.join(Paths.swaglog_root(), log_entry)
-          setxattr(log_path, LOG_ATTR_NAME, int.to_bytes(curr_time, 4, sys.byteorder))
-          with open(log_path) as f:
-            send_queue_push(dumps_call("forwardLogs", {"logs": f.read()}, request_id=log_entry), SEND_PRIORITY_LOW)
-            curr_log = log_entry
-        except OSError:
-          pass  # file could be deleted by log rotation
+      index.update()
+
+      # send batches of the newest logs until LOG_WINDOW batches await a response
+      curr_time = int(time.time())  # noqa: TID251
+      log_files = index.pending(curr_time)
+      while log_files and len(in_flight) < LOG_WINDOW:
+        batch: list[str] = []
+        logs = ""
+        while log_files and len(batch) < LOG_BATCH_FILES and len(logs) < LOG_BATCH_BYTES:
+          log_entry = log_files.pop()  # newest log file
+          if not index.mark_sent(log_entry, int.to_bytes(curr_time, 4, sys.byteorder)):
+            continue
+          try:
+            with open(os.path.join(Paths.swaglog_root(), log_entry)) as f:
+              logs += f.read()
+            batch.append(log_entry)
+          except OSError:
+            pass  # file could be deleted by log rotation
+        if batch:
+          # the ids of the logs in a batch are sent as the request id, and echoed back in the response
+          request_id = ",".join(batch)
+          cloudlog.debug(f"athena.log_handler.forward_request {request_id}")
+          send_queue_push(dumps_call("forwardLogs", {"logs": logs}, request_id=request_id), SEND_PRIORITY_LOW)
+          in_flight[request_id] = time.monotonic()
+
+      # batches without a response are sent again once LOG_RESEND_TIMEOUT passes
+      for request_id, t in list(in_flight.items()):
+        if time.monotonic() - t > LOG_RESPONSE_TIMEOUT:
+          del in_flight[request_id]
 
-      # wait for response up to ~100 seconds
       # always read queue at least once to process any old responses that arrive
-      for _ in range(100):
-        if end_event.is_set():
-          break
-        try:
-          log_resp = json.loads(log_recv_queue.get(timeout=1))
-          log_entry = log_resp.get("id")
-          log_success = "result" in log_resp and log_resp["result"].get("success")
-          cloudlog.debug(f"athena.log_handler.forward_response {log_entry} {log_success}")
-          if log_entry and log_success:
-            log_path = os.path.join(Paths.swaglog_root(), log_entry)
-            try:
-              setxattr(log_path, LOG_ATTR_NAME, LOG_ATTR_VALUE_MAX_UNIX_TIME)
-            except OSError:
-              pass  # file could be deleted by log rotation
-          if curr_log == log_entry:
-            break
-        except queue.Empty:
-          if curr_log is None:
-            break
+      try:
+        log_resp = json.loads(log_recv_queue.get(timeout=1))
+      except queue.Empty:
+        continue
+      request_id = log_resp.get("id")
+      log_success = "result" in log_resp and log_resp["result"].get("success")
+      cloudlog.debug(f"athena.log_handler.forward_response {request_id} {log_success}")
+      if isinstance(request_id, str):
+        in_flight.pop(request_id, None)
+        if log_success:
+          for log_entry in request_id.split(","):
+            index.mark_sent(log_entry, LOG_ATTR_VALUE_MAX_UNIX_TIME)
 
     except Exception:
       cloudlog.exception("athena.log_handler.exception")
@@ -4,6 +4,7 @@ import multiprocessing
 import os
 import requests
 import shutil
+import sys
 import time
 import threading
 import queue
@@ -437,13 +438,62 @@ class TestAthenadMethods(OpenpilotTestCase):
       end_event.set()
       thread.join()
 
-  def test_get_logs_to_send_sorted(self):
-    fl = []
-    for i in range(10):
-      file = f'swaglog.{i:010}'
-      self._create_file(file, Paths.swaglog_root())
-      fl.append(file)
+  def test_log_index(self):
+    fl = [os.path.basename(self._create_file(f'swaglog.{i:010}', Paths.swaglog_root())) for i in range(5)]
+    index = athenad.LogIndex(Paths.swaglog_root())
+    index.update()
+    curr_time = int(time.time())  # noqa: TID251
+    assert index.pending(curr_time) == fl[:-1]
+
+    # new and rotated out logs are picked up without a rescan
+    fl.append(os.path.basename(self._create_file(f'swaglog.{5:010}', Paths.swaglog_root())))
+    os.unlink(os.path.join(Paths.swaglog_root(), fl.pop(0)))
+    index.update()
+    assert index.pending(curr_time) == fl[:-1]
+
+    assert index.mark_sent(fl[0], athenad.LOG_ATTR_VALUE_MAX_UNIX_TIME)
+    assert index.mark_sent(fl[1], int.to_bytes(curr_time, 4, sys.byteorder))
+    assert index.pending(curr_time) == fl[2:-1]
+    assert index.pending(curr_time + athenad.LOG_RESEND_TIMEOUT + 1) == fl[1:-1]
+
+    # send times are read back from the xattrs on a new scan
+    index = athenad.LogIndex(Paths.swaglog_root())
+    index.scan()
+    assert index.pending(curr_time) == fl[2:-1]
+
+  def test_log_handler(self, mocker):
+    mocker.patch.object(athenad, "PC", False)
+    mocker.patch.object(athenad, "LOG_BATCH_FILES", 3)
+    mocker.patch.object(athenad, "LOG_WINDOW", 2)
+    mocker.patch.object(athenad, "send_queue", queue.PriorityQueue())
+    mocker.patch.object(athenad, "log_recv_queue", queue.Queue())
+    fl = [os.path.basename(self._create_file(f'swaglog.{i:010}', Paths.swaglog_root(), data=f'{i}\n'.encode())) for i in range(10)]
+
+    def recv_request():
+      _, _, req = athenad.send_queue.get(timeout=3)
+      req = json.loads(req)
+      assert req["method"] == "forwardLogs"
+      return req["id"], req["params"]["logs"]
 
-    # ensure the list is all logs except most recent
-    sl = athenad.get_logs_to_send_sorted()
-    assert sl == fl[:-1]
+    end_event = threading.Event()
+    thread = threading.Thread(target=athenad.log_handler, args=(end_event,))
+    thread.start()
+    try:
+      # two batches of the newest logs are sent without waiting for a response
+      assert recv_request() == (",".join(fl[8:5:-1]), "8\n7\n6\n")
+      request_id, _ = recv_request()
+      assert request_id == ",".join(fl[5:2:-1])
+      with self.assertRaises(queue.Empty):
+        athenad.send_queue.get(timeout=1.5)
+
+      # a response opens up the window for the next batch
+      athenad.log_recv_queue.put_nowait(json.dumps({"result": {"success": 1}, "id": request_id, "jsonrpc": "2.0"}))
+      assert recv_request() == (",".join(fl[2::-1]), "2\n1\n0\n")
+    finally:
+      end_event.set()
+      thread.join()
+
+    for i, f in enumerate(fl[:-1]):
+      time_sent = athenad.get_log_time_sent(os.path.join(Paths.swaglog_root(), f))
+      assert (time_sent == 2147483647) == (3 <= i <= 5)
+      assert time_sent > 0
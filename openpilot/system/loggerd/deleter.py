@@ -2,10 +2,12 @@
 import os
 import shutil
 import threading
+import time
+from collections.abc import Callable
+from dataclasses import dataclass
 from openpilot.common.hardware.hw import Paths
 from openpilot.common.swaglog import cloudlog
-from openpilot.system.loggerd.config import get_available_bytes, get_available_percent
-from openpilot.system.loggerd.uploader import listdir_by_creation
+from openpilot.system.loggerd.uploader import get_directory_sort
 from openpilot.system.loggerd.xattr_cache import getxattr
 
 MIN_BYTES = 5 * 1024 * 1024 * 1024
@@ -17,15 +19,27 @@ PRESERVE_ATTR_NAME = 'user.preserve'
 PRESERVE_ATTR_VALUE = b'1'
 PRESERVE_COUNT = 5
 
+DELETER_NICE = 19  # without an explicit io priority, the io priority follows the nice value
+# a directory changed this recently may change again within its ctime granularity, so it's rescanned until it settles
+CTIME_SETTLE_NS = 1_000_000_000
+
+
+@dataclass
+class LogDir:
+  ctime_ns: int
+  size: int  # bytes allocated on disk
+  locked: bool
+  preserve: bool
+
 
 def has_preserve_xattr(d: str) -> bool:
   return getxattr(os.path.join(Paths.log_root(), d), PRESERVE_ATTR_NAME) == PRESERVE_ATTR_VALUE
 
 
-def get_preserved_segments(dirs_by_creation: list[str]) -> set[str]:
+def get_preserved_segments(dirs_by_creation: list[str], is_preserved: Callable[[str], bool] = has_preserve_xattr) -> set[str]:
   # skip deleting most recent N preserved segments (and their prior segment)
   preserved = set()
-  for n, d in enumerate(filter(has_preserve_xattr, reversed(dirs_by_creation))):
+  for n, d in enumerate(filter(is_preserved, reversed(dirs_by_creation))):
     if n == PRESERVE_COUNT:
       break
     date_str, _, seg_str = d.rpartition("--")
@@ -45,28 +59,104 @@ def get_preserved_segments(dirs_by_creation: list[str]) -> set[str]:
   return preserved
 
 
+def get_bytes_to_free() -> int:
+  """Bytes to delete to get back above both MIN_BYTES and MIN_PERCENT available"""
+  try:
+    statvfs = os.statvfs(Paths.log_root())
+  except OSError:
+    return 0
+  to_free_bytes = MIN_BYTES - statvfs.f_bavail * statvfs.f_frsize
+  to_free_percent = (MIN_PERCENT / 100. * statvfs.f_blocks - statvfs.f_bavail) * statvfs.f_frsize
+  return max(int(to_free_bytes), int(to_free_percent), 0)
+
+
+def get_dir_size(path: str) -> int:
+  size = 0
+  for entry in os.scandir(path):
+    if entry.is_dir(follow_symlinks=False):
+      size += get_dir_size(entry.path)
+    else:
+      size += entry.stat(follow_symlinks=False).st_blocks * 512
+  return size
+
+
+class DeleterIndex:
+  """
+  Size, lock and preserve state of the directories in the log root. A directory's ctime changes when files are
+  added to or removed from it and when its xattrs change, so a directory is only rescanned once its ctime does.
+  Files growing in place don't change it, but those are in locked directories, which change when unlocked.
+  """
+
+  def __init__(self, root: str):
+    self.root = root
+    self.dirs: dict[str, LogDir] = {}
+
+  def _scan(self, d: str, ctime_ns: int) -> LogDir:
+    path = os.path.join(self.root, d)
+    names = os.listdir(path)
+    # read from disk, the cached value would be from the first scan when another process sets it
+    preserve = getxattr(path, PRESERVE_ATTR_NAME, cached=False) == PRESERVE_ATTR_VALUE
+    return LogDir(ctime_ns, get_dir_size(path), any(name.endswith(".lock") for name in names), preserve)
+
+  def update(self) -> list[str]:
+    """Refreshes changed directories, returning all directories by creation"""
+    try:
+      entries = [e for e in os.scandir(self.root) if e.is_dir(follow_symlinks=False)]
+    except OSError:
+      cloudlog.exception("deleter: listing log root failed")
+      return []
+
+    settled_ns = time.time_ns() - CTIME_SETTLE_NS
+    dirs = {}
+    for entry in entries:
+      try:
+        ctime_ns = entry.stat(follow_symlinks=False).st_ctime_ns
+        cached = self.dirs.get(entry.name)
+        if cached is None or cached.ctime_ns != ctime_ns or ctime_ns > settled_ns:
+          cached = self._scan(entry.name, ctime_ns)
+        dirs[entry.name] = cached
+      except OSError:
+        # deleted while scanning
+        continue
+    self.dirs = dirs
+    return sorted(dirs, key=get_directory_sort)
+
+  def evict(self, to_free: int) -> int:
+    """Deletes unlocked directories in deletion order until to_free bytes are freed, returning the bytes freed"""
+    dirs = self.update()
+    preserved_dirs = get_preserved_segments(dirs, lambda d: self.dirs[d].preserve)
+
+    freed = 0
+    for delete_dir in sorted(dirs, key=lambda d: (d in DELETE_LAST, d in preserved_dirs)):
+      if freed >= to_free:
+        break
+
+      info = self.dirs[delete_dir]
+      if info.locked:
+        continue
+
+      delete_path = os.path.join(self.root, delete_dir)
+      try:
+        cloudlog.info(f"deleting {delete_path}")
+        shutil.rmtree(delete_path)
+        freed += info.size
+      except OSError:
+        cloudlog.exception(f"issue deleting {delete_path}")
+      del self.dirs[delete_dir]
+    return freed
+
+
 def deleter_thread(exit_event: threading.Event):
+  try:
+    os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), DELETER_NICE)
+  except OSError:
+    cloudlog.exception("deleter: failed to lower priority")
+
+  index = DeleterIndex(Paths.log_root())
   while not exit_event.is_set():
-    out_of_bytes = get_available_bytes(default=MIN_BYTES + 1) < MIN_BYTES
-    out_of_percent = get_available_percent(default=MIN_PERCENT + 1) < MIN_PERCENT
-
-    if out_of_percent or out_of_bytes:
-      dirs = listdir_by_creation(Paths.log_root())
-      preserved_dirs = get_preserved_segments(dirs)
-
-      # remove the earliest directory we can
-      for delete_dir in sorted(dirs, key=lambda d: (d in DELETE_LAST, d in preserved_dirs)):
-        delete_path = os.path.join(Paths.log_root(), delete_dir)
-
-        if any(name.endswith(".lock") for name in os.listdir(delete_path)):
-          continue
-
-        try:
-          cloudlog.info(f"deleting {delete_path}")
-          shutil.rmtree(delete_path)
-          break
-        except OSError:
-          cloudlog.exception(f"issue deleting {delete_path}")
+    to_free = get_bytes_to_free()
+    if to_free > 0:
+      index.evict(to_free)
       exit_event.wait(.1)
     else:
       exit_event.wait(30)
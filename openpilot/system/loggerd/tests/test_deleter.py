@@ -6,7 +6,11 @@ from collections.abc import Sequence
 
 import openpilot.system.loggerd.deleter as deleter
 from openpilot.common.timeout import Timeout, TimeoutException
+from openpilot.common.hardware.hw import Paths
 from openpilot.system.loggerd.tests.loggerd_tests_common import UploaderTestCase
+from openpilot.system.loggerd.xattr_cache import _setxattr
+
+CTIME_GRANULARITY = 0.05  # coarse filesystem timestamps are a few ms
 
 Stats = namedtuple("Stats", ['f_bavail', 'f_blocks', 'f_frsize'])
 
@@ -90,6 +94,48 @@ class TestDeleter(UploaderTestCase):
       self.make_file_with_data("crash", self.seg_format2[:-4]),
     ])
 
+  def test_evict(self, mocker):
+    # use cached directories right away, instead of after their ctime settles
+    mocker.patch.object(deleter, "CTIME_SETTLE_NS", 0)
+    scan = mocker.patch.object(deleter.DeleterIndex, "_scan", autospec=True, side_effect=deleter.DeleterIndex._scan)
+    f_paths = [self.make_file_with_data(self.seg_format.format(i), self.f_type, 1) for i in range(4)]
+    locked = self.make_file_with_data(self.seg_format2.format(0), self.f_type, 1, lock=True)
+    preserved = self.make_file_with_data(self.seg_format2.format(1), self.f_type, 1, preserve_xattr=deleter.PRESERVE_ATTR_VALUE)
+
+    index = deleter.DeleterIndex(Paths.log_root())
+    dirs = [self.seg_format.format(i) for i in range(4)] + [self.seg_format2.format(i) for i in range(2)]
+    assert index.update() == dirs
+    assert index.dirs[locked.parent.name].locked
+    assert index.dirs[preserved.parent.name].preserve
+    assert not index.dirs[locked.parent.name].preserve
+
+    # unchanged directories aren't scanned again
+    scan.reset_mock()
+    assert index.update() == dirs
+    assert scan.call_count == 0
+
+    # an xattr set by another process, bypassing xattr_cache, is seen once the directory is rescanned
+    time.sleep(CTIME_GRANULARITY)
+    _setxattr(str(locked.parent), deleter.PRESERVE_ATTR_NAME, deleter.PRESERVE_ATTR_VALUE)
+    assert index.update() == dirs
+    assert [call.args[1] for call in scan.call_args_list] == [locked.parent.name]
+    assert index.dirs[locked.parent.name].preserve
+
+    # only deletes as much as needed, oldest first
+    freed = index.evict(int(2.5 * 1024 * 1024))
+    assert freed >= 2.5 * 1024 * 1024
+    assert [f.exists() for f in f_paths] == [False, False, False, True]
+
+    # picks up new files in cached directories
+    time.sleep(CTIME_GRANULARITY)
+    self.make_file_with_data(self.seg_format.format(3), "qlog", 1)
+    assert index.update() and index.dirs[self.seg_format.format(3)].size >= 2 * 1024 * 1024
+
+    # never deletes locked directories, and preserved ones last
+    index.evict(100 * 1024 * 1024)
+    assert not f_paths[3].exists() and not preserved.exists()
+    assert locked.exists()
+
   def test_no_delete_when_available_space(self):
     f_path = self.make_file_with_data(self.seg_dir, self.f_type)
 
@@ -0,0 +1,115 @@
+import os
+import shutil
+import tempfile
+import time
+
+import zstandard as zstd
+
+from openpilot.common.test import OpenpilotTestCase
+from openpilot.common.utils import UPLOAD_COMPRESSION_LEVEL, CompressionCache, upload_compression_cache
+import openpilot.system.loggerd.upload_engine as upload_engine
+from openpilot.system.loggerd.upload_engine import TokenBucket, UploadEngine
+from openpilot.system.loggerd.tests.upload_server import UploadServer
+
+BLOCK_BLOB = {"x-ms-blob-type": "BlockBlob"}
+
+
+class TestUploadEngine(OpenpilotTestCase):
+  def setup_method(self):
+    self.engine = UploadEngine()
+    self.tmpdir = tempfile.mkdtemp()
+
+  def teardown_method(self):
+    shutil.rmtree(self.tmpdir)
+
+  def _create_file(self, name, size):
+    fn = os.path.join(self.tmpdir, name)
+    data = os.urandom(size)
+    with open(fn, "wb") as f:
+      f.write(data)
+    return fn, data
+
+  def test_upload(self):
+    fn, data = self._create_file("qlog", 100 * 1024)
+    progress = []
+    with UploadServer() as server:
+      resp = self.engine.upload(f"{server.url}/qlog?sig=abc", {}, fn, callback=lambda sz, cur: progress.append((sz, cur)))
+      assert resp.status_code == 201
+      assert server.blobs["/qlog"] == data
+      assert progress[-1] == (len(data), len(data))
+
+      # the compressed file is kept for the retry of a failed upload, and dropped once it's uploaded
+      key = CompressionCache.key(fn, UPLOAD_COMPRESSION_LEVEL)
+      server.fail_requests = {len(server.requests)}
+      assert self.engine.upload(f"{server.url}/qlog.zst", {}, fn, compress=True).status_code == 500
+      assert os.path.exists(upload_compression_cache.path(key))
+
+      resp = self.engine.upload(f"{server.url}/qlog.zst", {}, fn, compress=True)
+      assert resp.status_code == 201
+      assert zstd.ZstdDecompressor().decompressobj().decompress(server.blobs["/qlog.zst"]) == data
+      assert not os.path.exists(upload_compression_cache.path(key))
+
+  def test_block_upload_resume(self, mocker):
+    mocker.patch.object(upload_engine, "BLOCK_SIZE", 64 * 1024)
+    mocker.patch.object(upload_engine, "BLOCK_UPLOAD_MIN_SIZE", 128 * 1024)
+    fn, data = self._create_file("fcamera.hevc", 300 * 1024)
+
+    with UploadServer() as server:
+      # the third block fails every attempt
+      server.fail_requests = set(range(2, 2 + upload_engine.BLOCK_RETRIES))
+      resp = self.engine.upload(f"{server.url}/fcamera.hevc?sig=1", BLOCK_BLOB, fn)
+      assert resp.status_code == 500
+      assert "/fcamera.hevc" not in server.blobs
+      n_requests = len(server.requests)
+
+      # retried with a new signature, only the missing blocks and the block list are sent
+      resp = self.engine.upload(f"{server.url}/fcamera.hevc?sig=2", BLOCK_BLOB, fn)
+      assert resp.status_code == 201
+      assert server.blobs["/fcamera.hevc"] == data
+      assert len(server.requests) - n_requests == 3 + 1
+      assert server.requests[-1] == ("/fcamera.hevc", "sig=2&comp=blocklist")
+
+  def test_rate_limit(self, mocker):
+    mocker.patch.object(upload_engine, "UPLOAD_RATE_METERED", 256 * 1024)
+    fn, data = self._create_file("qcamera.ts", 512 * 1024)
+    self.engine.limiter = TokenBucket(burst=64 * 1024)
+    with UploadServer() as server:
+      for metered in (False, True):
+        self.engine.set_network(metered)
+        start = time.monotonic()
+        assert self.engine.upload(f"{server.url}/qcamera.ts", {}, fn).status_code == 201
+        dt = time.monotonic() - start
+        assert server.blobs["/qcamera.ts"] == data
+        if metered:
+          assert dt >= 1.5
+        else:
+          assert dt < 1.
+
+  def test_submit(self):
+    self.engine = UploadEngine(num_workers=3)
+    files = [self._create_file(f"qcamera{i}.ts", 64 * 1024) for i in range(7)]
+    # slow enough that the uploads overlap
+    with UploadServer(rate=256 * 1024) as server:
+      futures = [self.engine.submit(self.engine.upload, f"{server.url}/{i}", {}, fn) for i, (fn, _) in enumerate(files)]
+      assert all(f.result().status_code == 201 for f in futures)
+      assert [server.blobs[f"/{i}"] for i in range(len(files))] == [data for _, data in files]
+      assert server.peak_concurrency == 3
+
+      # upload() runs on the calling thread
+      server.peak_concurrency = 0
+      for i, (fn, _) in enumerate(files[:2]):
+        assert self.engine.upload(f"{server.url}/{i}", {}, fn).status_code == 201
+      assert server.peak_concurrency == 1
+
+  def test_token_bucket(self):
+    bucket = TokenBucket(rate=1e6, burst=1e5)
+    start = time.monotonic()
+    for _ in range(60):
+      bucket.consume(1e4)
+    # the burst goes through immediately, the rest at rate
+    assert 0.45 <= time.monotonic() - start < 1.
+
+    bucket.set_rate(None)
+    start = time.monotonic()
+    bucket.consume(1e9)
+    assert time.monotonic() - start < 0.1
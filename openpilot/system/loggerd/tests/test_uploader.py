@@ -1,15 +1,21 @@
 import os
+import shutil
 import time
 import threading
 import logging
 import json
+import datetime
+from collections.abc import Iterator
 from pathlib import Path
 from openpilot.common.hardware.hw import Paths
 
 from openpilot.common.swaglog import cloudlog
-from openpilot.system.loggerd.uploader import main, UPLOAD_ATTR_NAME, UPLOAD_ATTR_VALUE
+import openpilot.system.loggerd.uploader as uploader
+from openpilot.system.loggerd.uploader import main, listdir_by_creation, NetworkType, Uploader, UPLOAD_ATTR_NAME, UPLOAD_ATTR_VALUE
+from openpilot.system.loggerd.xattr_cache import getxattr, setxattr
 
-from openpilot.system.loggerd.tests.loggerd_tests_common import UploaderTestCase
+from openpilot.system.loggerd.tests.loggerd_tests_common import MockResponse, UploaderTestCase
+from openpilot.system.loggerd.tests.upload_server import UploadServer
 
 
 class FakeLogHandler(logging.Handler):
@@ -148,6 +154,20 @@ class TestUploader(UploaderTestCase):
 
     assert log_handler.upload_order == exp_order, "Files uploaded in wrong order"
 
+  def test_upload_files_created_after_start(self):
+    self.start_thread()
+    time.sleep(0.25)
+    self.gen_files(lock=False)
+
+    # allow enough time that files could upload twice if there is a bug in the logic
+    time.sleep(1)
+    self.join_thread()
+
+    exp_order = self.gen_order([self.seg_num], [])
+
+    assert len(log_handler.upload_ignored) == 0, "Some files were ignored"
+    assert sorted(log_handler.upload_order) == sorted(exp_order), "Files not uploaded exactly once"
+
   def test_no_upload_with_lock_file(self):
     self.start_thread()
 
@@ -182,3 +202,162 @@ class TestUploader(UploaderTestCase):
     for f_path in f_paths:
       lock_path = f_path.with_suffix(f_path.suffix + ".lock")
       assert not lock_path.is_file(), "File lock not cleared on startup"
+
+
+def list_upload_files(u: Uploader, metered: bool) -> Iterator[tuple[str, str, str]]:
+  """The files left to upload, listing every segment, as the uploader did before UploadIndex"""
+  r = u.params.get("AthenadRecentlyViewedRoutes")
+  requested_routes = [] if r is None else [route for route in r.split(",") if route]
+
+  for logdir in listdir_by_creation(u.root):
+    path = os.path.join(u.root, logdir)
+    try:
+      names = os.listdir(path)
+    except OSError:
+      continue
+
+    if any(name.endswith(".lock") for name in names):
+      continue
+
+    # listdir order isn't defined, the index orders files of the same priority by name
+    for name in sorted(sorted(names), key=lambda n: u.immediate_priority.get(n, 1000)):
+      fn = os.path.join(path, name)
+      try:
+        ctime = os.path.getctime(fn)
+        is_uploaded = getxattr(fn, UPLOAD_ATTR_NAME) == UPLOAD_ATTR_VALUE
+      except OSError:
+        continue
+      if is_uploaded:
+        continue
+
+      if metered:
+        if logdir in u.immediate_folders and (datetime.datetime.now() - datetime.datetime.fromtimestamp(ctime)) < datetime.timedelta(hours=12):
+          continue
+        if name == "qcamera.ts" and not any(logdir.startswith(r.split('|')[-1]) for r in requested_routes):
+          continue
+
+      yield name, os.path.join(logdir, name), fn
+
+
+def next_file_from_listing(u: Uploader, metered: bool) -> tuple[str, str, str] | None:
+  upload_files = list(list_upload_files(u, metered))
+  for name, key, fn in upload_files:
+    if any(f in fn for f in u.immediate_folders):
+      return name, key, fn
+  for name, key, fn in upload_files:
+    if name in u.immediate_priority:
+      return name, key, fn
+  return None
+
+
+class TestUploadIndex(UploaderTestCase):
+  def setup_method(self):
+    super().openpilot_setup_method()
+    self.locked_dir = self.seg_format2.format(2)
+
+  def gen_segments(self, seg_nums: list[int]) -> None:
+    for i in seg_nums:
+      for seg_format in (self.seg_format, self.seg_format2):
+        seg_dir = seg_format.format(i)
+        for name in ("qlog", "rlog", "qcamera.ts", "fcamera.hevc"):
+          # one qlog was already uploaded, and one segment is still being written
+          xattr = UPLOAD_ATTR_VALUE if name == "qlog" and i == 1 else None
+          self.make_file_with_data(seg_dir, name, 0.01, lock=name == "rlog" and seg_dir == self.locked_dir, upload_xattr=xattr)
+        self.make_file_with_data("boot", seg_dir, 0.01)
+
+  def upload_all(self, u: Uploader, metered: bool) -> list[str]:
+    """Uploads the files picked by the index, checking it picks the same file as listing every segment"""
+    keys = []
+    while True:
+      expected = next_file_from_listing(u, metered)
+      assert u.next_file_to_upload(metered) == expected
+      if expected is None:
+        return keys
+      setxattr(expected[2], UPLOAD_ATTR_NAME, UPLOAD_ATTR_VALUE)
+      keys.append(expected[1])
+
+  def test_matches_listing(self):
+    self.gen_segments([0, 1, 2, 3])
+    route1, route2 = (seg_format.rsplit("--", 1)[0] for seg_format in (self.seg_format, self.seg_format2))
+    self.params.put("AthenadRecentlyViewedRoutes", f"0000000000000000|{route2}")
+    u = Uploader("0000000000000000", Paths.log_root())
+
+    # on metered networks only the qcameras of the requested routes are uploaded
+    metered_keys = self.upload_all(u, True)
+    qcameras = [k for k in metered_keys if k.endswith("qcamera.ts")]
+    assert len(qcameras) == 3 and all(k.startswith(route2) for k in qcameras)
+
+    keys = self.upload_all(u, False)
+    assert [k for k in keys if not k.startswith(route1)] == []
+    assert len(keys) == 4
+
+    # files in locked directories are skipped, until the lock is removed
+    assert not any(k.startswith(self.locked_dir) for k in metered_keys + keys)
+    os.unlink(Path(Paths.log_root()) / self.locked_dir / "rlog.lock")
+    assert self.upload_all(u, False) == [f"{self.locked_dir}/qlog", f"{self.locked_dir}/qcamera.ts"]
+
+  def test_concurrent_uploads(self, mocker):
+    self.gen_segments([0, 1, 2, 3])
+    mocker.patch.object(uploader, "fake_upload", False)
+    log_handler.reset()
+    u = Uploader("0000000000000000", Paths.log_root())
+    index = u.index
+    order = [os.path.join(e[3], e[2]) for e in index.immediate + sorted(index.priority + index.qcameras) if e[3] != self.locked_dir]
+
+    with UploadServer(rate=50 * 1024) as server:
+      def get_upload_url(*args, path, **kwargs):
+        return MockResponse(json.dumps({"url": f"{server.url}/{path}", "headers": {}}), 200)
+      mocker.patch.object(u.api, "get", side_effect=get_upload_url)
+      while u.step(NetworkType.wifi, False) is not None:
+        time.sleep(0.01)
+
+      # the files are started and marked uploaded in priority order, with every worker busy
+      assert [key.removesuffix(".zst") for key in log_handler.upload_order] == order
+      assert len(server.blobs) == len(order)
+      assert server.peak_concurrency == u.engine.num_workers > 1
+      assert u.next_file_to_upload(False) is None
+
+  def test_restart(self, mocker):
+    self.gen_segments([0, 1, 2])
+    u = Uploader("0000000000000000", Paths.log_root())
+    self.upload_all(u, False)
+    u.index.save()
+    done = {seg_format.format(i) for seg_format in (self.seg_format, self.seg_format2) for i in range(3)} - {self.locked_dir}
+    assert u.index.done == done
+
+    # segments fully uploaded before the restart are skipped
+    new_dir = self.seg_format.format(3)
+    self.make_file_with_data(new_dir, "qlog", 0.01)
+    add_dir = mocker.patch.object(uploader.UploadIndex, "_add_dir", autospec=True, side_effect=uploader.UploadIndex._add_dir)
+    u = Uploader("0000000000000000", Paths.log_root())
+    assert self.upload_all(u, False) == [f"{new_dir}/qlog"]
+    scanned = {call.args[1] for call in add_dir.call_args_list}
+    assert scanned.isdisjoint(done)
+    assert {"boot", self.locked_dir, new_dir} <= scanned
+    assert u.index.done == done | {new_dir}
+
+    # segments deleted while the uploader was down are dropped from the saved index
+    u.index.save()
+    deleted = self.seg_format.format(0)
+    shutil.rmtree(Path(Paths.log_root()) / deleted)
+    u = Uploader("0000000000000000", Paths.log_root())
+    assert u.index.done == (done | {new_dir}) - {deleted}
+    u.index.save()
+    assert uploader.UploadIndex(Paths.log_root(), u.immediate_folders, u.immediate_priority, self.params).done == u.index.done
+
+    # without inotify every update rescans, which also drops deleted segments
+    mocker.patch.object(uploader, "Inotify", side_effect=OSError)
+    u = Uploader("0000000000000000", Paths.log_root())
+    deleted = self.seg_format.format(1)
+    assert deleted in u.index.done
+    shutil.rmtree(Path(Paths.log_root()) / deleted)
+    u.index.update()
+    assert deleted not in u.index.done
+    done -= {self.seg_format.format(0), deleted}
+
+    # the saved index of another log root is ignored
+    self.params.put("UploaderIndex", {"root": "/data/other", "done": {self.seg_format.rsplit("--", 1)[0]: [0, 1, 2]}})
+    add_dir.reset_mock()
+    u = Uploader("0000000000000000", Paths.log_root())
+    assert self.upload_all(u, False) == []
+    assert done <= {call.args[1] for call in add_dir.call_args_list}
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the upload destination. Accepts plain PUTs and Azure style block uploads
+(?comp=block&blockid=..., then ?comp=blocklist), with injectable failures and a receive rate limit.
+"""
+import argparse
+import base64
+import http.server
+import re
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+
+
+class UploadServer(http.server.ThreadingHTTPServer):
+  daemon_threads = True
+
+  def __init__(self, host: str = "127.0.0.1", port: int = 0, rate: float | None = None):
+    super().__init__((host, port), UploadRequestHandler)
+    self.rate = rate  # bytes per second received per request, None is unlimited
+    self.lock = threading.Lock()
+    self.blobs: dict[str, bytes] = {}
+    self.blocks: dict[str, dict[str, bytes]] = {}
+    self.requests: list[tuple[str, str]] = []  # (path, query)
+    self.fail_requests: set[int] = set()  # indices into requests to respond to with fail_status
+    self.fail_status = 500
+    self.peak_concurrency = 0
+    self._active = 0
+    self._thread: threading.Thread | None = None
+
+  @property
+  def url(self) -> str:
+    host, port = self.server_address[:2]
+    return f"http://{host}:{port}"
+
+  def __enter__(self):
+    self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+    self._thread.start()
+    return self
+
+  def __exit__(self, *args) -> None:
+    self.shutdown()
+    self.server_close()
+    if self._thread is not None:
+      self._thread.join()
+
+
+class UploadRequestHandler(http.server.BaseHTTPRequestHandler):
+  protocol_version = "HTTP/1.1"  # keep-alive, to exercise connection reuse
+  server: UploadServer
+
+  def log_message(self, *args):
+    pass
+
+  def _respond(self, status: int) -> None:
+    self.send_response(status)
+    self.send_header("Content-Length", "0")
+    self.end_headers()
+
+  def _read_body(self) -> bytes:
+    length = int(self.headers["Content-Length"])
+    body = bytearray()
+    start = time.monotonic()
+    while len(body) < length:
+      body += self.rfile.read(min(64 * 1024, length - len(body)))
+      if self.server.rate is not None:
+        time.sleep(max(len(body) / self.server.rate - (time.monotonic() - start), 0))
+    return bytes(body)
+
+  def do_PUT(self):
+    url = urlparse(self.path)
+    query = parse_qs(url.query)
+    with self.server.lock:
+      fail = len(self.server.requests) in self.server.fail_requests
+      self.server.requests.append((url.path, url.query))
+      self.server._active += 1
+      self.server.peak_concurrency = max(self.server.peak_concurrency, self.server._active)
+
+    try:
+      body = self._read_body()
+      if fail:
+        return self._respond(self.server.fail_status)
+
+      comp = query.get("comp", [None])[0]
+      with self.server.lock:
+        if comp == "block":
+          block_id = query["blockid"][0]
+          base64.b64decode(block_id, validate=True)
+          self.server.blocks.setdefault(url.path, {})[block_id] = body
+        elif comp == "blocklist":
+          blocks = self.server.blocks.get(url.path, {})
+          block_ids = re.findall(r"<Latest>([^<]*)</Latest>", body.decode())
+          if not all(b in blocks for b in block_ids):
+            return self._respond(400)
+          self.server.blobs[url.path] = b"".join(blocks[b] for b in block_ids)
+          del self.server.blocks[url.path]
+        else:
+          self.server.blobs[url.path] = body
+      self._respond(201)
+    finally:
+      with self.server.lock:
+        self.server._active -= 1
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Local upload destination for testing uploads",
+                                   formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument("--host", default="127.0.0.1")
+  parser.add_argument("--port", type=int, default=8080)
+  parser.add_argument("--rate", type=float, help="receive rate limit per request, in bytes per second")
+  args = parser.parse_args()
+
+  with UploadServer(args.host, args.port, args.rate) as server:
+    print(f"accepting uploads on {server.url}")
+    while True:
+      time.sleep(10)
+      with server.lock:
+        print(f"{len(server.blobs)} blobs, {sum(len(b) for b in server.blobs.values()) / 1e6:.1f} MB, {len(server.requests)} requests")
@@ -0,0 +1,201 @@
+import base64
+import io
+import os
+import socket
+import threading
+import time
+from collections.abc import Callable
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import TypeVar
+
+import requests
+from requests.adapters import HTTPAdapter, DEFAULT_POOLBLOCK
+
+from openpilot.common.utils import discard_upload_stream, get_upload_stream
+from openpilot.common.swaglog import cloudlog
+
+# https://bytesolutions.com/dscp-tos-cos-precedence-conversion-chart,
+# https://en.wikipedia.org/wiki/Differentiated_services
+UPLOAD_TOS = 0x20  # CS1, low priority background traffic
+
+UPLOAD_WORKERS = int(os.getenv("UPLOAD_WORKERS", "4"))
+# bytes per second shared by all uploads of a process, None is unlimited
+UPLOAD_RATE_METERED = float(os.getenv("UPLOAD_RATE_METERED", str(256 * 1024)))
+UPLOAD_RATE_UNMETERED = float(os.environ["UPLOAD_RATE_UNMETERED"]) if "UPLOAD_RATE_UNMETERED" in os.environ else None
+
+CHUNK_SIZE = 64 * 1024  # bytes sent, and rate limited, at a time
+BLOCK_SIZE = 4 * 1024 * 1024  # size of the blocks of resumable uploads
+BLOCK_UPLOAD_MIN_SIZE = 2 * BLOCK_SIZE  # smaller files are sent in one request
+BLOCK_RETRIES = 3  # attempts per block before the upload fails, and is resumed by the next one
+
+OK_STATUS_CODES = (200, 201)
+
+T = TypeVar("T")
+
+
+class UploadTOSAdapter(HTTPAdapter):
+  def init_poolmanager(self, connections, maxsize, block=DEFAULT_POOLBLOCK, **pool_kwargs):
+    pool_kwargs["socket_options"] = [(socket.IPPROTO_IP, socket.IP_TOS, UPLOAD_TOS)]
+    super().init_poolmanager(connections, maxsize, block, **pool_kwargs)
+
+
+class TokenBucket:
+  """Limits consume() to rate units per second on average, in bursts of up to burst units. A rate of None is unlimited."""
+
+  def __init__(self, rate: float | None = None, burst: float = 4 * CHUNK_SIZE):
+    self.lock = threading.Lock()
+    self.rate = rate
+    self.burst = burst
+    self.tokens = burst
+    self.last = time.monotonic()
+
+  def set_rate(self, rate: float | None) -> None:
+    with self.lock:
+      self._refill()
+      self.rate = rate
+
+  def _refill(self) -> None:
+    now = time.monotonic()
+    if self.rate is not None:
+      self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+    else:
+      self.tokens = self.burst
+    self.last = now
+
+  def consume(self, n: float) -> None:
+    """Blocks until n units are available. Requests larger than burst go through once the bucket is full."""
+    while True:
+      with self.lock:
+        self._refill()
+        if self.rate is None or self.tokens >= min(n, self.burst):
+          self.tokens -= n
+          return
+        wait = (min(n, self.burst) - self.tokens) / self.rate if self.rate > 0 else 1.
+      # wake up periodically to pick up rate changes
+      time.sleep(min(wait, 0.1))
+
+
+class RateLimitedReader:
+  """Wraps a file, reading at most CHUNK_SIZE bytes at a time at the rate allowed by limiter,
+  and calling callback(total, offset + bytes read so far) after each read."""
+
+  def __init__(self, f, limiter: TokenBucket, callback: Callable | None = None, total: int = 0, offset: int = 0):
+    self.f = f
+    self.limiter = limiter
+    self.callback = callback
+    self.total = total
+    self.total_read = offset
+
+  def __getattr__(self, attr):
+    return getattr(self.f, attr)
+
+  def read(self, size: int = -1) -> bytes:
+    size = CHUNK_SIZE if size is None or size < 0 else min(size, CHUNK_SIZE)
+    chunk = self.f.read(size)
+    self.limiter.consume(len(chunk))
+    self.total_read += len(chunk)
+    if self.callback is not None:
+      self.callback(self.total, self.total_read)
+    return chunk
+
+
+class UploadEngine:
+  """Uploads files over a connection reusing session, sharing a bandwidth limit set by the network type.
+  Up to num_workers uploads run at once without opening new connections, on its threads with submit(), or on the caller's.
+
+  Files of at least BLOCK_UPLOAD_MIN_SIZE going to an Azure block blob are sent as blocks and committed with a block list.
+  The blocks that made it are remembered, so a failed upload resumes where it stopped when retried for the same blob.
+  """
+
+  def __init__(self, num_workers: int = UPLOAD_WORKERS, rate: float | None = UPLOAD_RATE_UNMETERED):
+    self.num_workers = num_workers
+    self.session = requests.Session()
+    self.session.mount("http://", UploadTOSAdapter(pool_maxsize=num_workers))
+    self.session.mount("https://", UploadTOSAdapter(pool_maxsize=num_workers))
+    self.limiter = TokenBucket(rate)
+
+    self._lock = threading.Lock()
+    self._executor: ThreadPoolExecutor | None = None
+    # uploaded, uncommitted block ids by (blob url, file, size)
+    self._blocks: dict[tuple[str, str, int], set[str]] = {}
+
+  def set_network(self, metered: bool) -> None:
+    self.limiter.set_rate(UPLOAD_RATE_METERED if metered else UPLOAD_RATE_UNMETERED)
+
+  def submit(self, upload: Callable[..., T], *args) -> Future[T]:
+    """Runs upload(*args) on one of num_workers threads, upload being upload() or a function calling it, like one getting the url first"""
+    with self._lock:
+      if self._executor is None:
+        self._executor = ThreadPoolExecutor(max_workers=self.num_workers, thread_name_prefix="upload")
+    return self._executor.submit(upload, *args)
+
+  def upload(self, url: str, headers: dict[str, str], fn: str, compress: bool = False, callback: Callable | None = None,
+             timeout: float = 30) -> requests.Response:
+    """PUTs fn, zstd compressed if compress, to url. callback(size, bytes sent) is called as the upload progresses.
+    Returns the response of the last request, for a block upload that's the one committing the block list."""
+    stream = None
+    try:
+      stream, size = get_upload_stream(fn, compress)
+      if size >= BLOCK_UPLOAD_MIN_SIZE and headers.get("x-ms-blob-type") == "BlockBlob":
+        response = self._upload_blocks(url, headers, fn, stream, size, callback, timeout)
+      else:
+        response = self.session.put(url,
+                                    data=RateLimitedReader(stream, self.limiter, callback, size),
+                                    headers={**headers, 'Content-Length': str(size)},
+                                    timeout=timeout)
+    finally:
+      if stream:
+        stream.close()
+
+    # the compressed file is only kept for retrying a failed upload
+    if compress and response.status_code in OK_STATUS_CODES:
+      discard_upload_stream(fn)
+    return response
+
+  def _upload_blocks(self, url: str, headers: dict[str, str], fn: str, stream: io.BufferedIOBase, size: int,
+                     callback: Callable | None, timeout: float) -> requests.Response:
+    # https://learn.microsoft.com/en-us/rest/api/storageservices/put-block
+    # the blob headers apply to the blob created by the block list, the blocks are sent without them
+    blob_headers = {k: v for k, v in headers.items() if k.lower() != "x-ms-blob-type"}
+    sep = "&" if "?" in url else "?"
+    key = (url.partition("?")[0], fn, size)
+    with self._lock:
+      done = self._blocks.setdefault(key, set())
+
+    block_ids = []
+    for i, offset in enumerate(range(0, size, BLOCK_SIZE)):
+      block_id = base64.b64encode(f"{i:08d}".encode()).decode()
+      block_ids.append(block_id)
+      length = min(BLOCK_SIZE, size - offset)
+      if block_id in done:
+        continue
+
+      for attempt in range(BLOCK_RETRIES):
+        stream.seek(offset)
+        data = RateLimitedReader(io.BytesIO(stream.read(length)), self.limiter, callback, size, offset)
+        try:
+          response = self.session.put(f"{url}{sep}comp=block&blockid={requests.utils.quote(block_id, safe='')}",
+                                      data=data, headers={'Content-Length': str(length)}, timeout=timeout)
+        except (requests.exceptions.Timeout, requests.exceptions.ConnectionError):
+          if attempt == BLOCK_RETRIES - 1:
+            raise
+          continue
+
+        if response.status_code in OK_STATUS_CODES:
+          done.add(block_id)
+          break
+        # client errors, such as an expired signature, aren't fixed by retrying
+        if response.status_code < 500 or attempt == BLOCK_RETRIES - 1:
+          cloudlog.event("upload_engine.block_failed", fn=fn, block=i, status_code=response.status_code)
+          return response
+
+    if callback is not None:
+      callback(size, size)
+
+    block_list = "".join(f"<Latest>{block_id}</Latest>" for block_id in block_ids)
+    body = f'<?xml version="1.0" encoding="utf-8"?><BlockList>{block_list}</BlockList>'.encode()
+    response = self.session.put(f"{url}{sep}comp=blocklist", data=body, headers={**blob_headers, 'Content-Length': str(len(body))}, timeout=timeout)
+    if response.status_code in OK_STATUS_CODES:
+      with self._lock:
+        self._blocks.pop(key, None)
+    return response
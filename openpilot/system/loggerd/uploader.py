@@ -2,20 +2,24 @@
 import json
 import os
 import random
-import requests
 import threading
 import time
 import traceback
 import datetime
-from collections.abc import Iterator
+from bisect import bisect_left
+from collections import defaultdict
+from collections.abc import Container
+from concurrent.futures import Future
 
 from openpilot.cereal import log
 import openpilot.cereal.messaging as messaging
 from openpilot.common.api import Api
-from openpilot.common.utils import get_upload_stream
+from openpilot.common.inotify import Inotify, IN_ATTRIB, IN_CLOSE_WRITE, IN_CREATE, IN_DELETE, IN_DELETE_SELF, IN_IGNORED, IN_ISDIR, \
+                                     IN_MOVED_FROM, IN_MOVED_TO, IN_ONLYDIR, IN_Q_OVERFLOW
 from openpilot.common.params import Params
 from openpilot.common.realtime import set_core_affinity
 from openpilot.common.hardware.hw import Paths
+from openpilot.system.loggerd.upload_engine import UploadEngine
 from openpilot.system.loggerd.xattr_cache import getxattr, setxattr
 from openpilot.common.swaglog import cloudlog
 
@@ -29,6 +33,11 @@ MAX_UPLOAD_SIZES = {
   "qcam": 5*1e6,
 }
 
+ROOT_WATCH_MASK = IN_CREATE | IN_MOVED_TO | IN_DELETE | IN_MOVED_FROM | IN_DELETE_SELF | IN_ONLYDIR
+DIR_WATCH_MASK = IN_CREATE | IN_MOVED_TO | IN_CLOSE_WRITE | IN_DELETE | IN_MOVED_FROM | IN_ATTRIB | IN_ONLYDIR
+# seconds between saving the fully uploaded segments
+INDEX_SAVE_INTERVAL = 60.
+
 allow_sleep = bool(int(os.getenv("UPLOADER_SLEEP", "1")))
 force_wifi = os.getenv("FORCEWIFI") is not None
 fake_upload = os.getenv("FAKEUPLOAD") is not None
@@ -71,6 +80,209 @@ def clear_locks(root: str) -> None:
       cloudlog.exception("clear_locks failed")
 
 
+class UploadIndex:
+  """
+  The files the uploader may upload, in upload order, kept up to date with inotify instead of listing every
+  segment and reading every file's xattr on each upload. It's seeded with a scan of the log root, which skips the
+  segments fully uploaded before a restart, saved to the UploaderIndex param. Only directories with files left to
+  upload, locked directories and the immediate folders are watched. Without inotify every update is a rescan.
+  """
+  def __init__(self, root: str, immediate_folders: list[str], immediate_priority: dict[str, int], params: Params):
+    self.root = root
+    self.immediate_folders = immediate_folders
+    self.immediate_priority = immediate_priority
+    self.params = params
+
+    self.done = self._load_done()
+    self.last_save = 0.
+    self.inotify: Inotify | None = None
+    self.seed()
+
+  def _load_done(self) -> set[str]:
+    index = self.params.get("UploaderIndex")
+    if not isinstance(index, dict) or index.get("root") != self.root:
+      return set()
+    return {f"{route}--{seg}" for route, segs in index["done"].items() for seg in segs}
+
+  def save(self) -> None:
+    done = defaultdict(list)
+    for logdir in self.done:
+      route, _, seg = logdir.rpartition("--")
+      done[route].append(int(seg))
+    self.params.put("UploaderIndex", {"root": self.root, "done": {route: sorted(segs) for route, segs in done.items()}})
+    self.last_save = time.monotonic()
+
+  def seed(self) -> None:
+    # (directory sort, priority, name, directory) of files in the immediate folders, qcameras, and other priority files
+    self.immediate: list[tuple] = []
+    self.qcameras: list[tuple] = []
+    self.priority: list[tuple] = []
+    self.pending: defaultdict[str, int] = defaultdict(int)
+    self.locks: defaultdict[str, set[str]] = defaultdict(set)
+    self.watches: dict[int, str] = {}
+
+    if self.inotify is not None:
+      self.inotify.close()
+    try:
+      self.inotify = Inotify()
+      self.inotify.add_watch(self.root, ROOT_WATCH_MASK)
+    except OSError:
+      self.inotify = None
+
+    logdirs = listdir_by_creation(self.root)
+    # forget the segments deleted while not watching the log root, such as before a restart
+    self.done &= set(logdirs)
+    for logdir in logdirs:
+      # empty directories are segments that were just created
+      if logdir not in self.done and self._add_dir(logdir):
+        self._check_done(logdir)
+
+  def is_immediate(self, fn: str) -> bool:
+    return any(f in fn for f in self.immediate_folders)
+
+  def _entry(self, logdir: str, name: str) -> tuple:
+    return tuple(get_directory_sort(logdir)), self.immediate_priority.get(name, 1000), name, logdir
+
+  def _list(self, logdir: str, name: str) -> list[tuple] | None:
+    if self.is_immediate(os.path.join(self.root, logdir, name)):
+      return self.immediate
+    elif name == "qcamera.ts":
+      return self.qcameras
+    elif name in self.immediate_priority:
+      return self.priority
+    return None
+
+  def _add_dir(self, logdir: str) -> int:
+    path = os.path.join(self.root, logdir)
+    if self.inotify is not None:
+      try:
+        self.watches[self.inotify.add_watch(path, DIR_WATCH_MASK)] = logdir
+      except FileNotFoundError:
+        return 0
+      except OSError:
+        cloudlog.exception("uploader: failed to watch %s", path)
+    try:
+      names = os.listdir(path)
+    except OSError:
+      return 0
+    for name in names:
+      self._add_file(logdir, name)
+    return len(names)
+
+  def _add_file(self, logdir: str, name: str) -> None:
+    if name.endswith(".lock"):
+      self.locks[logdir].add(name)
+      return
+
+    files = self._list(logdir, name)
+    if files is None:
+      return
+    entry = self._entry(logdir, name)
+    i = bisect_left(files, entry)
+    if i < len(files) and files[i] == entry:
+      return
+
+    fn = os.path.join(self.root, logdir, name)
+    try:
+      if getxattr(fn, UPLOAD_ATTR_NAME) == UPLOAD_ATTR_VALUE:
+        return
+    except OSError:
+      return
+    files.insert(i, entry)
+    self.pending[logdir] += 1
+    self.done.discard(logdir)
+
+  def remove(self, logdir: str, name: str) -> None:
+    if name.endswith(".lock"):
+      self.locks[logdir].discard(name)
+      self._check_done(logdir)
+      return
+
+    files = self._list(logdir, name)
+    if files is None:
+      return
+    entry = self._entry(logdir, name)
+    i = bisect_left(files, entry)
+    if i < len(files) and files[i] == entry:
+      del files[i]
+      self.pending[logdir] -= 1
+      self._check_done(logdir)
+
+  def _remove_dir(self, logdir: str) -> None:
+    for files in (self.immediate, self.qcameras, self.priority):
+      files[:] = [e for e in files if e[3] != logdir]
+    self.pending.pop(logdir, None)
+    self.locks.pop(logdir, None)
+    self.done.discard(logdir)
+    for wd in [wd for wd, d in self.watches.items() if d == logdir]:
+      del self.watches[wd]
+
+  def _check_done(self, logdir: str) -> None:
+    # segments are written once, stop watching them when everything is uploaded
+    if self.pending[logdir] > 0 or len(self.locks[logdir]) or self.is_immediate(os.path.join(self.root, logdir, "")):
+      return
+    del self.pending[logdir], self.locks[logdir]
+    if logdir.rpartition("--")[0]:
+      self.done.add(logdir)
+    for wd in [wd for wd, d in self.watches.items() if d == logdir]:
+      del self.watches[wd]
+      if self.inotify is not None:
+        self.inotify.rm_watch(wd)
+
+  def update(self) -> None:
+    if self.inotify is None:
+      self.seed()
+    else:
+      self._read_events()
+
+    if time.monotonic() - self.last_save > INDEX_SAVE_INTERVAL:
+      self.save()
+
+  def _read_events(self) -> None:
+    assert self.inotify is not None
+    for wd, mask, _, name in self.inotify.read():
+      if mask & (IN_Q_OVERFLOW | IN_DELETE_SELF):
+        self.seed()
+        return
+
+      logdir = self.watches.get(wd)
+      if logdir is None:
+        # the log root
+        if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+          self._add_dir(name)
+        elif mask & IN_ISDIR and mask & (IN_DELETE | IN_MOVED_FROM):
+          self._remove_dir(name)
+      elif mask & IN_IGNORED:
+        self._remove_dir(logdir)
+      elif mask & (IN_DELETE | IN_MOVED_FROM):
+        self.remove(logdir, name)
+      elif mask & IN_ATTRIB:
+        if name.endswith(".lock"):
+          continue
+        # read from disk, xattr_cache holds the value from before the change if the file was marked
+        # uploaded by another process, such as athenad
+        try:
+          uploaded = getxattr(os.path.join(self.root, logdir, name), UPLOAD_ATTR_NAME, cached=False) == UPLOAD_ATTR_VALUE
+        except OSError:
+          uploaded = False
+        if uploaded:
+          self.remove(logdir, name)
+      else:
+        self._add_file(logdir, name)
+
+  def first(self, files: list[tuple], route: str | None = None, skip: Container[str] = ()) -> tuple | None:
+    """First file not in a locked directory nor in skip, optionally of a route, the files of which are contiguous"""
+    i = 0 if route is None else bisect_left(files, ((route.rjust(10, '0'),),))
+    while i < len(files):
+      entry = files[i]
+      if route is not None and not entry[3].startswith(route):
+        break
+      if not len(self.locks.get(entry[3], ())) and os.path.join(self.root, entry[3], entry[2]) not in skip:
+        return entry
+      i += 1
+    return None
+
+
 class Uploader:
   def __init__(self, dongle_id: str, root: str):
     self.dongle_id = dongle_id
@@ -84,58 +296,54 @@ class Uploader:
 
     self.immediate_folders = ["crash/", "boot/"]
     self.immediate_priority = {"qlog": 0, "qlog.zst": 0, "qcamera.ts": 1}
+    self._index: UploadIndex | None = None
+    # up to engine.num_workers files are uploaded at once, started in priority order
+    self.engine = UploadEngine()
+    # (key, size, network type, metered, upload) by file, in the order they were started
+    self.uploads: dict[str, tuple[str, int, int, bool, Future]] = {}
+
+  @property
+  def index(self) -> UploadIndex:
+    # created on first use, to seed after locks are cleared
+    if self._index is None:
+      self._index = UploadIndex(self.root, self.immediate_folders, self.immediate_priority, self.params)
+    return self._index
 
-  def list_upload_files(self, metered: bool) -> Iterator[tuple[str, str, str]]:
-    r = self.params.get("AthenadRecentlyViewedRoutes")
-    requested_routes = [] if r is None else [route for route in r.split(",") if route]
-
-    for logdir in listdir_by_creation(self.root):
-      path = os.path.join(self.root, logdir)
-      try:
-        names = os.listdir(path)
-      except OSError:
-        continue
-
-      if any(name.endswith(".lock") for name in names):
+  def next_file_to_upload(self, metered: bool) -> tuple[str, str, str] | None:
+    """
+    The first file in an immediate folder, or else the first priority file, in segment order. Files being uploaded and
+    files in locked directories are skipped, and on metered networks so are the qcameras of routes not in
+    AthenadRecentlyViewedRoutes.
+    """
+    index = self.index
+    index.update()
+
+    for entry in index.immediate:
+      logdir, name = entry[3], entry[2]
+      fn = os.path.join(self.root, logdir, name)
+      if len(index.locks.get(logdir, ())) or fn in self.uploads:
         continue
-
-      for name in sorted(names, key=lambda n: self.immediate_priority.get(n, 1000)):
-        key = os.path.join(logdir, name)
-        fn = os.path.join(path, name)
-        # skip files already uploaded
+      if metered and logdir in self.immediate_folders:
         try:
-          ctime = os.path.getctime(fn)
-          is_uploaded = getxattr(fn, UPLOAD_ATTR_NAME) == UPLOAD_ATTR_VALUE
+          if (datetime.datetime.now() - datetime.datetime.fromtimestamp(os.path.getctime(fn))) < datetime.timedelta(hours=12):
+            continue
         except OSError:
-          cloudlog.event("uploader_getxattr_failed", key=key, fn=fn)
-          # deleter could have deleted, so skip
           continue
-        if is_uploaded:
-          continue
-
-        # limit uploading on metered connections
-        if metered:
-          dt = datetime.timedelta(hours=12)
-          if logdir in self.immediate_folders and (datetime.datetime.now() - datetime.datetime.fromtimestamp(ctime)) < dt:
-            continue
-
-          if name == "qcamera.ts" and not any(logdir.startswith(r.split('|')[-1]) for r in requested_routes):
-            continue
-
-        yield name, key, fn
-
-  def next_file_to_upload(self, metered: bool) -> tuple[str, str, str] | None:
-    upload_files = list(self.list_upload_files(metered))
-
-    for name, key, fn in upload_files:
-      if any(f in fn for f in self.immediate_folders):
-        return name, key, fn
+      return name, os.path.join(logdir, name), fn
 
-    for name, key, fn in upload_files:
-      if name in self.immediate_priority:
-        return name, key, fn
+    candidates = [index.first(index.priority, skip=self.uploads)]
+    if not metered:
+      candidates.append(index.first(index.qcameras, skip=self.uploads))
+    else:
+      r = self.params.get("AthenadRecentlyViewedRoutes")
+      requested_routes = [] if r is None else [route for route in r.split(",") if route]
+      candidates += [index.first(index.qcameras, route.split('|')[-1], self.uploads) for route in requested_routes]
 
-    return None
+    entry = min((c for c in candidates if c is not None), default=None)
+    if entry is None:
+      return None
+    logdir, name = entry[3], entry[2]
+    return name, os.path.join(logdir, name), os.path.join(self.root, logdir, name)
 
   def do_upload(self, key: str, fn: str):
     url_resp = self.api.get("v1.4/" + self.dongle_id + "/upload_url/", timeout=10, path=key, access_token=self.api.get_token())
@@ -150,17 +358,22 @@ class Uploader:
     if fake_upload:
       return FakeResponse()
 
-    stream = None
+    compress = key.endswith('.zst') and not fn.endswith('.zst')
+    return self.engine.upload(url, headers, fn, compress, timeout=10)
+
+  def _send(self, key: str, fn: str) -> tuple[object, tuple | None, float]:
+    # runs on the engine's threads, returns the response or the exception, and how long it took
+    start_time = time.monotonic()
     try:
-      compress = key.endswith('.zst') and not fn.endswith('.zst')
-      stream, _ = get_upload_stream(fn, compress)
-      response = requests.put(url, data=stream, headers=headers, timeout=10)
-      return response
-    finally:
-      if stream:
-        stream.close()
-
-  def upload(self, name: str, key: str, fn: str, network_type: int, metered: bool) -> bool:
+      return self.do_upload(key, fn), None, time.monotonic() - start_time
+    except Exception as e:
+      return None, (e, traceback.format_exc()), time.monotonic() - start_time
+
+  def upload(self, name: str, key: str, fn: str, network_type: int, metered: bool) -> bool | None:
+    """
+    Starts uploading fn on the engine's threads, it's finished by finish_uploads(). Files that aren't sent, because
+    they're empty or too large, are finished right away, returning whether that succeeded.
+    """
     try:
       sz = os.path.getsize(fn)
     except OSError:
@@ -168,26 +381,32 @@ class Uploader:
       return False
 
     cloudlog.event("upload_start", key=key, fn=fn, sz=sz, network_type=network_type, metered=metered)
+    self.engine.set_network(metered)
 
     if sz == 0:
       # tag files of 0 size as uploaded
-      success = True
+      return self._mark_uploaded(key, fn, sz)
     elif name in MAX_UPLOAD_SIZES and sz > MAX_UPLOAD_SIZES[name]:
       cloudlog.event("uploader_too_large", key=key, fn=fn, sz=sz)
-      success = True
-    else:
-      start_time = time.monotonic()
+      return self._mark_uploaded(key, fn, sz)
 
-      stat = None
-      last_exc = None
-      try:
-        stat = self.do_upload(key, fn)
-      except Exception as e:
-        last_exc = (e, traceback.format_exc())
+    self.uploads[fn] = (key, sz, network_type, metered, self.engine.submit(self._send, key, fn))
+    return None
 
+  def finish_uploads(self) -> bool | None:
+    """
+    Handles the uploads that are done, in the order they were started so files are marked uploaded in priority order.
+    Returns whether they all succeeded, None if there weren't any.
+    """
+    success = None
+    for fn, (key, sz, network_type, metered, future) in list(self.uploads.items()):
+      if not future.done():
+        break
+      del self.uploads[fn]
+
+      stat, last_exc, dt = future.result()
       if stat is not None and stat.status_code in (200, 201, 401, 403, 412):
         self.last_filename = fn
-        dt = time.monotonic() - start_time
         if stat.status_code == 412:
           cloudlog.event("upload_ignored", key=key, fn=fn, sz=sz, network_type=network_type, metered=metered)
         else:
@@ -195,33 +414,49 @@ class Uploader:
           speed = (content_length / 1e6) / dt
           cloudlog.event("upload_success", key=key, fn=fn, sz=sz, content_length=content_length,
                          network_type=network_type, metered=metered, speed=speed)
-        success = True
+        uploaded = self._mark_uploaded(key, fn, sz, last_exc)
       else:
-        success = False
+        uploaded = False
         cloudlog.event("upload_failed", stat=stat, exc=last_exc, key=key, fn=fn, sz=sz, network_type=network_type, metered=metered)
-
-    if success:
-      # tag file as uploaded
-      try:
-        setxattr(fn, UPLOAD_ATTR_NAME, UPLOAD_ATTR_VALUE)
-      except OSError:
-        cloudlog.event("uploader_setxattr_failed", exc=last_exc, key=key, fn=fn, sz=sz)
-
+      success = uploaded if success is None else success and uploaded
     return success
 
+  def _mark_uploaded(self, key: str, fn: str, sz: int, last_exc: tuple | None = None) -> bool:
+    # tag file as uploaded
+    try:
+      setxattr(fn, UPLOAD_ATTR_NAME, UPLOAD_ATTR_VALUE)
+    except OSError:
+      cloudlog.event("uploader_setxattr_failed", exc=last_exc, key=key, fn=fn, sz=sz)
+    if self._index is not None:
+      self._index.remove(*os.path.split(os.path.relpath(fn, self.root)))
+    return True
 
   def step(self, network_type: int, metered: bool) -> bool | None:
-    d = self.next_file_to_upload(metered)
-    if d is None:
-      return None
-
-    name, key, fn = d
-
-    # qlogs and bootlogs need to be compressed before uploading
-    if key.endswith(('qlog', 'rlog')) or (key.startswith('boot/') and not key.endswith('.zst')):
-      key += ".zst"
-
-    return self.upload(name, key, fn, network_type, metered)
+    """
+    Finishes the uploads that are done and starts the next files, keeping up to engine.num_workers uploads in flight.
+    Returns whether the uploads finished succeeded, True while others are in flight, and None if there's nothing to upload.
+    """
+    success = self.finish_uploads()
+    while sum(not upload[-1].done() for upload in self.uploads.values()) < self.engine.num_workers:
+      d = self.next_file_to_upload(metered)
+      if d is None:
+        break
+
+      name, key, fn = d
+      # qlogs and bootlogs need to be compressed before uploading
+      if key.endswith(('qlog', 'rlog')) or (key.startswith('boot/') and not key.endswith('.zst')):
+        key += ".zst"
+
+      finished = self.upload(name, key, fn, network_type, metered)
+      if finished is not None:
+        success = finished if success is None else success and finished
+        # the file is still next, back off instead of picking it again
+        if not finished:
+          break
+
+    if success is None and len(self.uploads):
+      return True
+    return success
 
 
 def main(exit_event: threading.Event | None = None) -> None:
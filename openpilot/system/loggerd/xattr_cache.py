@@ -51,9 +51,10 @@ def _setxattr(path: str, attr_name: str, attr_value: bytes) -> None:
 
 _cached_attributes: dict[tuple, bytes | None] = {}
 
-def getxattr(path: str, attr_name: str) -> bytes | None:
+def getxattr(path: str, attr_name: str, cached: bool = True) -> bytes | None:
+  """Returns the attribute's value, or None if it isn't set. cached=False reads it from disk, to see changes made by other processes"""
   key = (path, attr_name)
-  if key not in _cached_attributes:
+  if not cached or key not in _cached_attributes:
     try:
       response = _getxattr(path, attr_name)
     except OSError as e:
@@ -50,9 +50,9 @@ class DiskFile(io.BufferedReader):
       parts.append(self.read(r[1] - r[0]))
     return parts
 
-def FileReader(fn):
+def FileReader(fn, readahead: int = 0):
   fn = resolve_name(fn)
   if fn.startswith(("http://", "https://")):
-    return URLFile(fn)
+    return URLFile(fn, readahead=readahead)
   else:
     return DiskFile(open(fn, "rb"))
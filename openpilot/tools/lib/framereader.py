@@ -2,12 +2,18 @@ import os
 import subprocess
 import json
 import logging
-from collections.abc import Iterator
+import threading
+import zipfile
+from collections.abc import Iterator, Sequence
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
+from openpilot.common.hardware.hw import Paths
+from openpilot.common.utils import atomic_write
 from openpilot.tools.lib.filereader import FileReader, resolve_name
 from openpilot.tools.lib.exceptions import DataUnreadableError
+from openpilot.tools.lib.segment_cache import file_cache_key
 from openpilot.tools.lib.vidindex import hevc_index
 
 logger = logging.getLogger("tools")
@@ -16,19 +22,30 @@ HEVC_SLICE_B = 0
 HEVC_SLICE_P = 1
 HEVC_SLICE_I = 2
 
+
+VIDEO_INDEX_VERSION = 1
+# GOPs decoded concurrently by FrameReader.get_many, each in its own ffmpeg process
+DECODE_WORKERS = 4
+
 class LRUCache:
-  def __init__(self, capacity: int):
+  def __init__(self, capacity: int, max_bytes: int | None = None):
+    """Evicts the least recently used entries past capacity entries, or past max_bytes of numpy arrays if set"""
     self._cache: OrderedDict = OrderedDict()
     self.capacity = capacity
+    self.max_bytes = max_bytes
+    self.nbytes = 0
 
   def __getitem__(self, key):
     self._cache.move_to_end(key)
     return self._cache[key]
 
   def __setitem__(self, key, value):
+    if key in self._cache:
+      self.nbytes -= self._cache.pop(key).nbytes
     self._cache[key] = value
-    if len(self._cache) > self.capacity:
-        self._cache.popitem(last=False)
+    self.nbytes += value.nbytes
+    while len(self._cache) > self.capacity or (self.max_bytes is not None and self.nbytes > self.max_bytes and len(self._cache) > 1):
+      self.nbytes -= self._cache.popitem(last=False)[1].nbytes
 
   def __contains__(self, key):
     return key in self._cache
@@ -42,9 +59,20 @@ def assert_hvec(fn: str) -> None:
     if 'hevc' not in fn:
       raise NotImplementedError(fn)
 
-def decompress_video_data(rawdat, w, h, pix_fmt="rgb24", vid_fmt='hevc', hwaccel="auto", loglevel="info") -> np.ndarray:
+# input is fed to persistent decoder sessions in reads of this size
+SESSION_READ_SIZE = 1000 * 1000
+
+
+def frame_shape(w: int, h: int, pix_fmt: str) -> tuple[int, ...]:
+  if pix_fmt == "rgb24":
+    return (h, w, 3)
+  elif pix_fmt in ["nv12", "yuv420p"]:
+    return (h*w*3//2,)
+  raise NotImplementedError(f"Unsupported pixel format: {pix_fmt}")
+
+def ffmpeg_decode_args(pix_fmt="rgb24", vid_fmt='hevc', hwaccel="auto", loglevel="info") -> list[str]:
   threads = os.getenv("FFMPEG_THREADS", "0")
-  args = ["ffmpeg", "-v", loglevel,
+  return ["ffmpeg", "-v", loglevel,
           "-threads", threads,
           "-hwaccel", hwaccel,
           "-c:v", "hevc",
@@ -55,16 +83,61 @@ def decompress_video_data(rawdat, w, h, pix_fmt="rgb24", vid_fmt='hevc', hwaccel
           "-f", "rawvideo",
           "-pix_fmt", pix_fmt,
           "pipe:1"]
-  dat = subprocess.check_output(args, input=rawdat)
 
-  ret: np.ndarray
-  if pix_fmt == "rgb24":
-    ret = np.frombuffer(dat, dtype=np.uint8).reshape(-1, h, w, 3)
-  elif pix_fmt in ["nv12", "yuv420p"]:
-    ret = np.frombuffer(dat, dtype=np.uint8).reshape(-1, (h*w*3//2))
-  else:
-    raise NotImplementedError(f"Unsupported pixel format: {pix_fmt}")
-  return ret
+def decompress_video_data(rawdat, w, h, pix_fmt="rgb24", vid_fmt='hevc', hwaccel="auto", loglevel="info") -> np.ndarray:
+  shape = frame_shape(w, h, pix_fmt)
+  dat = subprocess.check_output(ffmpeg_decode_args(pix_fmt, vid_fmt, hwaccel, loglevel), input=rawdat)
+  return np.frombuffer(dat, dtype=np.uint8).reshape(-1, *shape)
+
+class DecoderSession:
+  """
+  Long-lived ffmpeg process decoding fn from byte offset off_b to off_e. The input is streamed in by a
+  writer thread and frames are read from the pipe one at a time, so memory use is a single frame.
+  """
+  def __init__(self, fn: str, prefix: bytes, off_b: int, off_e: int, w: int, h: int,
+               pix_fmt: str = "rgb24", hwaccel="auto", loglevel="quiet"):
+    self.shape = frame_shape(w, h, pix_fmt)
+    self.frame_size = int(np.prod(self.shape))
+    self.proc = subprocess.Popen(ffmpeg_decode_args(pix_fmt, hwaccel=hwaccel, loglevel=loglevel),
+                                 stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    self._writer = threading.Thread(target=self._write_input, args=(fn, prefix, off_b, off_e), daemon=True)
+    self._writer.start()
+
+  def _write_input(self, fn: str, prefix: bytes, off_b: int, off_e: int) -> None:
+    assert self.proc.stdin is not None
+    try:
+      self.proc.stdin.write(prefix)
+      with FileReader(fn, readahead=4) as f:
+        f.seek(off_b)
+        while off_b < off_e:
+          dat = f.read(min(SESSION_READ_SIZE, off_e - off_b))
+          if not dat:
+            break
+          self.proc.stdin.write(dat)
+          off_b += len(dat)
+    except (BrokenPipeError, ValueError):
+      # the session was closed before all the input was decoded
+      pass
+    finally:
+      try:
+        self.proc.stdin.close()
+      except BrokenPipeError:
+        pass
+
+  def read_frame(self) -> np.ndarray | None:
+    assert self.proc.stdout is not None
+    dat = self.proc.stdout.read(self.frame_size)
+    if len(dat) < self.frame_size:
+      return None
+    return np.frombuffer(dat, dtype=np.uint8).reshape(self.shape)
+
+  def close(self) -> None:
+    if self.proc.poll() is None:
+      self.proc.kill()
+    self.proc.wait()
+    self._writer.join()
+    if self.proc.stdout is not None:
+      self.proc.stdout.close()
 
 def ffprobe(fn, fmt=None):
   fn = resolve_name(fn)
@@ -88,16 +161,51 @@ def get_index_data(fn: str, index_data: dict|None = None):
   stream = index_data["probe"]["streams"][0]
   return index_data["index"], index_data["global_prefix"], stream["width"], stream["height"]
 
+def video_index_path(fn: str) -> str:
+  """Sidecar path in the download cache, keyed by URL, or by path, size and mtime for local files"""
+  return os.path.join(Paths.download_cache_root(), file_cache_key(fn) + "_vidindex.npz")
+
+def load_video_index(path: str) -> dict | None:
+  try:
+    with np.load(path) as d:
+      if int(d['version']) != VIDEO_INDEX_VERSION:
+        return None
+      return {
+        'index': d['index'],
+        'global_prefix': d['global_prefix'].tobytes(),
+        'probe': json.loads(str(d['probe'])),
+      }
+  except (OSError, KeyError, ValueError, zipfile.BadZipFile):
+    return None
+
+def save_video_index(path: str, index_data: dict) -> None:
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  with atomic_write(path, mode="wb", overwrite=True) as f:
+    np.savez(f, version=VIDEO_INDEX_VERSION, index=index_data['index'],
+             global_prefix=np.frombuffer(index_data['global_prefix'], dtype=np.uint8),
+             probe=np.array(json.dumps(index_data['probe'])))
+
 def get_video_index(fn):
+  """Frame types and offsets, global prefix and ffprobe output of fn, persisted in the download cache on first use"""
+  path = None
+  if int(os.environ.get("DISABLE_FILEREADER_CACHE", "0")) != 1:
+    path = video_index_path(resolve_name(fn))
+    index_data = load_video_index(path)
+    if index_data is not None:
+      return index_data
+
   assert_hvec(fn)
   frame_types, dat_len, prefix = hevc_index(fn)
   index = np.array(frame_types + [(0xFFFFFFFF, dat_len)], dtype=np.uint32)
   probe = ffprobe(fn, "hevc")
-  return {
+  index_data = {
     'index': index,
     'global_prefix': prefix,
     'probe': probe
   }
+  if path is not None:
+    save_video_index(path, index_data)
+  return index_data
 
 class FfmpegDecoder:
   def __init__(self, fn: str, index_data: dict|None = None,
@@ -110,37 +218,57 @@ class FfmpegDecoder:
     self.loglevel, self.hwaccel = loglevel, hwaccel
 
   def _gop_bounds(self, frame_idx: int):
-    f_b = frame_idx
-    while f_b > 0 and self.index[f_b, 0] != HEVC_SLICE_I:
-      f_b -= 1
-    f_e = frame_idx + 1
-    while f_e < self.frame_count and self.index[f_e, 0] != HEVC_SLICE_I:
-      f_e += 1
+    # iframes is sorted, the GOP runs from the last I-frame at or before frame_idx up to the next one
+    i = np.searchsorted(self.iframes, frame_idx, side="right")
+    f_b = int(self.iframes[i - 1]) if i > 0 else 0
+    f_e = int(self.iframes[i]) if i < len(self.iframes) else self.frame_count
     return f_b, f_e, self.index[f_b, 1], self.index[f_e, 1]
 
   def _decode_gop(self, raw: bytes) -> Iterator[np.ndarray]:
     yield from decompress_video_data(raw, self.w, self.h, pix_fmt=self.pix_fmt, hwaccel=self.hwaccel, loglevel=self.loglevel)
 
   def get_gop_start(self, frame_idx: int):
-    return self.iframes[np.searchsorted(self.iframes, frame_idx, side="right") - 1]
+    return self._gop_bounds(frame_idx)[0]
+
+  def decode_gop_frames(self, frame_indices: Sequence[int]) -> dict[int, np.ndarray]:
+    """Decodes the frames in frame_indices, which must all be in one GOP, stopping after the last one"""
+    f_b, _, off_b, off_e = self._gop_bounds(frame_indices[0])
+    wanted = set(frame_indices)
+    last = max(wanted)
+    frames = {}
+    session = DecoderSession(self.fn, self.prefix, off_b, off_e, self.w, self.h, self.pix_fmt, hwaccel=self.hwaccel, loglevel=self.loglevel)
+    try:
+      for fidx in range(f_b, last + 1):
+        frm = session.read_frame()
+        if frm is None:
+          raise DataUnreadableError(f"{self.fn}: decoder stopped at frame {fidx}, expected {last + 1}")
+        if fidx in wanted:
+          frames[fidx] = frm
+    finally:
+      session.close()
+    return frames
 
   def get_iterator(self, start_fidx: int = 0, end_fidx: int|None = None,
                    frame_skip: int = 1) -> Iterator[tuple[int, np.ndarray]]:
     end_fidx = end_fidx or self.frame_count
-    fidx = start_fidx
-    while fidx < end_fidx:
-      f_b, f_e, off_b, off_e = self._gop_bounds(fidx)
-      with FileReader(self.fn) as f:
-        f.seek(off_b)
-        raw = self.prefix + f.read(off_e - off_b)
-      # number of frames to discard inside this GOP before the wanted one
-      for i, frm in enumerate(decompress_video_data(raw, self.w, self.h, self.pix_fmt, hwaccel=self.hwaccel, loglevel=self.loglevel)):
-        fidx = f_b + i
-        if fidx >= end_fidx:
-          return
-        elif fidx >= start_fidx and (fidx - start_fidx) % frame_skip == 0:
+    if start_fidx >= end_fidx:
+      return
+    f_b, _, off_b, _ = self._gop_bounds(start_fidx)
+    _, _, _, off_e = self._gop_bounds(end_fidx - 1)
+
+    # a single decoder session from the first GOP start through the end of the last GOP
+    session = DecoderSession(self.fn, self.prefix, off_b, off_e, self.w, self.h, self.pix_fmt, hwaccel=self.hwaccel, loglevel=self.loglevel)
+    try:
+      fidx = f_b
+      while fidx < end_fidx:
+        frm = session.read_frame()
+        if frm is None:
+          raise DataUnreadableError(f"{self.fn}: decoder stopped at frame {fidx}, expected {end_fidx}")
+        if fidx >= start_fidx and (fidx - start_fidx) % frame_skip == 0:
           yield fidx, frm
-      fidx += 1
+        fidx += 1
+    finally:
+      session.close()
 
 def FrameIterator(fn: str, index_data: dict|None=None, pix_fmt: str = "rgb24",
                   start_fidx:int=0, end_fidx=None, frame_skip:int=1, hwaccel="auto", loglevel="quiet") -> Iterator[np.ndarray]:
@@ -150,10 +278,10 @@ def FrameIterator(fn: str, index_data: dict|None=None, pix_fmt: str = "rgb24",
 
 class FrameReader:
   def __init__(self, fn: str, index_data: dict|None = None, cache_size: int = 30,
-               pix_fmt: str = "rgb24", hwaccel="auto", loglevel="quiet"):
+               pix_fmt: str = "rgb24", hwaccel="auto", loglevel="quiet", cache_bytes: int | None = None):
     self.decoder = FfmpegDecoder(fn, index_data=index_data, pix_fmt=pix_fmt, hwaccel=hwaccel, loglevel=loglevel)
     self.iframes = self.decoder.iframes
-    self._cache: LRUCache = LRUCache(cache_size)
+    self._cache: LRUCache = LRUCache(cache_size, cache_bytes)
     self.w, self.h, self.frame_count, = self.decoder.w, self.decoder.h, self.decoder.frame_count
     self.pix_fmt = pix_fmt
 
@@ -164,10 +292,39 @@ class FrameReader:
     if fidx in self._cache:  # If frame is cached, return it
       return self._cache[fidx]
     read_start = self.decoder.get_gop_start(fidx)
-    if not self.it or fidx < self.fidx or read_start != self.decoder.get_gop_start(self.fidx):  # If the frame is in a different GOP, reset the iterator
+    # keep decoding with the current session if the frame is ahead of it, unless it's cheaper to restart from the frame's GOP
+    if not self.it or fidx < self.fidx or read_start > self.fidx + 1:
+      if self.it is not None:
+        self.it.close()
       self.it = self.decoder.get_iterator(read_start)
       self.fidx = -1
     while self.fidx < fidx:
       self.fidx, frame = next(self.it)
       self._cache[self.fidx] = frame
     return self._cache[fidx]
+
+  def get_many(self, frame_indices: Sequence[int], num_workers: int = DECODE_WORKERS) -> np.ndarray:
+    """
+    Returns the frames at frame_indices, in the given order, stacked into one array. Uncached frames are grouped
+    by GOP and every GOP is decoded once, up to its last requested frame, with num_workers GOPs decoding in parallel.
+    """
+    shape = frame_shape(self.w, self.h, self.pix_fmt)
+    if len(frame_indices) == 0:
+      return np.empty((0, *shape), dtype=np.uint8)
+    for fidx in frame_indices:
+      if not 0 <= fidx < self.frame_count:
+        raise IndexError(f"frame {fidx} out of range, {self.frame_count} frames")
+
+    frames = {fidx: self._cache[fidx] for fidx in set(frame_indices) if fidx in self._cache}
+    gops: dict[int, list[int]] = {}
+    for fidx in sorted(set(frame_indices) - frames.keys()):
+      gops.setdefault(self.decoder.get_gop_start(fidx), []).append(fidx)
+
+    if gops:
+      with ThreadPoolExecutor(max_workers=max(1, min(num_workers, len(gops)))) as executor:
+        for decoded in executor.map(self.decoder.decode_gop_frames, gops.values()):
+          frames.update(decoded)
+          for fidx, frame in decoded.items():
+            self._cache[fidx] = frame
+
+    return np.stack([frames[fidx] for fidx in frame_indices])
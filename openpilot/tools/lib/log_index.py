@@ -0,0 +1,110 @@
+import os
+import struct
+import zipfile
+import capnp
+import numpy as np
+
+from openpilot.cereal import log as capnp_log
+from openpilot.common.hardware.hw import Paths
+from openpilot.common.utils import atomic_write
+from openpilot.tools.lib.segment_cache import file_cache_key
+
+INDEX_VERSION = 1
+# capnp's default reader limit, anything above this is a corrupted frame header
+MAX_CAPNP_SEGMENTS = 512
+
+
+def message_size(dat: bytes, offset: int = 0) -> int:
+  """Returns the framed size of the capnp message at offset, or -1 if its header is incomplete"""
+  # https://capnproto.org/encoding.html#serialization-over-a-stream
+  if len(dat) - offset < 4:
+    return -1
+  num_segments = struct.unpack_from('<I', dat, offset)[0] + 1
+  if num_segments > MAX_CAPNP_SEGMENTS:
+    raise ValueError(f"invalid segment count {num_segments}")
+  header_size = (4 * (num_segments + 1) + 7) & ~7
+  if len(dat) - offset < header_size:
+    return -1
+  return header_size + 8 * sum(struct.unpack_from(f'<{num_segments}I', dat, offset + 4))
+
+
+def index_path(fn: str) -> str:
+  """Sidecar path in the download cache, keyed by URL, or by path, size and mtime for local files"""
+  return os.path.join(Paths.download_cache_root(), file_cache_key(fn) + "_index.npz")
+
+
+class LogIndex:
+  def __init__(self, data_size: int, offsets: np.ndarray, sizes: np.ndarray, mono_times: np.ndarray, types: np.ndarray, type_names: list[str]):
+    """Byte offset, size, logMonoTime and union type of every event in a decompressed log. Non-union events have type -1"""
+    self.data_size = data_size
+    self.offsets = offsets
+    self.sizes = sizes
+    self.mono_times = mono_times
+    self.types = types
+    self.type_names = type_names
+
+  @staticmethod
+  def build(dat: bytes) -> 'LogIndex':
+    offsets, sizes, mono_times, types = [], [], [], []
+    type_ids: dict[str, int] = {}
+    offset = 0
+    try:
+      for evt in capnp_log.Event.read_multiple_bytes(dat):
+        size = message_size(dat, offset)
+        try:
+          typ = type_ids.setdefault(evt.which(), len(type_ids))
+        except capnp.KjException:
+          typ = -1
+        offsets.append(offset)
+        sizes.append(size)
+        mono_times.append(evt.logMonoTime)
+        types.append(typ)
+        offset += size
+    except (capnp.KjException, ValueError):
+      # corrupted tail, index what was readable
+      pass
+
+    return LogIndex(len(dat), np.array(offsets, dtype=np.uint64), np.array(sizes, dtype=np.uint64),
+                    np.array(mono_times, dtype=np.uint64), np.array(types, dtype=np.int16), list(type_ids))
+
+  @staticmethod
+  def load(path: str) -> 'LogIndex | None':
+    try:
+      with np.load(path) as d:
+        if int(d['version']) != INDEX_VERSION:
+          return None
+        return LogIndex(int(d['data_size']), d['offsets'], d['sizes'], d['mono_times'], d['types'], d['type_names'].tolist())
+    except (OSError, KeyError, ValueError, zipfile.BadZipFile):
+      return None
+
+  def save(self, path: str) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with atomic_write(path, mode="wb", overwrite=True) as f:
+      np.savez(f, version=INDEX_VERSION, data_size=self.data_size, offsets=self.offsets, sizes=self.sizes,
+               mono_times=self.mono_times, types=self.types, type_names=np.array(self.type_names, dtype=str))
+
+  def select(self, msg_type: str, start_time: int | None = None, end_time: int | None = None) -> np.ndarray:
+    """Indices of the msg_type events with logMonoTime in [start_time, end_time), in file order"""
+    if msg_type not in self.type_names:
+      return np.array([], dtype=np.int64)
+    mask = self.types == self.type_names.index(msg_type)
+    if start_time is not None:
+      mask &= self.mono_times >= start_time
+    if end_time is not None:
+      mask &= self.mono_times < end_time
+    return np.flatnonzero(mask)
+
+
+def get_log_index(fn: str, dat: bytes) -> LogIndex:
+  """Loads the sidecar index of the log, building and persisting it on first use"""
+  path = None
+  if fn and int(os.environ.get("DISABLE_FILEREADER_CACHE", "0")) != 1:
+    path = index_path(fn)
+    index = LogIndex.load(path)
+    if index is not None and index.data_size == len(dat):
+      return index
+
+  index = LogIndex.build(dat)
+  if path is not None:
+    index.save(path)
+  return index
@@ -1,48 +1,13 @@
 import numpy as np
+from collections.abc import Collection
 
+from openpilot.cereal import log as capnp_log
 
-def flatten_type_dict(d, sep="/", prefix=None):
-  res = {}
-  if isinstance(d, dict):
-    for key, val in d.items():
-      if prefix is None:
-        res.update(flatten_type_dict(val, prefix=key))
-      else:
-        res.update(flatten_type_dict(val, prefix=prefix + sep + key))
-    return res
-  elif isinstance(d, list):
-    return {prefix: np.array(d)}
-  else:
-    return {prefix: d}
-
-
-def get_message_dict(message, typ):
-  valid = message.valid
-  message = message._get(typ)
-  if not hasattr(message, 'to_dict') or typ in ('qcomGnss', 'ubloxGnss'):
-    # TODO: support these
-    #print("skipping", typ)
-    return
-
-  msg_dict = message.to_dict(verbose=True)
-  msg_dict = flatten_type_dict(msg_dict)
-  msg_dict['_valid'] = valid
-  return msg_dict
-
-
-def append_dict(path, t, d, values):
-  if path not in values:
-    group = {}
-    group["t"] = []
-    for k in d:
-      group[k] = []
-    values[path] = group
-  else:
-    group = values[path]
-
-  group["t"].append(t)
-  for k, v in d.items():
-    group[k].append(v)
+INITIAL_CAPACITY = 256
+INT_TYPES = ('int8', 'int16', 'int32', 'int64', 'uint8', 'uint16', 'uint32', 'uint64')
+FLOAT_TYPES = ('float32', 'float64')
+# TODO: support these
+SKIPPED_TYPES = ('qcomGnss', 'ubloxGnss')
 
 
 def potentially_ragged_array(arr, dtype=None, **kwargs):
@@ -52,28 +17,167 @@ def potentially_ragged_array(arr, dtype=None, **kwargs):
   except ValueError:
     return np.array(arr, dtype=object, **kwargs)
 
-def msgs_to_time_series(msgs):
+
+class Column:
+  __slots__ = ('data', 'fill')
+
+  def __init__(self, dtype, fill, capacity: int = INITIAL_CAPACITY):
+    """Typed column grown by doubling. Rows that are never set keep the fill value, e.g. inactive union fields"""
+    self.fill = fill
+    self.data = np.full(capacity, fill, dtype=dtype)
+
+  def grow(self, capacity: int) -> None:
+    data = np.full(capacity, self.fill, dtype=self.data.dtype)
+    data[:len(self.data)] = self.data
+    self.data = data
+
+  def set(self, i: int, value) -> None:
+    try:
+      self.data[i] = value
+    except OverflowError:
+      # UInt64 values past the int64 range, same as np.array() would infer
+      self.data = self.data.astype(np.uint64)
+      self.data[i] = value
+
+  def values(self, n: int) -> np.ndarray:
+    if self.data.dtype == object:
+      return potentially_ragged_array(self.data[:n].tolist())
+    return self.data[:n]
+
+
+def _list_converter(element_type: str):
+  if element_type == 'struct':
+    return lambda l: [x.to_dict(verbose=True) for x in l]
+  elif element_type == 'enum':
+    return lambda l: [str(x) for x in l]
+  elif element_type == 'list':
+    return lambda l: [list(x) for x in l]
+  return list
+
+
+def _selected(path: str, fields: Collection[str] | None) -> bool:
+  return fields is None or any(path == f or path.startswith(f + "/") or f.startswith(path + "/") for f in fields)
+
+
+def compile_struct(schema, columns: dict[str, Column], prefix: str | None = None, fields: Collection[str] | None = None,
+                   parents: tuple[int, ...] = ()) -> list[tuple]:
+  """
+    Walks a struct schema once, creating a column in columns for every selected leaf field, keyed by its "/" joined path.
+    Returns the (name, in_union, column, converter, children) nodes used to fill them from a reader.
+  """
+  nodes = []
+  union_fields = set(schema.union_fields)
+  for name, field in schema.fields.items():
+    path = name if prefix is None else f"{prefix}/{name}"
+    if not _selected(path, fields):
+      continue
+
+    if field.proto.which() == 'group' or field.proto.slot.type.which() == 'struct':
+      child_schema = field.schema
+      if child_schema.node.id in parents:
+        continue
+      children = compile_struct(child_schema, columns, path, fields, (*parents, schema.node.id))
+      if children:
+        nodes.append((name, name in union_fields, None, None, children))
+      continue
+
+    typ = field.proto.slot.type.which()
+    converter = None
+    if typ == 'bool':
+      column = Column(np.bool_, False)
+    elif typ in INT_TYPES:
+      column = Column(np.int64, 0)
+    elif typ in FLOAT_TYPES:
+      column = Column(np.float64, np.nan)
+    elif typ in ('text', 'data', 'enum', 'list'):
+      column = Column(object, None)
+      if typ == 'enum':
+        converter = str
+      elif typ == 'list':
+        converter = _list_converter(field.proto.slot.type.list.elementType.which())
+    else:
+      # void, interfaces and AnyPointer have no value to record
+      continue
+
+    columns[path] = column
+    nodes.append((name, name in union_fields, column, converter, None))
+  return nodes
+
+
+def fill_struct(reader, nodes: list[tuple], i: int) -> None:
+  which = None
+  for name, in_union, column, converter, children in nodes:
+    if in_union:
+      if which is None:
+        which = reader.which()
+      if which != name:
+        continue
+
+    value = getattr(reader, name)
+    if children is not None:
+      fill_struct(value, children, i)
+    else:
+      column.set(i, value if converter is None else converter(value))
+
+
+class ServiceTimeSeries:
+  def __init__(self, service: str, fields: Collection[str] | None = None):
+    self.service = service
+    self.size = 0
+    self.t = Column(np.float64, np.nan)
+    self.valid = Column(np.bool_, False)
+    self.columns: dict[str, Column] = {}
+    self.nodes = compile_struct(capnp_log.Event.schema.fields[service].schema, self.columns, fields=fields)
+
+  def append(self, msg) -> None:
+    i = self.size
+    if i == len(self.t.data):
+      for column in (self.t, self.valid, *self.columns.values()):
+        column.grow(2 * len(column.data))
+
+    self.t.data[i] = msg.logMonoTime / 1.0e9
+    self.valid.data[i] = msg.valid
+    fill_struct(getattr(msg, self.service), self.nodes, i)
+    self.size += 1
+
+  def to_dict(self) -> dict[str, np.ndarray]:
+    t = self.t.values(self.size)
+    order = np.argsort(t, kind='stable')
+    series = {"t": t[order]}
+    for path, column in self.columns.items():
+      series[path] = column.values(self.size)[order]
+    series["_valid"] = self.valid.values(self.size)[order]
+    return series
+
+
+def is_struct_service(service: str) -> bool:
+  field = capnp_log.Event.schema.fields[service]
+  return service not in SKIPPED_TYPES and field.proto.which() == 'slot' and field.proto.slot.type.which() == 'struct'
+
+
+def msgs_to_time_series(msgs, services: Collection[str] | None = None, fields: dict[str, Collection[str]] | None = None):
   """
     Convert an iterable of canonical capnp messages into a dictionary of time series.
     Each time series has a value with key "t" which consists of monotonically increasing timestamps
     in seconds.
+
+    Columns are typed from the capnp schema: integers are int64, floats are float64 and inactive union
+    fields are NaN/0/False/None. Optionally only include services, and for services in fields only the
+    given "/" joined field paths (or struct prefixes), e.g. {"carState": ["vEgo", "cruiseState"]}.
   """
-  values = {}
+  values: dict[str, ServiceTimeSeries | None] = {}
   for msg in msgs:
     typ = msg.which()
+    if services is not None and typ not in services:
+      continue
 
-    tm = msg.logMonoTime / 1.0e9
-    msg_dict = get_message_dict(msg, typ)
-    if msg_dict is not None:
-      append_dict(typ, tm, msg_dict, values)
-
-  # Sort values by time.
-  for group in values.values():
-    order = np.argsort(group["t"])
-    for name, group_values in group.items():
-      group[name] = potentially_ragged_array(group_values)[order]
+    if typ not in values:
+      values[typ] = ServiceTimeSeries(typ, None if fields is None else fields.get(typ)) if is_struct_service(typ) else None
+    series = values[typ]
+    if series is not None:
+      series.append(msg)
 
-  return values
+  return {typ: series.to_dict() for typ, series in values.items() if series is not None}
 
 
 if __name__ == "__main__":
@@ -1,6 +1,8 @@
 #!/usr/bin/env python3
 import bz2
-from functools import partial
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial, reduce
 import multiprocessing
 import capnp
 import enum
@@ -10,21 +12,32 @@ import sys
 import tqdm
 import urllib.parse
 import warnings
+import numpy as np
 import zstandard as zstd
 
-from collections.abc import Iterable, Iterator
+from collections.abc import Callable, Iterable, Iterator
+from typing import Any, TypeVar
 from urllib.parse import parse_qs, urlparse
 
 from openpilot.cereal import log as capnp_log
 from openpilot.common.swaglog import cloudlog
 from openpilot.tools.lib.filereader import FileReader
 from openpilot.tools.lib.file_sources import comma_api_source, internal_source, openpilotci_source, comma_car_segments_source, Source
+from openpilot.tools.lib.log_index import LogIndex, get_log_index, message_size
+from openpilot.tools.lib.segment_cache import read_decompressed, write_decompressed
 from openpilot.tools.lib.route import SegmentRange, FileName
 from openpilot.tools.lib.log_time_series import msgs_to_time_series
 
 LogMessage = type[capnp._DynamicStructReader]
 LogIterable = Iterable[LogMessage]
 RawLogIterable = Iterable[bytes]
+T = TypeVar("T")
+
+ZSTD_MAGIC = b'\x28\xB5\x2F\xFD'
+# compressed bytes read per step in streaming mode, aligned with the URLFile cache chunks
+STREAM_READ_SIZE = 1000 * 1000
+# URLFile chunks downloaded ahead of the current one in streaming mode
+STREAM_READAHEAD = 8
 
 
 def save_log(dest, log_msgs, compress=True):
@@ -49,17 +62,40 @@ def decompress_stream(data: bytes):
   return decompressed_data
 
 
+class _LogFrames:
+  def __init__(self, dat: bytes):
+    """Byte ranges of the messages in a decompressed log, found the first time one is needed"""
+    self._dat = dat
+    self._offsets: list[int] | None = None
+
+  def get(self, i: int) -> memoryview:
+    if self._offsets is None:
+      offsets = [0]
+      while (size := message_size(self._dat, offsets[-1])) != -1 and offsets[-1] + size <= len(self._dat):
+        offsets.append(offsets[-1] + size)
+      self._offsets = offsets
+    return memoryview(self._dat)[self._offsets[i]:self._offsets[i + 1]]
+
+
 class CachedEventReader:
-  __slots__ = ('_evt', '_enum')
+  __slots__ = ('_evt', '_enum', '_frames', '_idx')
 
-  def __init__(self, evt: capnp._DynamicStructReader, _enum: str | None = None):
+  def __init__(self, evt: capnp._DynamicStructReader, _enum: str | None = None, _frames: _LogFrames | None = None, _idx: int = 0):
     """All capnp attribute accesses are expensive, and which() is often called multiple times"""
     self._evt = evt
     self._enum: str | None = _enum
+    self._frames = _frames
+    self._idx = _idx
+
+  def as_bytes(self) -> bytes | memoryview:
+    """The serialized event. Events of a log read in full are a view of it, the others are copied"""
+    if self._frames is None:
+      return self._evt.as_builder().to_bytes()
+    return self._frames.get(self._idx)
 
   # fast pickle support
   def __reduce__(self):
-    return CachedEventReader._reducer, (self._evt.as_builder().to_bytes(), self._enum)
+    return CachedEventReader._reducer, (bytes(self.as_bytes()), self._enum)
 
   @staticmethod
   def _reducer(data: bytes, _enum: str | None = None):
@@ -87,39 +123,61 @@ class CachedEventReader:
 
 
 class _LogFileReader:
-  def __init__(self, fn, only_union_types=False, sort_by_time=False, dat=None):
+  def __init__(self, fn, only_union_types=False, sort_by_time=False, dat=None, use_index=False, cache_decompressed=False, use_mmap=False):
     self.data_version = None
     self._only_union_types = only_union_types
+    self._sort_by_time = sort_by_time
 
     ext = None
+    cached = False
     if not dat:
       _, ext = os.path.splitext(urllib.parse.urlparse(fn).path)
       if ext not in ('', '.bz2', '.zst'):
         # old rlogs weren't compressed
         raise ValueError(f"unknown extension {ext}")
 
-      with FileReader(fn) as f:
-        dat = f.read()
-
-    if ext == ".bz2" or dat.startswith(b'BZh9'):
-      dat = bz2.decompress(dat)
-    elif ext == ".zst" or dat.startswith(b'\x28\xB5\x2F\xFD'):
-      # https://github.com/facebook/zstd/blob/dev/doc/zstd_compression_format.md#zstandard-frames
-      dat = decompress_stream(dat)
-
-    ents = capnp_log.Event.read_multiple_bytes(dat)
-
-    self._ents = []
+      if cache_decompressed:
+        dat = read_decompressed(fn, use_mmap)
+        cached = dat is not None
+
+      if not cached:
+        with FileReader(fn) as f:
+          dat = f.read()
+
+    if not cached:
+      if ext == ".bz2" or dat.startswith(b'BZh9'):
+        dat = bz2.decompress(dat)
+      elif ext == ".zst" or dat.startswith(ZSTD_MAGIC):
+        # https://github.com/facebook/zstd/blob/dev/doc/zstd_compression_format.md#zstandard-frames
+        dat = decompress_stream(dat)
+
+      if cache_decompressed and fn:
+        write_decompressed(fn, dat)
+        if use_mmap:
+          dat = read_decompressed(fn, use_mmap) or dat
+
+    self._dat = dat
+    # with an index, events are only parsed once the whole log is iterated
+    self._index: LogIndex | None = get_log_index(fn, dat) if use_index else None
+    self._ents: list[CachedEventReader] | None = None if use_index else self._read_ents()
+
+  def _read_ents(self) -> list[CachedEventReader]:
+    ents = []
+    frames = _LogFrames(self._dat)
     try:
-      for e in ents:
-        self._ents.append(CachedEventReader(e))
+      for i, e in enumerate(capnp_log.Event.read_multiple_bytes(self._dat)):
+        ents.append(CachedEventReader(e, None, frames, i))
     except capnp.KjException:
       warnings.warn("Corrupted events detected", RuntimeWarning, stacklevel=1)
 
-    if sort_by_time:
-      self._ents.sort(key=lambda x: x.logMonoTime)
+    if self._sort_by_time:
+      ents.sort(key=lambda x: x.logMonoTime)
+    return ents
 
   def __iter__(self) -> Iterator[capnp._DynamicStructReader]:
+    if self._ents is None:
+      self._ents = self._read_ents()
+
     for ent in self._ents:
       if self._only_union_types:
         try:
@@ -130,6 +188,97 @@ class _LogFileReader:
       else:
         yield ent
 
+  def filter(self, msg_type: str, start_time: int | None = None, end_time: int | None = None) -> Iterator[CachedEventReader]:
+    assert self._index is not None, "filtering a segment requires an index"
+    idxs = self._index.select(msg_type, start_time, end_time)
+    if self._sort_by_time:
+      idxs = idxs[np.argsort(self._index.mono_times[idxs], kind='stable')]
+
+    for offset, size in zip(self._index.offsets[idxs].tolist(), self._index.sizes[idxs].tolist(), strict=True):
+      yield CachedEventReader._reducer(self._dat[offset:offset + size], msg_type)
+
+
+def _iter_decompressed(f, read_size: int) -> Iterator[bytes]:
+  """Incrementally decompresses a bz2, zstd or uncompressed file, handling concatenated streams/frames"""
+  dat = f.read(read_size)
+  if dat.startswith(b'BZh'):
+    new_decompressor = bz2.BZ2Decompressor
+  elif dat.startswith(ZSTD_MAGIC):
+    new_decompressor = zstd.ZstdDecompressor().decompressobj
+  else:
+    while dat:
+      yield dat
+      dat = f.read(read_size)
+    return
+
+  decompressor = new_decompressor()
+  while dat:
+    yield decompressor.decompress(dat)
+    if decompressor.eof:
+      dat = decompressor.unused_data or f.read(read_size)
+      decompressor = new_decompressor()
+    else:
+      dat = f.read(read_size)
+
+
+def _complete_messages_size(dat: bytes) -> int:
+  """Returns the length of the prefix of dat made up of complete capnp messages"""
+  offset = 0
+  while (size := message_size(dat, offset)) != -1 and len(dat) - offset >= size:
+    offset += size
+  return offset
+
+
+class _StreamingLogFileReader:
+  def __init__(self, fn, only_union_types=False):
+    """Decompresses and parses the file incrementally on every iteration, only holding one read step of events in memory"""
+    _, ext = os.path.splitext(urllib.parse.urlparse(fn).path)
+    if ext not in ('', '.bz2', '.zst'):
+      raise ValueError(f"unknown extension {ext}")
+
+    self._fn = fn
+    self._only_union_types = only_union_types
+
+  def _iter_events(self) -> Iterator[capnp._DynamicStructReader]:
+    with FileReader(self._fn, readahead=STREAM_READAHEAD) as f:
+      dat = b""
+      try:
+        for chunk in _iter_decompressed(f, STREAM_READ_SIZE):
+          dat += chunk
+          size = _complete_messages_size(dat)
+          if size > 0:
+            yield from capnp_log.Event.read_multiple_bytes(dat[:size])
+            dat = dat[size:]
+      except (capnp.KjException, ValueError):
+        warnings.warn("Corrupted events detected", RuntimeWarning, stacklevel=1)
+        return
+
+      if len(dat):
+        warnings.warn("Corrupted events detected", RuntimeWarning, stacklevel=1)
+
+  def __iter__(self) -> Iterator[capnp._DynamicStructReader]:
+    for evt in self._iter_events():
+      ent = CachedEventReader(evt)
+      if self._only_union_types:
+        try:
+          ent.which()
+          yield ent
+        except capnp.lib.capnp.KjException:
+          pass
+      else:
+        yield ent
+
+
+def _open_log_file(fn, sort_by_time=False, only_union_types=False, streaming=False, use_index=False, cache_decompressed=False, use_mmap=False):
+  if streaming:
+    return _StreamingLogFileReader(fn, only_union_types=only_union_types)
+  return _LogFileReader(fn, sort_by_time=sort_by_time, only_union_types=only_union_types, use_index=use_index,
+                        cache_decompressed=cache_decompressed, use_mmap=use_mmap)
+
+
+def _run_on_log_file(func, lr_kwargs, fn):
+  return func(_open_log_file(fn, **lr_kwargs))
+
 
 class ReadMode(enum.StrEnum):
   RLOG = "r"  # only read rlogs
@@ -244,7 +393,10 @@ class LogReader:
     return identifiers
 
   def __init__(self, identifier: str | list[str], default_mode: ReadMode = ReadMode.RLOG,
-               sources: list[Source] | None = None, sort_by_time=False, only_union_types=False):
+               sources: list[Source] | None = None, sort_by_time=False, only_union_types=False, streaming=False, use_index=False,
+               prefetch: int = 0, cache_decompressed=False, use_mmap=False):
+    if streaming and (sort_by_time or use_index or prefetch or cache_decompressed):
+      raise ValueError("sort_by_time, use_index, prefetch and cache_decompressed require reading whole segments, they can't be used with streaming")
     if sources is None:
       sources = [internal_source, comma_api_source, openpilotci_source, comma_car_segments_source]
 
@@ -256,18 +408,50 @@ class LogReader:
 
     self.sort_by_time = sort_by_time
     self.only_union_types = only_union_types
+    # streaming segments are re-read on each iteration instead of being kept in memory
+    self.streaming = streaming
+    # per-segment event type index, persisted in the download cache, used by filter() and first()
+    self.use_index = use_index
+    # number of segments to download and decompress in background threads while iterating
+    self.prefetch = prefetch
+    # keep decompressed segments in the download cache, optionally reading them through a memory map
+    self.cache_decompressed = cache_decompressed
+    self.use_mmap = use_mmap
 
     self.__lrs: dict[int, _LogFileReader] = {}
     self.reset()
 
+  @property
+  def _lr_kwargs(self) -> dict[str, Any]:
+    return {"sort_by_time": self.sort_by_time, "only_union_types": self.only_union_types, "streaming": self.streaming, "use_index": self.use_index,
+            "cache_decompressed": self.cache_decompressed, "use_mmap": self.use_mmap}
+
   def _get_lr(self, i):
+    if self.streaming:
+      return _open_log_file(self.logreader_identifiers[i], **self._lr_kwargs)
     if i not in self.__lrs:
-      self.__lrs[i] = _LogFileReader(self.logreader_identifiers[i], sort_by_time=self.sort_by_time, only_union_types=self.only_union_types)
+      self.__lrs[i] = _open_log_file(self.logreader_identifiers[i], **self._lr_kwargs)
     return self.__lrs[i]
 
+  def _iter_lrs(self):
+    num_segs = len(self.logreader_identifiers)
+    if not self.prefetch:
+      for i in range(num_segs):
+        yield self._get_lr(i)
+      return
+
+    # bz2/zstd decompression and downloads release the GIL, so threads overlap them with consuming the current segment
+    with ThreadPoolExecutor(self.prefetch) as pool:
+      futures = deque(pool.submit(self._get_lr, i) for i in range(min(self.prefetch + 1, num_segs)))
+      for i in range(self.prefetch + 1, num_segs + self.prefetch + 1):
+        lr = futures.popleft().result()
+        if i < num_segs:
+          futures.append(pool.submit(self._get_lr, i))
+        yield lr
+
   def __iter__(self):
-    for i in range(len(self.logreader_identifiers)):
-      yield from self._get_lr(i)
+    for lr in self._iter_lrs():
+      yield from lr
 
   def _run_on_segment(self, func, i):
     return func(self._get_lr(i))
@@ -280,6 +464,23 @@ class LogReader:
         ret.extend(p)
       return ret
 
+  def map_segments(self, func: Callable[[LogIterable], T], num_processes: int | None = None,
+                   disable_tqdm=True, desc=None) -> Iterator[T]:
+    """
+      Runs func on every segment in a process pool, yielding the results in segment order.
+      Workers open their segment themselves and only send back func's result, so it should be small
+      (a count, an array, a few messages), not the segment's events.
+    """
+    num_segs = len(self.logreader_identifiers)
+    with multiprocessing.Pool(num_processes) as pool:
+      results = pool.imap(partial(_run_on_log_file, func, self._lr_kwargs), self.logreader_identifiers)
+      yield from tqdm.tqdm(results, total=num_segs, disable=disable_tqdm, desc=desc)
+
+  def map_reduce(self, map_func: Callable[[LogIterable], T], reduce_func: Callable[[Any, T], Any], initial: Any,
+                 num_processes: int | None = None, disable_tqdm=True, desc=None):
+    """Folds reduce_func over the per-segment map_func results, in segment order"""
+    return reduce(reduce_func, self.map_segments(map_func, num_processes, disable_tqdm, desc), initial)
+
   def reset(self):
     self.logreader_identifiers = []
     for identifier in self.identifier:
@@ -289,11 +490,17 @@ class LogReader:
   def from_bytes(dat):
     return _LogFileReader("", dat=dat)
 
-  def filter(self, msg_type: str):
-    return (getattr(m, m.which()) for m in filter(lambda m: m.which() == msg_type, self))
+  def filter(self, msg_type: str, start_time: int | None = None, end_time: int | None = None):
+    """Yields msg_type messages, optionally only those with logMonoTime in [start_time, end_time)"""
+    if self.use_index:
+      msgs = (m for lr in self._iter_lrs() for m in lr.filter(msg_type, start_time, end_time))
+    else:
+      msgs = (m for m in self if m.which() == msg_type and (start_time is None or m.logMonoTime >= start_time) and
+              (end_time is None or m.logMonoTime < end_time))
+    return (getattr(m, msg_type) for m in msgs)
 
-  def first(self, msg_type: str):
-    return next(self.filter(msg_type), None)
+  def first(self, msg_type: str, start_time: int | None = None):
+    return next(self.filter(msg_type, start_time), None)
 
   @property
   def time_series(self):
@@ -0,0 +1,67 @@
+import mmap
+import os
+
+from openpilot.common.hardware.hw import Paths
+from openpilot.common.utils import atomic_write
+from openpilot.tools.lib.url_file import hash_url
+
+DECOMPRESSED_CACHE_SIZE = int(os.getenv("DECOMPRESSED_CACHE_SIZE", 20 * 1024 * 1024 * 1024))
+
+
+def file_cache_key(fn: str) -> str:
+  """Cache key for a file, its URL or its path, size and mtime for local files"""
+  key = fn
+  if not fn.startswith(("http://", "https://", "cd:/")):
+    st = os.stat(fn)
+    key = f"{os.path.realpath(fn)}:{st.st_size}:{st.st_mtime_ns}"
+  return hash_url(key)
+
+
+def decompressed_cache_root() -> str:
+  return os.path.join(Paths.download_cache_root(), "decompressed")
+
+
+def read_decompressed(fn: str, use_mmap: bool = False) -> bytes | mmap.mmap | None:
+  """Returns the cached decompressed log, optionally memory mapped, or None on a miss"""
+  path = os.path.join(decompressed_cache_root(), file_cache_key(fn))
+  try:
+    with open(path, "rb") as f:
+      # mtime is the LRU recency, atime isn't reliably updated
+      os.utime(f.fileno())
+      if use_mmap and os.fstat(f.fileno()).st_size > 0:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+      return f.read()
+  except FileNotFoundError:
+    return None
+
+
+def write_decompressed(fn: str, dat: bytes) -> None:
+  os.makedirs(decompressed_cache_root(), exist_ok=True)
+  with atomic_write(os.path.join(decompressed_cache_root(), file_cache_key(fn)), mode="wb", overwrite=True) as f:
+    f.write(dat)
+  prune_decompressed()
+
+
+def prune_decompressed() -> None:
+  """Evicts the least recently used decompressed logs until the cache is under DECOMPRESSED_CACHE_SIZE"""
+  entries = []
+  with os.scandir(decompressed_cache_root()) as it:
+    for entry in it:
+      # skip in-progress atomic writes
+      if entry.name.startswith("tmp"):
+        continue
+      try:
+        st = entry.stat()
+      except FileNotFoundError:
+        continue
+      entries.append((st.st_mtime_ns, st.st_size, entry.path))
+
+  total = sum(size for _, size, _ in entries)
+  for _, size, path in sorted(entries):
+    if total <= DECOMPRESSED_CACHE_SIZE:
+      break
+    try:
+      os.remove(path)
+    except OSError:
+      pass
+    total -= size
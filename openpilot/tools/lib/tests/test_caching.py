@@ -3,12 +3,14 @@ import os
 import shutil
 import socket
 import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
 
 from openpilot.common.parameterized import parameterized
 from openpilot.common.test import OpenpilotTestCase
 from openpilot.selfdrive.test.helpers import http_server_context
 from openpilot.common.hardware.hw import Paths
-from openpilot.tools.lib.url_file import URLFile, prune_cache
+from openpilot.tools.lib.url_file import URLFile, get_cache_index, prune_cache
 import openpilot.tools.lib.url_file as url_file_module
 
 
@@ -31,10 +33,39 @@ class CachingTestRequestHandler(http.server.BaseHTTPRequestHandler):
     self.end_headers()
 
 
+class RangeRequestHandler(http.server.BaseHTTPRequestHandler):
+  DATA = bytes(range(256)) * 4
+  RANGES: list[str] = []
+  DELAY = 0.  # seconds, for ranges not starting at 0
+
+  def do_GET(self):
+    RangeRequestHandler.RANGES.append(self.headers["Range"])
+    start, end = (int(x) for x in self.headers["Range"].removeprefix("bytes=").split("-"))
+    if start > 0:
+      time.sleep(self.DELAY)
+    self.send_response(206)
+    self.send_header("Content-Length", str(len(self.DATA[start:end + 1])))
+    self.end_headers()
+    self.wfile.write(self.DATA[start:end + 1])
+
+  def do_HEAD(self):
+    self.send_response(200)
+    self.send_header("Content-Length", str(len(self.DATA)))
+    self.end_headers()
+
+  def log_message(self, *args):
+    pass
+
+
 def host():
   with http_server_context(handler=CachingTestRequestHandler) as (host, port):
     yield f"http://{host}:{port}"
 
+
+def range_host():
+  with http_server_context(handler=RangeRequestHandler) as (host, port):
+    yield f"http://{host}:{port}"
+
 class TestFileDownload(OpenpilotTestCase):
 
   def test_pipeline_defaults(self, host):
@@ -135,33 +166,104 @@ class TestFileDownload(OpenpilotTestCase):
     assert length == 4
 
 
+  def test_concurrent_chunk_download(self, monkeypatch, range_host):
+    os.environ.pop("DISABLE_FILEREADER_CACHE", None)
+    monkeypatch.setattr(url_file_module, 'CHUNK_SIZE', 100)
+    data = RangeRequestHandler.DATA
+
+    # missing chunks are downloaded in batches of consecutive chunks, at most DOWNLOAD_WORKERS requests
+    RangeRequestHandler.RANGES.clear()
+    assert URLFile(f"{range_host}/full").read() == data
+    assert len(RangeRequestHandler.RANGES) <= url_file_module.DOWNLOAD_WORKERS
+
+    # sequential reads also fetch the next chunks, in the background
+    f = URLFile(f"{range_host}/readahead", readahead=4)
+    assert f.read(30) == data[:30]
+    wait(f._readahead_downloads.values())
+    assert all(os.path.exists(f._chunk_path(c)) for c in range(5))
+    assert not os.path.exists(f._chunk_path(5))
+    assert b"".join(iter(lambda: f.read(30), b"")) == data[30:]
+
+    # random access doesn't read ahead
+    f = URLFile(f"{range_host}/random", readahead=4)
+    f.seek(500)
+    assert f.read(30) == data[500:530]
+    assert not os.path.exists(f._chunk_path(6))
+
+    # scattered chunks are a request each, still running on at most workers threads
+    pool_sizes = []
+
+    class RecordingPool(ThreadPoolExecutor):
+      def __init__(self, max_workers, *args, **kwargs):
+        pool_sizes.append(max_workers)
+        super().__init__(max_workers, *args, **kwargs)
+    monkeypatch.setattr(url_file_module, 'ThreadPoolExecutor', RecordingPool)
+    chunks = [0, 2, 4, 6, 8]
+    assert URLFile(f"{range_host}/scattered")._download_chunks(chunks, workers=2) == {c: data[c * 100:(c + 1) * 100] for c in chunks}
+    assert pool_sizes == [2]
+
+  def test_readahead(self, monkeypatch, range_host):
+    os.environ.pop("DISABLE_FILEREADER_CACHE", None)
+    monkeypatch.setattr(url_file_module, 'CHUNK_SIZE', 100)
+    monkeypatch.setattr(RangeRequestHandler, 'DELAY', 0.5)
+    data = RangeRequestHandler.DATA
+
+    # reads don't wait for the readahead of the chunks after them
+    RangeRequestHandler.RANGES.clear()
+    f = URLFile(f"{range_host}/readahead_blocking", readahead=4)
+    start = time.monotonic()
+    assert f.read(100) == data[:100]
+    assert time.monotonic() - start < 0.4
+    assert f.read(100) == data[100:200]
+    assert len(RangeRequestHandler.RANGES) == 2
+
+    # the window is refilled in one request once half of it was read, rather than a request per read
+    monkeypatch.setattr(RangeRequestHandler, 'DELAY', 0.)
+    RangeRequestHandler.RANGES.clear()
+    f = URLFile(f"{range_host}/readahead_batched", readahead=4)
+    assert b"".join(iter(lambda: f.read(50), b"")) == data
+    assert len(RangeRequestHandler.RANGES) == 4
+
+
 class TestCache(OpenpilotTestCase):
   def test_prune_cache(self, monkeypatch):
     with tempfile.TemporaryDirectory() as tmpdir:
       monkeypatch.setattr(Paths, 'download_cache_root', staticmethod(lambda: tmpdir + "/"))
 
-      # setup test files and manifest
-      manifest_lines = []
-      for i in range(3):
-        fname = f"hash_{i}"
+      # setup test files
+      index = get_cache_index()
+      fnames = [f"hash_{i}" for i in range(3)]
+      for fname in fnames:
         with open(tmpdir + "/" + fname, "wb") as f:
           f.truncate(1000)
-        manifest_lines.append(f"{fname} {1000 + i}")
-      with open(tmpdir + "/manifest.txt", "w") as f:
-        f.write('\n'.join(manifest_lines))
+        index.add({fname: 1000})
 
       # under limit, shouldn't prune
-      assert len(os.listdir(tmpdir)) == 4
       prune_cache()
-      assert len(os.listdir(tmpdir)) == 4
+      assert all(os.path.exists(tmpdir + "/" + fname) for fname in fnames)
+      assert index.stats()["size"] == 3000
 
-      # set a tiny cache limit to force eviction (1.5 chunks worth)
-      monkeypatch.setattr(url_file_module, 'CACHE_SIZE', url_file_module.CHUNK_SIZE + url_file_module.CHUNK_SIZE // 2)
+      # reading the oldest file makes it the most recently used
+      index.touch([fnames[0]])
 
-      # prune_cache should evict oldest files to get under limit
+      # set a tiny cache limit to force eviction
+      monkeypatch.setattr(url_file_module, 'CACHE_SIZE', 2500)
       prune_cache()
       remaining = os.listdir(tmpdir)
-      # should have evicted at least one file + manifest
-      assert len(remaining) < 4
-      # newest file should remain
-      assert manifest_lines[2].split()[0] in remaining
+      assert fnames[1] not in remaining
+      assert fnames[0] in remaining and fnames[2] in remaining
+
+      stats = index.stats()
+      assert stats["hits"] == 1
+      assert stats["misses"] == 3
+      assert stats["evictions"] == 1
+      assert stats["size"] == 2000
+
+  def test_manifest_migration(self, monkeypatch):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      monkeypatch.setattr(Paths, 'download_cache_root', staticmethod(lambda: tmpdir + "/"))
+      with open(tmpdir + "/manifest.txt", "w") as f:
+        f.write("hash_0 1000\nhash_1 1001")
+
+      assert get_cache_index().stats()["entries"] == 2
+      assert not os.path.exists(tmpdir + "/manifest.txt")
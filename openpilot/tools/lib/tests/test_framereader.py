@@ -0,0 +1,147 @@
+import contextlib
+import os
+from unittest import mock
+
+import numpy as np
+
+from openpilot.common.test import OpenpilotTestCase
+import openpilot.tools.lib.framereader as framereader
+from openpilot.tools.lib.filereader import resolve_name
+from openpilot.tools.lib.framereader import FfmpegDecoder, FrameReader, LRUCache, get_video_index, load_video_index, video_index_path
+from openpilot.tools.lib.openpilotci import get_url
+
+VIDEO = get_url("0982d79ebb0de295|2021-01-04--17-13-21", "13", "fcamera.hevc")
+
+
+class TestLRUCache(OpenpilotTestCase):
+  def test_max_bytes(self):
+    cache = LRUCache(10, max_bytes=300)
+    for i in range(3):
+      cache[i] = np.zeros(100, dtype=np.uint8)
+    assert cache.nbytes == 300
+
+    # the least recently used entry is evicted first
+    cache[0]
+    cache[3] = np.zeros(100, dtype=np.uint8)
+    assert 1 not in cache
+    assert all(i in cache for i in (0, 2, 3))
+    assert cache.nbytes == 300
+
+    # replacing an entry updates the size
+    cache[3] = np.zeros(200, dtype=np.uint8)
+    assert 2 not in cache and 0 in cache
+    assert cache.nbytes == 300
+
+    # an entry larger than max_bytes is still cached, on its own
+    cache[4] = np.zeros(400, dtype=np.uint8)
+    assert 4 in cache and 3 not in cache and 0 not in cache
+    assert cache.nbytes == 400
+
+  def test_capacity(self):
+    cache = LRUCache(2)
+    for i in range(3):
+      cache[i] = np.zeros(100, dtype=np.uint8)
+    assert 0 not in cache
+    assert cache.nbytes == 200
+
+
+class TestFrameReader(OpenpilotTestCase):
+  SLOW_TEST = True
+  SHARED_DOWNLOAD_CACHE = True
+
+  def setup_method(self):
+    self.index_data = get_video_index(VIDEO)
+    self.decoder = FfmpegDecoder(VIDEO, index_data=self.index_data)
+    self.iframes = [int(i) for i in self.decoder.iframes]
+    assert len(self.iframes) >= 3
+
+  def _record_sessions(self, mocker) -> list[framereader.DecoderSession]:
+    sessions = []
+    session_cls = framereader.DecoderSession
+
+    def create_session(*args, **kwargs):
+      sessions.append(session_cls(*args, **kwargs))
+      return sessions[-1]
+    mocker.patch.object(framereader, "DecoderSession", side_effect=create_session)
+    return sessions
+
+  def test_gop_bounds(self):
+    dec = self.decoder
+    index = self.index_data['index']
+    for fidx in (0, self.iframes[1] - 1, self.iframes[1], dec.frame_count // 2, dec.frame_count - 1):
+      f_b, f_e, off_b, off_e = dec._gop_bounds(fidx)
+      assert f_b == max((i for i in self.iframes if i <= fidx), default=0)
+      assert f_e == min((i for i in self.iframes if i > fidx), default=dec.frame_count)
+      assert (off_b, off_e) == (index[f_b, 1], index[f_e, 1])
+      assert dec.get_gop_start(fidx) == f_b
+
+  def test_video_index_sidecar(self, mocker):
+    path = video_index_path(resolve_name(VIDEO))
+    with contextlib.suppress(FileNotFoundError):
+      os.remove(path)
+
+    with mock.patch.dict(os.environ, {"DISABLE_FILEREADER_CACHE": "1"}):
+      rebuilt = get_video_index(VIDEO)
+    assert not os.path.exists(path)
+
+    get_video_index(VIDEO)
+    loaded = load_video_index(path)
+    assert loaded is not None
+    assert np.array_equal(loaded['index'], rebuilt['index'])
+    assert loaded['index'].dtype == rebuilt['index'].dtype
+    assert loaded['global_prefix'] == rebuilt['global_prefix']
+    assert loaded['probe'] == rebuilt['probe']
+
+    # the sidecar is used instead of indexing the video again
+    mocker.patch.object(framereader, "hevc_index", side_effect=AssertionError("video was indexed"))
+    assert np.array_equal(get_video_index(VIDEO)['index'], rebuilt['index'])
+
+  def test_sequential_get(self, mocker):
+    sessions = self._record_sessions(mocker)
+    fidxs = list(range(self.iframes[1] - 2, self.iframes[2] + 2))
+    fr = FrameReader(VIDEO, index_data=self.index_data)
+    frames = [fr.get(fidx) for fidx in fidxs]
+    # one session decodes through the GOP boundaries
+    assert len(sessions) == 1
+
+    for fidx, frame in zip(fidxs[::5], frames[::5], strict=True):
+      fresh = FrameReader(VIDEO, index_data=self.index_data).get(fidx)
+      assert np.array_equal(frame, fresh), f"frame {fidx} differs"
+
+  def test_session_closed_early(self, mocker):
+    sessions = self._record_sessions(mocker)
+    it = self.decoder.get_iterator(0)
+    next(it)
+    it.close()
+
+    session, = sessions
+    assert session.proc.poll() is not None
+    assert not session._writer.is_alive()
+    assert session.proc.stdout.closed
+
+    # seeking back restarts the decoder, closing the previous session
+    fr = FrameReader(VIDEO, index_data=self.index_data)
+    fr.get(5)
+    fr.get(0)
+    assert len(sessions) == 3
+    assert sessions[1].proc.poll() is not None and sessions[1].proc.stdout.closed
+    fr.it.close()
+
+  def test_get_many(self):
+    # out of order, duplicated and spanning GOPs
+    fidxs = [self.iframes[1] + 3, 2, self.iframes[2] + 1, self.iframes[1] + 3, 0, 2, self.iframes[1], self.iframes[1] - 1]
+    frames = FrameReader(VIDEO, index_data=self.index_data).get_many(fidxs)
+
+    fr = FrameReader(VIDEO, index_data=self.index_data)
+    expected = [fr.get(fidx) for fidx in fidxs]
+    assert frames.shape == (len(fidxs), *expected[0].shape)
+    for fidx, frame, expected_frame in zip(fidxs, frames, expected, strict=True):
+      assert np.array_equal(frame, expected_frame), f"frame {fidx} differs"
+
+    # cached frames are returned without decoding
+    fr = FrameReader(VIDEO, index_data=self.index_data)
+    fr.get_many(fidxs)
+    with mock.patch.object(fr.decoder, "decode_gop_frames", side_effect=AssertionError("decoded again")):
+      assert np.array_equal(fr.get_many(fidxs[::-1]), frames[::-1])
+
+    assert fr.get_many([]).shape == (0, *expected[0].shape)
@@ -0,0 +1,40 @@
+import numpy as np
+
+from openpilot.cereal import messaging
+from openpilot.common.test import OpenpilotTestCase
+from openpilot.tools.lib.log_time_series import msgs_to_time_series
+
+
+def device_state_msgs(n):
+  msgs = []
+  for i in range(n):
+    msg = messaging.new_message('deviceState', valid=bool(i % 2))
+    msg.logMonoTime = int((n - i) * 1e9)
+    msg.deviceState.freeSpacePercent = i
+    msg.deviceState.cpuUsagePercent = [i % 100, 0]
+    msg.deviceState.networkType = 'wifi'
+    msgs.append(msg.as_reader())
+  return msgs
+
+
+class TestLogTimeSeries(OpenpilotTestCase):
+  def test_typed_columns(self):
+    n = 1000
+    msgs = device_state_msgs(n) + [messaging.new_message('carParams').as_reader()]
+    ts = msgs_to_time_series(msgs)
+
+    ds = ts['deviceState']
+    assert np.all(np.diff(ds['t']) > 0)
+    assert ds['freeSpacePercent'].dtype == np.float64
+    assert ds['freeSpacePercent'].tolist() == list(range(n - 1, -1, -1))
+    assert ds['cpuUsagePercent'].shape == (n, 2)
+    assert ds['startedMonoTime'].dtype == np.int64
+    assert set(ds['networkType']) == {'wifi'}
+    assert ds['_valid'].dtype == np.bool_
+    assert 'carParams' in ts
+
+  def test_selection(self):
+    msgs = device_state_msgs(10) + [messaging.new_message('carParams').as_reader()]
+    ts = msgs_to_time_series(msgs, services=['deviceState'], fields={'deviceState': ['freeSpacePercent', 'networkStats']})
+    assert list(ts) == ['deviceState']
+    assert set(ts['deviceState']) == {'t', '_valid', 'freeSpacePercent', 'networkStats/wwanTx', 'networkStats/wwanRx'}
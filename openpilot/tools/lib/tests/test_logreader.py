@@ -1,19 +1,26 @@
+import bz2
 import capnp
 import contextlib
 import io
+import operator
+import pickle
 import shutil
 import tempfile
 import os
 import unittest
 import requests
+import zstandard as zstd
 
 from openpilot.common.test import OpenpilotTestCase
 from openpilot.common.parameterized import parameterized
 
 from openpilot.cereal import log as capnp_log
+from openpilot.tools.lib import segment_cache
+from openpilot.tools.lib.log_index import index_path
 from openpilot.tools.lib.logreader import LogsUnavailable, LogIterable, LogReader, parse_indirect, ReadMode
 from openpilot.tools.lib.file_sources import comma_api_source, InternalUnavailableException
 from openpilot.tools.lib.route import SegmentRange
+from openpilot.tools.lib.segment_cache import decompressed_cache_root
 from openpilot.tools.lib.url_file import URLFileException
 
 NUM_SEGS = 17  # number of segments in the test route
@@ -26,6 +33,10 @@ def noop(segment: LogIterable):
   return segment
 
 
+def count_msgs(segment: LogIterable):
+  return sum(1 for _ in segment)
+
+
 @contextlib.contextmanager
 def setup_source_scenario(mocker, is_internal=False):
   internal_source_mock = mocker.patch("openpilot.tools.lib.logreader.internal_source")
@@ -262,3 +273,98 @@ class TestLogReader(OpenpilotTestCase):
       msgs = list(LogReader(qlog.name, only_union_types=True))
       assert len(msgs) == num_msgs
       [m.which() for m in msgs]
+
+  def test_as_bytes(self):
+    events = [capnp_log.Event.new_message(logMonoTime=i, valid=bool(i % 2)).to_bytes() for i in range(100)]
+    with tempfile.NamedTemporaryFile() as rlog:
+      with open(rlog.name, "wb") as f:
+        f.write(b"".join(events))
+
+      msgs = list(LogReader(rlog.name))
+      assert [bytes(m.as_bytes()) for m in msgs] == events
+      # events that aren't views of a log are copied
+      assert [pickle.loads(pickle.dumps(m)).as_bytes() for m in msgs] == events
+
+  @parameterized.expand([("",), (".bz2",), (".zst",)], names=("ext",))
+  def test_streaming(self, mocker, ext):
+    mocker.patch("openpilot.tools.lib.logreader.STREAM_READ_SIZE", 100)
+    msgs = [capnp_log.Event.new_message(logMonoTime=i, valid=bool(i % 2)).to_bytes() for i in range(1000)]
+    dat = b"".join(msgs)
+    # concatenated streams/frames, like a log that was appended to
+    if ext == ".bz2":
+      dat = bz2.compress(dat[:len(dat) // 2]) + bz2.compress(dat[len(dat) // 2:])
+    elif ext == ".zst":
+      dat = zstd.compress(dat[:len(dat) // 2]) + zstd.compress(dat[len(dat) // 2:])
+
+    with tempfile.NamedTemporaryFile(suffix=ext) as log:
+      with open(log.name, "wb") as f:
+        f.write(dat)
+
+      msgs = list(LogReader(log.name, streaming=True))
+      assert [m.logMonoTime for m in msgs] == list(range(1000))
+      assert [(m.logMonoTime, m.valid) for m in msgs] == [(m.logMonoTime, m.valid) for m in LogReader(log.name)]
+
+      # truncated last message
+      with open(log.name, "wb") as f:
+        f.write(b"".join(m.as_builder().to_bytes() for m in msgs)[:-3])
+      with self.assertWarns(RuntimeWarning):
+        assert len(list(LogReader(log.name, streaming=True))) == 999
+
+    with self.assertRaises(ValueError):
+      LogReader(QLOG_FILE, streaming=True, sort_by_time=True)
+
+  def test_index(self, mocker):
+    with tempfile.NamedTemporaryFile(suffix=".zst") as log:
+      msgs = []
+      for i in range(1000):
+        msg = capnp_log.Event.new_message(logMonoTime=i)
+        msg.init("carParams" if i % 100 == 0 else "carState")
+        msgs.append(msg.to_bytes())
+      with open(log.name, "wb") as f:
+        f.write(zstd.compress(b"".join(msgs)))
+
+      lr = LogReader(log.name, use_index=True)
+      assert lr.first("carParams") is not None
+      assert len(list(lr.filter("carParams"))) == len(list(LogReader(log.name).filter("carParams"))) == 10
+      assert len(list(lr.filter("carState", 100, 200))) == 99
+      assert len(list(lr.filter("initData"))) == 0
+      assert len(list(lr)) == 1000
+      assert os.path.exists(index_path(log.name))
+
+      # the sidecar is reused instead of rebuilding the index
+      build_mock = mocker.patch("openpilot.tools.lib.log_index.LogIndex.build")
+      assert len(list(LogReader(log.name, use_index=True).filter("carParams"))) == 10
+      assert build_mock.call_count == 0
+
+  def test_prefetch_and_map_reduce(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      logs = []
+      for seg in range(5):
+        logs.append(os.path.join(tmpdir, f"rlog_{seg}"))
+        with open(logs[-1], "wb") as f:
+          f.write(b"".join(capnp_log.Event.new_message(logMonoTime=seg * 1000 + i).to_bytes() for i in range(100 * (seg + 1))))
+
+      expected = [m.logMonoTime for m in LogReader(logs)]
+      assert [m.logMonoTime for m in LogReader(logs, prefetch=2)] == expected
+
+      lr = LogReader(logs)
+      assert list(lr.map_segments(count_msgs, num_processes=2)) == [100, 200, 300, 400, 500]
+      assert lr.map_reduce(count_msgs, operator.add, 0, num_processes=2) == len(expected)
+
+  def test_decompressed_cache(self, mocker, monkeypatch):
+    with tempfile.NamedTemporaryFile(suffix=".zst") as log:
+      with open(log.name, "wb") as f:
+        f.write(zstd.compress(b"".join(capnp_log.Event.new_message(logMonoTime=i).to_bytes() for i in range(100))))
+
+      assert len(list(LogReader(log.name, cache_decompressed=True))) == 100
+      assert len(os.listdir(decompressed_cache_root())) == 1
+
+      # warm runs read the cached segment, optionally memory mapped
+      file_reader_mock = mocker.patch("openpilot.tools.lib.logreader.FileReader")
+      for use_mmap in (True, False):
+        assert [m.logMonoTime for m in LogReader(log.name, cache_decompressed=True, use_mmap=use_mmap)] == list(range(100))
+      assert file_reader_mock.call_count == 0
+
+      monkeypatch.setattr(segment_cache, "DECOMPRESSED_CACHE_SIZE", 0)
+      segment_cache.prune_decompressed()
+      assert len(os.listdir(decompressed_cache_root())) == 0
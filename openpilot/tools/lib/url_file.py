@@ -1,8 +1,14 @@
+import atexit
+import contextlib
 import logging
+import math
 import os
 import re
 import socket
+import sqlite3
+import threading
 import time
+from concurrent.futures import Future, ThreadPoolExecutor
 from hashlib import md5
 from urllib3 import PoolManager, Retry
 from urllib3.response import BaseHTTPResponse
@@ -16,6 +22,11 @@ from urllib3.exceptions import MaxRetryError
 K = 1000
 CHUNK_SIZE = 1000 * K
 CACHE_SIZE = 10 * 1024 * 1024 * 1024  # total cache size in GB
+# max concurrent range requests when downloading missing chunks
+DOWNLOAD_WORKERS = 8
+# cache hits are recorded in batches, at least this often
+TOUCH_FLUSH_INTERVAL = 5.0
+TOUCH_FLUSH_SIZE = 256
 
 logging.getLogger("urllib3").setLevel(logging.WARNING)
 
@@ -24,31 +35,145 @@ def hash_url(link: str) -> str:
   return md5(link.split("?", maxsplit=1)[0].encode('utf-8')).hexdigest()
 
 
-def prune_cache(new_entry: str | None = None) -> None:
-  """Evicts oldest cache files (LRU) until cache is under the size limit."""
-  # we use a manifest to avoid tons of os.stat syscalls (slow)
-  manifest = {}
-  manifest_path = Paths.download_cache_root() + "manifest.txt"
-  if os.path.exists(manifest_path):
+class DownloadCacheIndex:
+  def __init__(self, root: str):
+    """
+      LRU index of the download cache chunks in a sqlite database, safe to share between processes.
+      Cache hits are recorded in batches, downloads and evictions in a single transaction each.
+    """
+    self.root = root
+    self.db_path = os.path.join(root, "manifest.db")
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self._lock = threading.Lock()
+    self._touched: dict[str, float] = {}
+    self._last_flush = time.monotonic()
+    self._last_time = 0.0
+
+    os.makedirs(root, exist_ok=True)
+    self._conn = sqlite3.connect(self.db_path, timeout=60, isolation_level=None, check_same_thread=False)
+    self._conn.execute("PRAGMA journal_mode=WAL")
+    self._conn.execute("PRAGMA synchronous=NORMAL")
+    with self._transaction() as c:
+      c.execute("CREATE TABLE IF NOT EXISTS entries (name TEXT PRIMARY KEY, size INTEGER NOT NULL, atime REAL NOT NULL)")
+      c.execute("CREATE INDEX IF NOT EXISTS entries_atime ON entries (atime)")
+      c.execute("CREATE TABLE IF NOT EXISTS total (id INTEGER PRIMARY KEY CHECK (id = 0), size INTEGER NOT NULL)")
+      c.execute("INSERT OR IGNORE INTO total VALUES (0, 0)")
+      self._import_manifest(c)
+    atexit.register(self._flush_at_exit)
+
+  def _flush_at_exit(self) -> None:
+    # the cache may have been cleared already
+    with contextlib.suppress(sqlite3.Error):
+      self.flush()
+
+  @contextlib.contextmanager
+  def _transaction(self):
+    with self._lock:
+      # IMMEDIATE takes the write lock up front, serializing writers across processes
+      self._conn.execute("BEGIN IMMEDIATE")
+      try:
+        yield self._conn
+      except BaseException:
+        self._conn.execute("ROLLBACK")
+        raise
+      self._conn.execute("COMMIT")
+
+  def _now(self) -> float:
+    # strictly increasing within a process, so LRU order is deterministic
+    self._last_time = max(time.time(), self._last_time + 1e-6)  # noqa: TID251
+    return self._last_time
+
+  def _import_manifest(self, c: sqlite3.Connection) -> None:
+    # migrate the old manifest.txt format
+    manifest_path = os.path.join(self.root, "manifest.txt")
+    if not os.path.exists(manifest_path):
+      return
     with open(manifest_path) as f:
-      manifest = {parts[0]: int(parts[1]) for line in f if (parts := line.strip().split()) and len(parts) == 2}
+      entries = {parts[0]: int(parts[1]) for line in f if (parts := line.strip().split()) and len(parts) == 2}
+    self._add(c, {name: (CHUNK_SIZE, atime) for name, atime in entries.items()})
+    os.remove(manifest_path)
+
+  def _add(self, c: sqlite3.Connection, entries: dict[str, tuple[int, float]]) -> None:
+    for name, (size, atime) in entries.items():
+      old = c.execute("SELECT size FROM entries WHERE name = ?", (name,)).fetchone()
+      c.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?)", (name, size, atime))
+      c.execute("UPDATE total SET size = size + ?", (size - (old[0] if old else 0),))
+
+  def _flush_touched(self, c: sqlite3.Connection) -> None:
+    c.executemany("UPDATE entries SET atime = ? WHERE name = ?", [(atime, name) for name, atime in self._touched.items()])
+    self._touched.clear()
+    self._last_flush = time.monotonic()
+
+  def _evict(self, c: sqlite3.Connection) -> None:
+    total = c.execute("SELECT size FROM total").fetchone()[0]
+    while total > CACHE_SIZE:
+      rows = c.execute("SELECT name, size FROM entries ORDER BY atime LIMIT 64").fetchall()
+      if not rows:
+        break
+      for name, size in rows:
+        if total <= CACHE_SIZE:
+          break
+        try:
+          os.remove(os.path.join(self.root, name))
+        except OSError:
+          pass
+        c.execute("DELETE FROM entries WHERE name = ?", (name,))
+        total -= size
+        self.evictions += 1
+    c.execute("UPDATE total SET size = ?", (max(total, 0),))
+
+  def add(self, entries: dict[str, int]) -> None:
+    """Records newly downloaded files and their sizes, evicting the least recently used files if over CACHE_SIZE"""
+    self.misses += len(entries)
+    with self._transaction() as c:
+      self._flush_touched(c)
+      self._add(c, {name: (size, self._now()) for name, size in entries.items()})
+      self._evict(c)
+
+  def touch(self, names: list[str]) -> None:
+    """Records cache hits, written out in batches"""
+    with self._lock:
+      self.hits += len(names)
+      for name in names:
+        self._touched[name] = self._now()
+    if len(self._touched) >= TOUCH_FLUSH_SIZE or time.monotonic() - self._last_flush > TOUCH_FLUSH_INTERVAL:
+      self.flush()
+
+  def flush(self) -> None:
+    if self._touched:
+      with self._transaction() as c:
+        self._flush_touched(c)
+
+  def prune(self) -> None:
+    with self._transaction() as c:
+      self._flush_touched(c)
+      self._evict(c)
+
+  def stats(self) -> dict[str, int]:
+    with self._lock:
+      size = self._conn.execute("SELECT size FROM total").fetchone()[0]
+      entries = self._conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+    return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "size": size, "entries": entries}
+
+
+_cache_indexes: dict[str, DownloadCacheIndex] = {}
+
+
+def get_cache_index() -> DownloadCacheIndex:
+  root = Paths.download_cache_root()
+  index = _cache_indexes.get(root)
+  # the cache directory may have been cleared since
+  if index is None or not os.path.exists(index.db_path):
+    index = _cache_indexes[root] = DownloadCacheIndex(root)
+  return index
+
+
+def prune_cache() -> None:
+  """Evicts least recently used cache files until cache is under the size limit."""
+  get_cache_index().prune()
 
-  if new_entry:
-    manifest[new_entry] = int(time.time())  # noqa: TID251
-
-  # evict the least recently used files until under limit
-  sorted_items = sorted(manifest.items(), key=lambda x: x[1])
-  while len(manifest) * CHUNK_SIZE > CACHE_SIZE and sorted_items:
-    key, _ = sorted_items.pop(0)
-    try:
-      os.remove(Paths.download_cache_root() + key)
-    except OSError:
-      pass
-    manifest.pop(key, None)
-
-  # write out manifest
-  with atomic_write(manifest_path, mode="w", overwrite=True) as f:
-    f.write('\n'.join(f"{k} {v}" for k, v in manifest.items()))
 
 class URLFileException(Exception):
   pass
@@ -56,10 +181,15 @@ class URLFileException(Exception):
 
 class URLFile:
   _pool_manager: PoolManager | None = None
+  _readahead_pool: ThreadPoolExecutor | None = None
 
   @staticmethod
   def reset() -> None:
     URLFile._pool_manager = None
+    # the pool's threads don't exist in a forked child
+    URLFile._readahead_pool = None
+    # sqlite connections can't be used across a fork
+    _cache_indexes.clear()
 
   @staticmethod
   def pool_manager() -> PoolManager:
@@ -69,11 +199,21 @@ class URLFile:
       URLFile._pool_manager = PoolManager(num_pools=10, maxsize=100, socket_options=socket_options, retries=retries)
     return URLFile._pool_manager
 
-  def __init__(self, url: str, timeout: int = 10, cache: bool | None = None):
+  @staticmethod
+  def readahead_pool() -> ThreadPoolExecutor:
+    if URLFile._readahead_pool is None:
+      URLFile._readahead_pool = ThreadPoolExecutor(DOWNLOAD_WORKERS, thread_name_prefix="urlfile_readahead")
+    return URLFile._readahead_pool
+
+  def __init__(self, url: str, timeout: int = 10, cache: bool | None = None, readahead: int = 0):
     self._url = url
     self._timeout = Timeout(connect=timeout, read=timeout)
     self._pos = 0
     self._length: int | None = None
+    # on sequential reads, also download this many chunks past the end of the read in the background
+    self._readahead = readahead
+    self._readahead_downloads: dict[int, Future] = {}
+    self._last_read_end = 0
     #  Caching enabled by default, can be disabled with DISABLE_FILEREADER_CACHE=1, or overwritten by the cache input
     self._force_download = int(os.environ.get("DISABLE_FILEREADER_CACHE", "0")) == 1
     if cache is not None:
@@ -119,37 +259,113 @@ class URLFile:
     return self._length
 
   def read(self, ll: int | None = None) -> bytes:
+    if ll is not None:
+      # like a regular file, don't read past EOF (range requests past the end fail)
+      length = self.get_length()
+      if length != -1:
+        ll = max(0, min(ll, length - self._pos))
+      if ll == 0:
+        return b""
+
     if self._force_download:
       return self.read_aux(ll=ll)
 
     file_begin = self._pos
     file_end = self._pos + ll if ll is not None else self.get_length()
     assert file_end != -1, f"Remote file is empty or doesn't exist: {self._url}"
-    #  We have to align with chunks we store. Position is the begginiing of the latest chunk that starts before or at our file
-    position = (file_begin // CHUNK_SIZE) * CHUNK_SIZE
-    response = b""
-    while True:
-      self._pos = position
-      chunk_number = self._pos / CHUNK_SIZE
-      file_name = hash_url(self._url) + "_" + str(chunk_number)
-      full_path = os.path.join(Paths.download_cache_root(), str(file_name))
-      data = None
-      #  If we don't have a file, download it
-      if not os.path.exists(full_path):
-        data = self.read_aux(ll=CHUNK_SIZE)
-        with atomic_write(full_path, mode="wb", overwrite=True) as new_cached_file:
-          new_cached_file.write(data)
-        prune_cache(file_name)
+    if file_end <= file_begin:
+      return b""
+
+    #  We have to align with chunks we store
+    chunks = list(range(file_begin // CHUNK_SIZE, (file_end - 1) // CHUNK_SIZE + 1))
+
+    # only wait for the readahead downloads of the chunks this read needs
+    cached: dict[int, bytes] = {}
+    for chunk in chunks:
+      future = self._readahead_downloads.pop(chunk, None)
+      if future is not None:
+        with contextlib.suppress(Exception):
+          cached |= {c: d for c, d in future.result().items() if c in chunks}
+
+    hits = []
+    for chunk in chunks:
+      if chunk in cached:
+        continue
+      try:
+        with open(self._chunk_path(chunk), "rb") as cached_file:
+          cached[chunk] = cached_file.read()
+        hits.append(self._chunk_name(chunk))
+      except FileNotFoundError:
+        pass
+    get_cache_index().touch(hits)
+
+    cached |= self._download_chunks([c for c in chunks if c not in cached])
+
+    if self._readahead > 0 and file_begin == self._last_read_end:
+      self._start_readahead(chunks[-1])
+
+    parts = []
+    for chunk in chunks:
+      position = chunk * CHUNK_SIZE
+      parts.append(cached[chunk][max(0, file_begin - position): min(CHUNK_SIZE, file_end - position)])
+
+    self._pos = self._last_read_end = file_end
+    return b"".join(parts)
+
+  def _start_readahead(self, last_chunk: int) -> None:
+    length = self.get_length()
+    end_chunk = (length - 1) // CHUNK_SIZE if length != -1 else last_chunk
+    window = range(last_chunk + 1, min(last_chunk + self._readahead, end_chunk) + 1)
+    self._readahead_downloads = {c: f for c, f in self._readahead_downloads.items() if c in window}
+
+    # refill the whole window in one request once half of it was read, instead of a request per read
+    missing = [c for c in window if c not in self._readahead_downloads and not os.path.exists(self._chunk_path(c))]
+    if missing and len(window) - len(missing) < self._readahead / 2:
+      future = URLFile.readahead_pool().submit(self._download_chunks, missing, 1)
+      self._readahead_downloads |= dict.fromkeys(missing, future)
+
+  def _chunk_name(self, chunk: int) -> str:
+    return hash_url(self._url) + "_" + str(float(chunk))
+
+  def _chunk_path(self, chunk: int) -> str:
+    return os.path.join(Paths.download_cache_root(), self._chunk_name(chunk))
+
+  def _download_chunks(self, chunks: list[int], workers: int = DOWNLOAD_WORKERS) -> dict[int, bytes]:
+    """Downloads and caches chunks, batching consecutive ones into a single range request, with up to workers requests running concurrently"""
+    if not chunks:
+      return {}
+
+    # batch consecutive chunks, splitting long runs so the requests can be spread over the workers
+    max_batch = math.ceil(len(chunks) / workers)
+    batches: list[list[int]] = []
+    for chunk in chunks:
+      if batches and batches[-1][-1] + 1 == chunk and len(batches[-1]) < max_batch:
+        batches[-1].append(chunk)
       else:
-        with open(full_path, "rb") as cached_file:
-          data = cached_file.read()
+        batches.append([chunk])
+
+    length = self.get_length()
 
-      response += data[max(0, file_begin - position): min(CHUNK_SIZE, file_end - position)]
+    def download(batch: list[int]) -> dict[int, bytes]:
+      start, end = batch[0] * CHUNK_SIZE, (batch[-1] + 1) * CHUNK_SIZE
+      if length != -1:
+        end = min(end, length)
+      data = self.get_multi_range([(start, end)])[0]
+      return {chunk: data[i * CHUNK_SIZE:(i + 1) * CHUNK_SIZE] for i, chunk in enumerate(batch)}
 
-      position += CHUNK_SIZE
-      if position >= file_end:
-        self._pos = file_end
-        return response
+    downloaded: dict[int, bytes] = {}
+    if len(batches) == 1:
+      downloaded = download(batches[0])
+    else:
+      with ThreadPoolExecutor(min(workers, len(batches))) as pool:
+        for batch in pool.map(download, batches):
+          downloaded |= batch
+
+    for chunk, data in downloaded.items():
+      with atomic_write(self._chunk_path(chunk), mode="wb", overwrite=True) as new_cached_file:
+        new_cached_file.write(data)
+    get_cache_index().add({self._chunk_name(chunk): len(data) for chunk, data in downloaded.items()})
+    return downloaded
 
   def read_aux(self, ll: int | None = None) -> bytes:
     if ll is None:
@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+import argparse
+import time
+
+import openpilot.cereal.messaging as messaging
+from openpilot.cereal.services import SERVICE_LIST
+
+
+def print_summary(summary: dict, budget_ms: float) -> None:
+  print(f"\n{'service':<28}{'freq':>8}{'KB/s':>10}{'drops':>7}{'p50 ms':>9}{'p99 ms':>9}{'max ms':>9}")
+  for s, st in sorted(summary["recv"].items(), key=lambda x: -x[1]["latency_p99_ms"]):
+    flag = " !" if st["latency_p99_ms"] > budget_ms else ""
+    latency = f"{st['latency_p50_ms']:>9.1f}{st['latency_p99_ms']:>9.1f}{st['latency_max_ms']:>9.1f}"
+    print(f"{s:<28}{st['freq']:>8.1f}{st['bytes_per_sec'] / 1e3:>10.1f}{st['drops']:>7}{latency}{flag}")
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Measure publish to receive latency, throughput and drops of services",
+                                   formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument("services", nargs="*", help="services to measure, defaults to all fixed frequency services")
+  parser.add_argument("--interval", type=float, default=5., help="seconds between summaries")
+  parser.add_argument("--budget", type=float, default=10., help="flag services with a p99 latency above this, in ms")
+  args = parser.parse_args()
+
+  services = args.services or [s for s, service in SERVICE_LIST.items() if service.frequency > 1e-5]
+  poller = messaging.Poller()
+  socks = [messaging.sub_sock(s, poller=poller, conflate=False) for s in services]
+  stats = messaging.MessagingStats(args.interval)
+
+  while True:
+    evts = messaging.drain_many(socks, poller, timeout=100, raw=True)
+    cur_time_ns = time.monotonic_ns()
+    for evt in evts:
+      stats.record_recv(evt.which(), evt.logMonoTime, len(evt.dat), cur_time_ns)
+
+    cur_time = time.monotonic()
+    if cur_time - stats.start_time >= args.interval:
+      print_summary(stats.summary(cur_time), args.budget)
+      stats.reset(cur_time)